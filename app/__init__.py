@@ -8,12 +8,17 @@ from config import configs
 db = SQLAlchemy()
 
 
-def create_app(config_name):
+def create_app(config_name, readonly=False):
+    '''
+    :param readonly: open the databases read-only, for scripts which do not write
+    '''
     app = Flask(__name__)
     conf = configs[config_name]
     app.config.from_object(conf)
     conf.init_app(app)
 
+    from .database import configure_sqlite
+    configure_sqlite(app, readonly=readonly)
     db.init_app(app)
 
     from .main import main
@@ -35,8 +40,30 @@ def create_app(config_name):
     logger.addHandler(ch)
     app.logger = logger
 
-    if not os.path.exists(conf.DB):
+    # a read-only app never creates or migrates the database
+    if readonly:
+        if not os.path.exists(conf.DB):
+            raise Exception('Database %s does not exist' % conf.DB)
+        # fail here, instead of with "no such column" in the middle of a query
+        from .migrate import get_missing_columns
+        with app.app_context():
+            missing = get_missing_columns(db.engine)
+        if missing:
+            raise Exception('Database %s is older than the models, missing %s. '
+                            'Run migration first: create_app(\'%s\') without readonly, e.g. start the monitor'
+                            % (conf.DB, ', '.join(missing), config_name))
+    elif not os.path.exists(conf.DB):
         with app.app_context():
             db.create_all()
+    else:
+        # add missing columns and indexes to existing database
+        from .migrate import migrate
+        with app.app_context():
+            for sql in migrate(db.engine):
+                logger.info('Migrate database: %s' % sql)
+            from .models import backfill_smiles_hash
+            n = backfill_smiles_hash()
+            if n > 0:
+                logger.info('Migrate database: smiles_hash of %i tasks filled' % n)
 
     return app
@@ -0,0 +1,133 @@
+from multiprocessing import Pool
+
+from flask import current_app
+
+from config import Config
+from . import db
+from .models import Task, Job, analyze_job, save_job_properties, mark_post_dirty
+
+
+def analyze_job_worker(job_id_dir_procedure_kwargs):
+    job_id, job_dir, procedure, kwargs = job_id_dir_procedure_kwargs
+    return_dict = analyze_job(job_dir, procedure, **kwargs)
+    return_dict['job_id'] = job_id
+    return return_dict
+
+
+class InsituResult:
+    '''
+    Result of a job analyzed on the compute node, which is collected like the AsyncResult of the pool
+    '''
+
+    def __init__(self, return_dict):
+        self.return_dict = return_dict
+
+    def ready(self) -> bool:
+        return True
+
+    def get(self) -> dict:
+        return self.return_dict
+
+
+class AnalysisPool:
+    '''
+    A long-lived pool of worker processes for analyzing finished jobs of all tasks
+    Only (job_id, job_dir, procedure, analysis kwargs) are sent to workers
+    Results stream back and are committed in batches, so that analysis of different tasks interleaves
+    '''
+
+    def __init__(self, n_process=8, batch=50):
+        self.n_process = n_process
+        self.batch = batch
+        self._pool = None
+        self._pending = {}  # {job_id: AsyncResult}
+
+    def __repr__(self):
+        return '<AnalysisPool: %i processes %i pending>' % (self.n_process, self.n_pending)
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = Pool(self.n_process)
+        return self._pool
+
+    @property
+    def n_pending(self) -> int:
+        return len(self._pending)
+
+    def submit(self, job) -> bool:
+        '''
+        Send a job to the pool. A job will not be sent twice before its result is collected
+        If the job is analyzed in-situ on the compute node, its result is taken directly
+        '''
+        if job.id in self._pending:
+            return False
+        return_dict = job.get_insitu_result()
+        if return_dict is not None:
+            current_app.logger.info('Ingest in-situ result %s' % job)
+            return_dict['job_id'] = job.id
+            self._pending[job.id] = InsituResult(return_dict)
+            return True
+        current_app.logger.info('Analyze %s' % job)
+        args = (job.id, job.dir, job.task.procedure, job.get_analyze_kwargs())
+        self._pending[job.id] = self.pool.apply_async(analyze_job_worker, [args])
+        return True
+
+    def collect(self, wait=False) -> [int]:
+        '''
+        Save the results of analyzed jobs
+        :param wait: wait until all submitted jobs are analyzed
+        :return: id of tasks which have new analyzed jobs
+        '''
+        return_dicts = []
+        for job_id, async_result in list(self._pending.items()):
+            if not (wait or async_result.ready()):
+                continue
+            del self._pending[job_id]
+            try:
+                return_dicts.append(async_result.get())
+            except Exception as e:
+                current_app.logger.error('Analyze failed job %i %s' % (job_id, repr(e)))
+
+        task_ids = []
+        for i in range(0, len(return_dicts), self.batch):
+            batch = return_dicts[i:i + self.batch]
+            jobs = Job.query.filter(Job.id.in_([return_dict['job_id'] for return_dict in batch]))
+            job_dict = {job.id: job for job in jobs}
+            for return_dict in batch:
+                job = job_dict.get(return_dict.pop('job_id'))
+                if job is None:
+                    continue
+                exception = return_dict.pop('exception')
+                if exception is not None:
+                    current_app.logger.error('Analyze failed %s %s' % (job, exception))
+                for k, v in return_dict.items():
+                    setattr(job, k, v)
+                if job.task_id not in task_ids:
+                    task_ids.append(job.task_id)
+            save_job_properties(list(job_dict.values()))
+            mark_post_dirty(list(job_dict.values()))
+            db.session.commit()
+
+        for task in Task.query.filter(Task.id.in_(task_ids)):
+            task.update_status()
+        return task_ids
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+_analysis_pool = None
+
+
+def get_analysis_pool() -> AnalysisPool:
+    '''
+    The analysis pool shared by the whole process
+    '''
+    global _analysis_pool
+    if _analysis_pool is None:
+        _analysis_pool = AnalysisPool(n_process=Config.ANALYSIS_NPROCS)
+    return _analysis_pool
@@ -0,0 +1,143 @@
+import os
+import signal
+import traceback
+from multiprocessing import Pool
+
+from flask import current_app
+
+from . import db
+from .models import Task, Compute, build_model, prepare_job
+
+
+class BuildTimeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise BuildTimeout('Build timeout')
+
+
+def build_task_worker(spec_timeout):
+    '''
+    Build the simulation box and prepare all jobs of a task in a worker process
+    The working directory of the worker process is isolated from the monitor process
+    :param spec_timeout: (spec, timeout), spec is generated by Task.get_build_spec()
+    :return: dict of plain data, which is saved by Task.set_build_result() in the monitor process
+    '''
+    spec, timeout = spec_timeout
+    result = {
+        'task_id'     : spec['task_id'],
+        'n_mol_list'  : None,
+        'commands'    : None,
+        'exception'   : None,
+        # rows of the new jobs, inserted by the monitor process only if the build succeeds
+        'job_mappings': spec['job_mappings'],
+    }
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.alarm(timeout)
+    try:
+        build_dir = os.path.join(spec['dir'], 'build')
+        os.makedirs(build_dir, exist_ok=True)
+        os.chdir(build_dir)
+        n_mol_list = build_model(spec['procedure'], spec['smiles_list'], n_mol_list=spec['n_mol_list'],
+                                 prior_n_mol_list=spec['prior_n_mol_list'])
+        result['n_mol_list'] = n_mol_list
+        for job in spec['jobs']:
+            result['commands'] = prepare_job(spec['procedure'], job['dir'], job['t'], job['p'], job['name'],
+                                             job['repeat_id'], prior_job_dir=job['prior_job_dir'])
+    except BuildTimeout as e:
+        result['exception'] = repr(e)
+    except Exception as e:
+        traceback.print_exc()
+        result['exception'] = repr(e)
+    finally:
+        signal.alarm(0)
+    return result
+
+
+class BuildExecutor:
+    '''
+    Build many tasks at once in worker processes
+    DFF typing, Packmol packing and job preparation run in workers, the database is updated only in the monitor process
+    '''
+
+    def __init__(self, n_process=8, timeout=3600, batch=20):
+        self.n_process = n_process
+        self.timeout = timeout
+        self.batch = batch
+        self._pool = None
+        self._pending = []  # [AsyncResult]
+        self._results = []
+
+    def __repr__(self):
+        return '<BuildExecutor: %i processes %i pending>' % (self.n_process, self.n_pending)
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = Pool(self.n_process)
+        return self._pool
+
+    @property
+    def n_pending(self) -> int:
+        return len(self._pending)
+
+    def dispatch(self, tasks):
+        '''
+        Send the tasks to workers. Jobs are inserted when the results are collected
+        '''
+        specs = []
+        for task in tasks:
+            current_app.logger.info('Build %s' % task)
+            try:
+                spec = task.get_build_spec()
+            except Exception as e:
+                current_app.logger.error('Build task failed %s: %s' % (task, repr(e)))
+                traceback.print_exc()
+                task.status = Compute.Status.FAILED
+            else:
+                if spec is not None:
+                    specs.append(spec)
+        db.session.commit()
+
+        for spec in specs:
+            self._pending.append(self.pool.apply_async(build_task_worker, [(spec, self.timeout)]))
+
+    def collect(self, wait=False) -> [int]:
+        '''
+        Save results of finished builds. The database is committed in batches
+        :return: id of tasks which are built successfully
+        '''
+        built_ids = []
+        pending = []
+        results = []
+        for async_result in self._pending:
+            if wait or async_result.ready():
+                results.append(async_result.get())
+            else:
+                pending.append(async_result)
+        self._pending = pending
+
+        for i in range(0, len(results), self.batch):
+            batch = results[i:i + self.batch]
+            tasks = Task.query.filter(Task.id.in_([result['task_id'] for result in batch]))
+            task_dict = {task.id: task for task in tasks}
+            for result in batch:
+                task = task_dict.get(result['task_id'])
+                if task is None:
+                    continue
+                task.set_build_result(result)
+                if task.status == Compute.Status.DONE:
+                    built_ids.append(task.id)
+            db.session.commit()
+        return built_ids
+
+    def build(self, tasks) -> [int]:
+        self.dispatch(tasks)
+        return self.collect(wait=True)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
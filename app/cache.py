@@ -0,0 +1,44 @@
+from contextvars import ContextVar
+from functools import wraps
+from itertools import count
+
+_counter = count(1)
+_cycle = ContextVar('cycle', default=0)  # 0 means memoization is off
+_active = set()  # cycles which are not finished. Memos of other cycles are dropped
+
+
+def new_cycle():
+    '''
+    Start a new monitor cycle. Values memoized in previous cycles are discarded
+    The cycle is kept in a context variable. Each monitor stage is an asyncio task with its own copy of the context,
+    so a stage starting a new cycle does not discard the memos of other stages still in progress
+    '''
+    _active.discard(_cycle.get())
+    cycle = next(_counter)
+    _active.add(cycle)
+    _cycle.set(cycle)
+
+
+def cycle_cached(func):
+    '''
+    Memoize a method without arguments on the instance, for the current monitor cycle only
+    Outside of the monitor (web app and scripts) no cycle is started and the method is always evaluated
+    The memo is a plain attribute of the instance, so it survives the expiration of SQLAlchemy attributes after commit
+    '''
+
+    @wraps(func)
+    def wrapper(self):
+        cycle = _cycle.get()
+        if cycle == 0:
+            return func(self)
+        memo = self.__dict__.setdefault('_cycle_memo', {})  # {cycle: {name: value}}
+        if cycle not in memo:
+            for finished in [c for c in memo if c not in _active]:
+                del memo[finished]
+            memo[cycle] = {}
+        values = memo[cycle]
+        if func.__name__ not in values:
+            values[func.__name__] = func(self)
+        return values[func.__name__]
+
+    return wrapper
@@ -0,0 +1,73 @@
+import sqlite3
+
+from sqlalchemy.pool import QueuePool
+
+
+def readonly_uri(uri):
+    '''
+    Convert a sqlite URI to a read-only URI
+    sqlite:////path/db?check_same_thread=False -> sqlite:///file:/path/db?mode=ro&uri=true&check_same_thread=False
+    '''
+    prefix = 'sqlite:///'
+    if not uri.startswith(prefix) or uri.startswith(prefix + 'file:'):
+        return uri
+    path, _, query = uri[len(prefix):].partition('?')
+    query = 'mode=ro&uri=true' + ('&' + query if query else '')
+    return '%sfile:%s?%s' % (prefix, path, query)
+
+
+def get_connection_factory(pragmas):
+    '''
+    sqlite3.Connection class which applies the pragmas to each new connection
+    Each app creates its own class, so the settings of different apps in one process are kept apart
+    '''
+
+    class PragmaConnection(sqlite3.Connection):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            cursor = self.cursor()
+            # journal mode is stored in the database file, a read-only connection cannot change it
+            if pragmas['journal_mode'] is not None and not pragmas['readonly']:
+                cursor.execute('PRAGMA journal_mode=%s' % pragmas['journal_mode'])
+            if pragmas['synchronous'] is not None:
+                cursor.execute('PRAGMA synchronous=%s' % pragmas['synchronous'])
+            cursor.execute('PRAGMA busy_timeout=%i' % (pragmas['busy_timeout'] * 1000))
+            if pragmas['readonly']:
+                cursor.execute('PRAGMA query_only=ON')
+            cursor.close()
+
+    return PragmaConnection
+
+
+def configure_sqlite(app, readonly=False):
+    '''
+    Configure the engines of the default database and all binds before db.init_app()
+    SQLITE_JOURNAL_MODE and SQLITE_SYNCHRONOUS are applied to each connection, None keeps the SQLite default
+    WAL journaling lets readers and the writer work at the same time, but only on a local filesystem
+    A busy writer makes others wait up to SQLITE_BUSY_TIMEOUT seconds instead of failing with "database is locked"
+    :param readonly: open all databases read-only. For scripts which only read, they never block the monitor
+    '''
+    config = app.config
+    pragmas = {
+        'journal_mode': config.get('SQLITE_JOURNAL_MODE'),
+        'synchronous' : config.get('SQLITE_SYNCHRONOUS'),
+        'busy_timeout': config.get('SQLITE_BUSY_TIMEOUT', 60),
+        'readonly'    : readonly,
+    }
+
+    if readonly:
+        config['SQLALCHEMY_DATABASE_URI'] = readonly_uri(config['SQLALCHEMY_DATABASE_URI'])
+        config['SQLALCHEMY_BINDS'] = {key: readonly_uri(uri) for key, uri in config['SQLALCHEMY_BINDS'].items()}
+        config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = False
+
+    # each bind gets its own engine and its own pool created with these options
+    # connections are shared between threads (check_same_thread=False), and reused instead of reopened
+    engine_options = {
+        'poolclass'    : QueuePool,
+        'pool_size'    : config.get('SQLITE_POOL_SIZE', 5),
+        'max_overflow' : config.get('SQLITE_POOL_OVERFLOW', 10),
+        'pool_pre_ping': True,
+        'connect_args' : {'timeout': pragmas['busy_timeout'], 'factory': get_connection_factory(pragmas)},
+    }
+    engine_options.update(config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
@@ -0,0 +1,87 @@
+import json
+
+from flask import current_app
+from sqlalchemy.orm import contains_eager
+
+from config import Config
+from . import db
+from .models import Task, Job, Compute
+
+
+class ExtendJob:
+    def __init__(self, job, continue_n):
+        self.job = job
+        self.continue_n = continue_n
+
+    def __le__(self, other):
+        return self.continue_n < other.continue_n
+
+    def __eq__(self, other):
+        return self.continue_n == other.continue_n
+
+    def __gt__(self, other):
+        return self.continue_n > other.continue_n
+
+
+def query_extend_jobs(procedure, n_job=None):
+    '''
+    Analyzed jobs of the procedure which are not converged and need to be extended
+    All filters are done in SQL, the task of each job is loaded in the same query
+    '''
+    jobs = Job.query.join(Job.task).options(contains_eager(Job.task)) \
+        .filter(Task.procedure == procedure) \
+        .filter(Job.status == Compute.Status.ANALYZED) \
+        .filter(Job.converged == False) \
+        .filter(Job.cycle < Config.EXTEND_CYCLE_LIMIT) \
+        .filter(Job.result != None) \
+        .order_by(Job.id)
+    if n_job is not None:
+        jobs = jobs.limit(n_job)
+    return jobs.all()
+
+
+class ExtendPlan:
+    '''
+    Jobs need to be extended, grouped as {name: {simulation_part: [ExtendJob]}}
+    Jobs with the same name and simulation part can be extended together in one -multidir bundle
+    The simulation part is cached on the Job row, so only the logs changed since last planning are read
+    '''
+
+    def __init__(self, procedure, n_job=None):
+        self.procedure = procedure
+        self.jobs = query_extend_jobs(procedure, n_job=n_job)
+        self.name_list = []
+        self.groups = {}
+        if self.jobs != []:
+            self.name_list = json.loads(self.jobs[0].result).get('name')
+            self.groups = {name: {} for name in self.name_list}
+
+    def __repr__(self):
+        return '<ExtendPlan: %s %i jobs>' % (self.procedure, len(self.jobs))
+
+    def plan(self, callback=None, commit=True, cache=True):
+        '''
+        Group the jobs by name and simulation part
+        :param callback: called as callback(i, n_jobs) for each job, for showing progress
+        :param commit: commit the updated simulation part counters.
+                       Set False to keep the loaded jobs from being expired, and commit them later
+        :param cache: update the simulation part counters of the jobs. Set False for read-only callers, e.g. stats
+        '''
+        for i, job in enumerate(self.jobs):
+            if callback is not None:
+                callback(i, len(self.jobs))
+            result = json.loads(job.result)
+            continue_list = result.get('continue')
+            continue_n = result.get('continue_n')
+            for j, name in enumerate(self.name_list):
+                if continue_list[j] == True:
+                    try:
+                        simulation_part_n = job.get_simulation_part(name, cache=cache)
+                    except Exception as e:
+                        current_app.logger.warning('Cannot read simulation part %s %s %s' % (job, name, repr(e)))
+                        continue
+                    self.groups[name].setdefault(str(simulation_part_n), []).append(ExtendJob(job, continue_n[j]))
+        # save updated simulation part counters
+        if commit and cache:
+            db.session.commit()
+        return self.groups
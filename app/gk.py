@@ -0,0 +1,267 @@
+import glob
+import math
+import os
+import re
+
+import numpy as np
+
+from config import Config
+
+SERIES_CACHE_DIR = 'series-cache'
+
+
+class StreamingMeanStd:
+    '''
+    Mean and standard deviation of time series from many independent replicas, updated one replica at a time
+    Welford's algorithm in float64 buffers, so memory is O(length of series) whatever the number of replicas
+    Series of different lengths are truncated to the shortest one
+    '''
+
+    def __init__(self):
+        self.n = 0
+        self.t_list = None
+        self.mean = None
+        self.m2 = None  # sum of squared deviations from the mean
+
+    def __repr__(self):
+        return '<StreamingMeanStd: %i replicas %i points>' % (self.n, self.size)
+
+    @property
+    def size(self) -> int:
+        return 0 if self.mean is None else self.mean.size
+
+    def add(self, t_list, data):
+        data = np.asarray(data, dtype=np.float64)
+        if self.mean is None:
+            self.t_list = np.array(t_list, dtype=np.float64)
+            self.mean = data.copy()
+            self.m2 = np.zeros_like(self.mean)
+            self.n = 1
+            return
+        size = min(self.size, data.size, len(t_list))
+        if size < self.size:
+            self.t_list = self.t_list[:size]
+            self.mean = self.mean[:size]
+            self.m2 = self.m2[:size]
+        data = data[:size]
+        self.n += 1
+        delta = data - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (data - self.mean)
+
+    def std(self) -> np.ndarray:
+        '''
+        Sample standard deviation of the replicas
+        '''
+        if self.n < 2:
+            return np.full(self.size, np.nan)
+        return np.sqrt(self.m2 / (self.n - 1))
+
+
+def _source_mtime(source_files) -> float:
+    mtime_list = [os.path.getmtime(f) for f in source_files if os.path.exists(f)]
+    return max(mtime_list) if mtime_list != [] else None
+
+
+def load_series(dir, key, source_files, loader):
+    '''
+    A time series of a job from the binary cache, or from loader() if the cache is missing or outdated
+    The cache is one .npy file in the job directory holding [[mtime, t...], [mtime, data...]]
+    The mtime is the latest modification time of the source files, so the cache is rebuilt whenever they change
+    Cached arrays are memory-mapped read-only instead of being parsed again
+    :param key: name of the cache file
+    :param source_files: text files parsed by loader
+    :param loader: called without argument, returns t_list, data. Either can be None if the series is not available
+    '''
+    if not Config.SERIES_CACHE:
+        return loader()
+    mtime = _source_mtime(source_files)
+    f_cache = os.path.join(dir, SERIES_CACHE_DIR, '%s.npy' % key.replace(' ', '_'))
+    if mtime is not None and os.path.exists(f_cache):
+        try:
+            array = np.load(f_cache, mmap_mode='r')
+            if array[0, 0] == mtime:
+                return array[0, 1:], array[1, 1:]
+        except Exception:
+            pass
+    t_list, data = loader()
+    if t_list is None or data is None or mtime is None:
+        return t_list, data
+    size = min(len(t_list), len(data))
+    array = np.empty((2, size + 1), dtype=np.float64)
+    array[:, 0] = mtime
+    array[0, 1:] = t_list[:size]
+    array[1, 1:] = data[:size]
+    try:
+        os.makedirs(os.path.dirname(f_cache), exist_ok=True)
+        # write to a temporary file first, so readers in other processes never see a partial file
+        np.save(f_cache + '.tmp.npy', array)
+        os.replace(f_cache + '.tmp.npy', f_cache)
+    except OSError:
+        pass
+    return t_list, data
+
+
+def get_t_property_list(dir, property, weight=0.00, name=None):
+    '''
+    mstools.analyzer.acf.get_t_property_list() with the binary cache
+    The loader reads the text files named after the abbreviation of the property, e.g. vis.txt or vis-0.50.txt
+    These files are the source of the cache. Weighted files of other weights are skipped,
+    so that writing vis-{weight}.txt does not invalidate the cache of other weights
+    If no source file is found, the cache is not used at all
+    '''
+    from mstools.analyzer.acf import get_t_property_list, Property_dict
+
+    key = '%s-%s-%.2f' % (property, name or 'System', weight)
+    prefix = Property_dict.get(property).get('abbr') + ('' if name is None else '-%s' % name)
+    source_files = [f for f in glob.glob(os.path.join(dir, prefix + '*.txt'))
+                    if re.search(r'-\d+\.\d\d\.txt$', f) is None or f.endswith('-%.2f.txt' % weight)]
+    return load_series(dir, key, source_files,
+                       lambda: get_t_property_list(dir=dir, property=property, weight=weight, name=name))
+
+
+def cache_job_series(dir, result, current=False, diff_gk=False):
+    '''
+    Fill the binary cache right after the analysis of a nvt-multi job, in the analysis worker
+    So that post-processing reads only .npy files
+    '''
+    get_t_property_list(dir, 'viscosity')
+    if current:
+        get_t_property_list(dir, 'electrical conductivity')
+    if diff_gk:
+        get_t_property_list(dir, 'diffusion constant', name='System')
+        for name in result.get('diffusion constant', {}).keys():
+            if name != 'System':
+                get_t_property_list(dir, 'diffusion constant', name=name)
+
+
+def get_property_mean_std(dir_list, property, weight=0.00, name=None, scale=1.):
+    '''
+    Averaged time series of a Green-Kubo property over independent replicas, and the standard deviation of replicas
+    Each replica is read once and discarded. Used for viscosity, electrical conductivity and diffusion constant
+    :param dir_list: directories of the replicas
+    :return: t_list, mean, stderr. All None if no replica has the series
+    '''
+    aggregator = StreamingMeanStd()
+    for dir in dir_list:
+        t_list, data = get_t_property_list(dir=dir, property=property, weight=weight, name=name)
+        if t_list is None or data is None:
+            continue
+        aggregator.add(t_list, data)
+    if aggregator.n == 0:
+        return None, None, None
+    return aggregator.t_list, aggregator.mean * scale, aggregator.std() * scale
+
+
+def weighted_running_integral(t_list, acf, weight_list, convert=1.):
+    '''
+    Running integrals of ACF with the long time tail weighted by t^(-weight), for all weights in one pass
+    The ACF is weighted only after 1 ps. Trapezoid rule, the value at t_list[i] - dt/2 for i >= 1
+    :param acf: array of shape (n_point,), or (n_repeat, n_point) for many repeats at once
+    :param weight_list: array of shape (n_weight,)
+    :param convert: unit conversion, scalar or array broadcastable to the leading dimensions of acf
+    :return: array of shape (n_weight, [n_repeat,] n_point - 1)
+    '''
+    t_list = np.asarray(t_list, dtype=np.float64)
+    acf = np.asarray(acf, dtype=np.float64)
+    convert = np.asarray(convert, dtype=np.float64)
+    dt = t_list[1] - t_list[0]
+    # factor[i, j] = 1 for t <= 1 ps and t^(-weight) afterwards
+    with np.errstate(divide='ignore'):
+        factor = np.where(t_list <= 1, 1., t_list ** -np.asarray(weight_list, dtype=np.float64)[:, None])
+    factor = factor.reshape((factor.shape[0],) + (1,) * (acf.ndim - 1) + (factor.shape[1],))
+    start = convert * acf[..., 0] * dt / 2
+    integral = np.zeros(factor.shape[:1] + acf.shape[:-1] + (acf.shape[-1] - 1,))
+    integral[..., 1:] = np.cumsum(acf[..., 1:-1] * factor[..., 1:-1], axis=-1) * (convert * dt)[..., None]
+    integral += start[..., None]
+    return integral
+
+
+def write_vis_with_weight(dir, weight, t_list, vis):
+    '''
+    Write the output of weighted_running_integral() of one job and one weight into vis-{weight}.txt
+    '''
+    dt = t_list[1] - t_list[0]
+    data = np.column_stack([t_list[1:vis.size + 1] - 0.5 * dt, vis])
+    with open(os.path.join(dir, 'vis-%.2f.txt' % weight), 'w') as f:
+        f.write('#time(ps)\tviscosity(mPa·s)\n')
+        np.savetxt(f, data, fmt='%f', delimiter='\t')
+
+
+def post_process_GK(t_p_dir, dir_list, property=None, fit=True, name=None, plot_not_converged=False,
+                    return_stderr=False):
+    '''
+    Green-Kubo property of a state point from the replicas in dir_list
+    The averaged time series and its fit are written into t_p_dir. This function does not touch the database
+    :param return_stderr: also return the fitted stderr at the end of the integration, or None if not fitted
+    :return: the fitted property and the score of the fit. None and 0 if the integral is not converged
+    '''
+    from mstools.analyzer.acf import get_block_average, Property_dict
+    from mstools.analyzer.fitting import polyval, polyfit, ExpConstfit, ExpConstval
+    from mstools.analyzer.plot import plot
+
+    scale = Config.CHARGE_SCALE ** 2 if property == 'electrical conductivity' else 1.
+    t_list, mean, stderr = get_property_mean_std(dir_list, property=property, name=name, scale=scale)
+    if t_list is None:
+        return (None, 0, None) if return_stderr else (None, 0)
+
+    if fit:
+        # fit the std of data using function y(t)=At^b
+        _log_t = np.log(t_list)
+        _log_stderr = np.log(stderr)
+        c1, s1 = polyfit(_log_t, _log_stderr, 1)
+
+        # fit the data using exponential function
+        n_block = len([t for t in t_list if t < 1])
+        t_list_block = get_block_average(t_list, n_block=n_block)
+        if property == 'viscosity':
+            bounds = ([-np.inf, 0, 0], [0, np.inf, np.inf])
+            c2, s2 = ExpConstfit(t_list_block[2:], get_block_average(mean, n_block=n_block)[2:],
+                                 bounds=bounds)
+        elif property == 'electrical conductivity':
+            # bounds = ([0, 0, 0], [np.inf, np.inf, np.inf])
+            bounds = ([0, 0, 0], [100, 100, 100])
+            c2, s2 = ExpConstfit(t_list_block[2:], get_block_average(mean, n_block=n_block)[2:],
+                                 bounds=bounds)
+        elif property == 'diffusion constant':
+            factor = math.floor(math.log10(mean.mean()))
+            bounds = ([0, 0, 0], [100, 100, 100])
+            c2, s2 = ExpConstfit(t_list_block[2:], get_block_average(mean * 10 ** (-factor), n_block=n_block)[2:],
+                                 bounds=bounds)
+            c2[0] *= 10 ** (factor)
+            c2[1] *= 10 ** (factor)
+        else:
+            return (None, 0, None) if return_stderr else (None, 0)
+        if abs(ExpConstval(t_list[-1], c2) - ExpConstval(t_list[-1] / 2, c2)) / ExpConstval(t_list[-1], c2) > 0.01:
+            if plot_not_converged:
+                plot(t_list, mean, ExpConstval(t_list, c2))
+            return (None, 0., None) if return_stderr else (None, 0.)
+
+        if name is not None:
+            file_name1 = Property_dict.get(property).get('abbr') + '-%s.txt' % (name)
+        else:
+            file_name1 = Property_dict.get(property).get('abbr') + '.txt'
+        f1 = open(os.path.join(t_p_dir, file_name1), 'w')
+        f1.write('#time(ps)\t%s\tfit\n' % (Property_dict.get(property).get('property_unit')))
+
+        if name is not None:
+            file_name2 = Property_dict.get(property).get('abbr') + '-%s-stderr.txt' % (name)
+        else:
+            file_name2 = Property_dict.get(property).get('abbr') + '-stderr.txt'
+        f2 = open(os.path.join(t_p_dir, file_name2), 'w')
+        f2.write('#time(ps)\t%s_stderr\tfit\n' % (Property_dict.get(property).get('property_unit')))
+        for i in range(mean.size):
+            f1.write('%#.5e\t%#.5e\t%#.5e\n' % (t_list[i], mean[i], ExpConstval(t_list[i], c2)))
+            f2.write('%#.5e\t%#.5e\t%#.5e\n' % (t_list[i], stderr[i], np.exp(polyval(np.log(t_list[i]), c1))))
+        if return_stderr:
+            return c2[1], s2, float(np.exp(polyval(np.log(t_list[-1]), c1)))
+        return c2[1], s2
+    else:
+        f1 = open(os.path.join(t_p_dir, '%s.txt' % (Property_dict.get(property).get('abbr'))), 'w')
+        f1.write('#time(ps)\t%s\tfit\n' % (Property_dict.get(property).get('property_unit')))
+        f2 = open(os.path.join(t_p_dir, '%s_stderr.txt' % (Property_dict.get(property).get('abbr'))), 'w')
+        f2.write('#time(ps)\t%s_stderr\tfit\n' % (Property_dict.get(property).get('property_unit')))
+        for i in range(mean.size):
+            f1.write('%f\t%f\n' % (t_list[i], mean[i]))
+            f2.write('%f\t%f\n' % (t_list[i], stderr[i]))
+        return (0, 0, None) if return_stderr else (0, 0)
@@ -0,0 +1,461 @@
+import json
+import os
+import re
+import shlex
+import subprocess
+import time
+
+from config import Config
+
+
+def _is_finished(job) -> bool:
+    State = getattr(job, 'State', None)
+    if State is not None:
+        return job.state == State.DONE
+    return str(job.state).lower() in ('done', 'completed', 'c', 'cd')
+
+
+def parse_array_id(job_id):
+    '''
+    Parse the id of a job array element
+    Slurm: 1234_5, 1234_[0-7], 1234_[0-3,6]. Torque: 1234[5]
+    :return: (array_id, [index]), or (job_id, None) if it is not a job array
+    '''
+    job_id = str(job_id)
+    match = re.match(r'^(\d+)(?:_|\[)\[?([\d,\-%]+)\]?$', job_id)
+    if match is None:
+        return job_id, None
+    indexes = []
+    for word in match.group(2).split('%')[0].split(','):
+        if '-' in word:
+            start, end = word.split('-')
+            indexes += list(range(int(start), int(end) + 1))
+        elif word != '':
+            indexes.append(int(word))
+    return match.group(1), indexes
+
+
+def generate_array_sh(jobmanager, workdir, commands_list, name, sh, **kwargs):
+    '''
+    Generate one Slurm job array script. Element i of the array executes commands_list[i]
+    '''
+    commands = ['case $SLURM_ARRAY_TASK_ID in']
+    for i, cmds in enumerate(commands_list):
+        commands.append('%i)' % i)
+        commands += cmds
+        commands.append(';;')
+    commands.append('esac')
+    jobmanager.generate_sh(workdir, commands, name=name, sh=sh, **kwargs)
+
+    # insert the array directive after the last #SBATCH line
+    with open(sh) as f:
+        lines = f.read().splitlines()
+    n = 0
+    for i, line in enumerate(lines):
+        if line.startswith('#SBATCH') or line.startswith('#LOCAL'):
+            n = i
+    lines.insert(n + 1, '#SBATCH --array=0-%i' % (len(commands_list) - 1))
+    with open(sh, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+SENTINEL_DIR = '_finished'
+SENTINEL_MARK = '# completion sentinel'
+INSITU_RESULT = 'result.json'
+
+
+def get_spool_dir(procedure) -> str:
+    '''
+    Directory where job scripts put the id of finished jobs, watched by the monitor of the procedure
+    '''
+    return os.path.join(Config.WORK_DIR, procedure, SENTINEL_DIR)
+
+
+def get_sentinel(job_dir, pbs_name, index=None) -> str:
+    '''
+    Completion sentinel written into a job directory by a PBS job, or by one element of a job array
+    '''
+    name = pbs_name if index is None else '%s.%i' % (pbs_name, index)
+    return os.path.join(job_dir, SENTINEL_DIR, name + '.json')
+
+
+def sentinel_commands(jobmanager, jobs, pbs_name, index=None, insitu=True) -> [str]:
+    '''
+    Shell commands run after the simulation commands of a job script exit
+    If Config.INSITU_ANALYSIS is set, the jobs are analyzed on the compute node in parallel, see run/analyze-job.py
+    A sentinel with the exit code of the simulation, wall time and host is written into each job directory,
+    then the job id is put into the spool directory of the procedure
+    No sentinel for remote job managers, because the job directories on the remote machine are not watched
+    The name of a PBS job is reused when a job is run again, so the sentinel left by a previous submission
+    is removed here, when the script is generated
+    :param jobs: [dict], generated by Job.get_script_spec()
+    :param insitu: set False if a job runs in several PBS jobs, whose results are not complete until all of them exit
+    '''
+    if not Config.JOB_SENTINEL or jobmanager.is_remote:
+        return []
+    for job in jobs:
+        try:
+            os.remove(get_sentinel(job['dir'], pbs_name, index))
+        except OSError:
+            pass
+    commands = ['_exit=$?']
+    if insitu and Config.INSITU_ANALYSIS:
+        script = os.path.join(Config.RUN_DIR, 'analyze-job.py')
+        for job in jobs:
+            commands.append('%s %s %s %s %i %s &' % (Config.INSITU_PYTHON, script, job['procedure'], job['dir'],
+                                                     job['cycle'], shlex.quote(json.dumps(job['analyze_kwargs']))))
+        commands.append('wait')
+    for job in jobs:
+        sentinel = get_sentinel(job['dir'], pbs_name, index)
+        spool_dir = get_spool_dir(job['procedure'])
+        commands.append('mkdir -p %s %s' % (os.path.dirname(sentinel), spool_dir))
+        commands.append('printf \'{"exit": %%d, "wall_time": %%d, "host": "%%s"}\\n\' $_exit $SECONDS $(hostname) > %s'
+                        % sentinel)
+        commands.append('touch %s' % os.path.join(spool_dir, str(job['id'])))
+    return commands
+
+
+def append_sentinel(sh, commands):
+    '''
+    Append sentinel commands to the end of a generated job script. A sentinel appended before is replaced
+    '''
+    if commands == []:
+        return
+    with open(sh) as f:
+        lines = f.read().splitlines()
+    if SENTINEL_MARK in lines:
+        lines = lines[:lines.index(SENTINEL_MARK)]
+    lines += [SENTINEL_MARK] + commands
+    with open(sh, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def early_stop_commands(commands, procedure, job_dirs) -> [str]:
+    '''
+    Wrap the production mdrun of a job script with the on-node convergence watcher, see run/early-stop.py
+    The watcher stops mdrun cleanly once all runs are converged. Afterwards, runs not converged are extended in place
+    The extension restarts the whole -multidir bundle with -cpi, with the watcher armed again for this segment
+    Converged runs are not extended. A run at nsteps exits at once, a run stopped by the watcher before nsteps
+    continues until the watcher stops the bundle or nsteps is reached
+    The exit code of the last mdrun is kept for the commands after it
+    Nothing is changed if the procedure is not in Config.EARLY_STOP, or the production mdrun is not found
+    '''
+    settings = Config.EARLY_STOP.get(procedure)
+    if settings is None:
+        return commands
+    for i, cmd in enumerate(commands):
+        if 'mdrun' in cmd and ' -rerun ' not in cmd and '-deffnm %s' % settings['name'] in cmd:
+            break
+    else:
+        return commands
+
+    script = '%s %s' % (Config.INSITU_PYTHON, os.path.join(Config.RUN_DIR, 'early-stop.py'))
+    args = '%s %s' % (procedure, ' '.join(job_dirs))
+    wrapped = [
+        '%s watch %s &' % (script, args),
+        '_early_stop=$!',
+        cmd,
+        '_md_exit=$?',
+        'kill $_early_stop 2>/dev/null',
+    ]
+    if settings.get('n_extend'):
+        wrapped += [
+            'for _i in $(seq %i); do' % settings['n_extend'],
+            '[ $_md_exit -eq 0 ] && %s extend %s || break' % (script, args),
+            '%s watch %s &' % (script, args),
+            '_early_stop=$!',
+            '%s -cpi %s.cpt' % (cmd, settings['name']),
+            '_md_exit=$?',
+            'kill $_early_stop 2>/dev/null',
+            'done',
+        ]
+    wrapped.append('[ $_md_exit -eq 0 ]')
+    return commands[:i] + wrapped + commands[i + 1:]
+
+
+def split_cpu_commands(commands) -> ([str], [str]):
+    '''
+    Split the commands of a job into the GPU stage and the CPU-only stage after MD, e.g. the hvap rerun of npt
+    The CPU stage starts after the last mdrun before the first rerun
+    :return: gpu_commands, cpu_commands. cpu_commands is empty if there is no rerun
+    '''
+    for i, cmd in enumerate(commands):
+        if ' -rerun ' in cmd:
+            break
+    else:
+        return commands, []
+    start = i
+    while start > 0 and 'mdrun' not in commands[start - 1]:
+        start -= 1
+    return commands[:start], commands[start:]
+
+
+def cpu_stage_commands(job_dirs, cpu_commands, gmx_mdrun, cpu_gmx_mdrun) -> [str]:
+    '''
+    Commands of the CPU stage for jobs of a -multidir bundle. The jobs are run one by one with all cores
+    :param gmx_mdrun: mdrun of the GPU build, GMX_MDRUN of the config. It is replaced by cpu_gmx_mdrun
+    :param cpu_gmx_mdrun: mdrun of the CPU build, CPU_GMX_MDRUN of the config
+    '''
+    commands = []
+    for job_dir in job_dirs:
+        commands.append('cd %s' % job_dir)
+        for cmd in cpu_commands:
+            if cmd.startswith(gmx_mdrun):
+                cmd = cpu_gmx_mdrun + cmd[len(gmx_mdrun):]
+            commands.append(cmd)
+    return commands
+
+
+def gpu_stage_commands(jobmanager, jm_cpu, jobs, pbs_name, cpu_sh) -> [str]:
+    '''
+    Commands at the end of the GPU stage. The sentinel of the GPU stage is written,
+    then the CPU stage is submitted with afterok dependency on this job, only if the GPU stage succeeded
+    So the GPU allocation ends as soon as MD finishes, and the CPU stage never waits for a failed GPU stage
+    '''
+    commands = sentinel_commands(jobmanager, jobs, pbs_name, insitu=False) or ['_exit=$?']
+    submit_cmd = getattr(jm_cpu, 'submit_cmd', 'sbatch')
+    commands.append('if [ $_exit -eq 0 ]; then %s --dependency=afterok:$SLURM_JOB_ID %s; fi' % (submit_cmd, cpu_sh))
+    return commands
+
+
+class SchedulerSnapshot:
+    '''
+    One bulk query (squeue or qstat) of a job manager, parsed into a dict {name: state}
+    PbsJob, Job and Task read the running state from this dict instead of asking the job manager for every job
+    The snapshot is refreshed when it is older than `ttl` seconds, or at the next read after a job is submitted
+    '''
+
+    def __init__(self, jobmanager, ttl=300):
+        self.jm = jobmanager
+        self.ttl = ttl
+        self.states = {}
+        self.finished = {}
+        self.arrays = {}  # {name: [array_id, {index: state}, {index: finished}]}
+        self.time = None
+
+    def __repr__(self):
+        return '<SchedulerSnapshot: %i jobs>' % len(self.states)
+
+    @property
+    def expired(self) -> bool:
+        return self.time is None or time.time() - self.time > self.ttl
+
+    def invalidate(self):
+        # the queue has changed, e.g. a job is submitted. The next read queries the job manager again
+        self.time = None
+
+    def refresh(self):
+        # update_stored_jobs() calls squeue/qstat only once
+        self.jm.update_stored_jobs()
+        states = {}
+        finished = {}
+        arrays = {}
+        for job in self.jm.stored_jobs:
+            array_id, indexes = parse_array_id(job.id)
+            if indexes is not None:
+                array = arrays.setdefault(job.name, [array_id, {}, {}])
+                if array[0] == array_id:
+                    for index in indexes:
+                        array[1][index] = job.state
+                        array[2][index] = _is_finished(job)
+            # jobs with same name, keep the one which is still in queue
+            if job.name in states and not finished[job.name]:
+                continue
+            states[job.name] = job.state
+            finished[job.name] = _is_finished(job)
+        self.states = states
+        self.finished = finished
+        self.arrays = arrays
+        self.time = time.time()
+
+    def get_state(self, name):
+        if self.expired:
+            self.refresh()
+        return self.states.get(name)
+
+    def get_array(self, name):
+        '''
+        :return: (array_id, {index: state}), or (None, {}) if the job array is not in queue
+        '''
+        if self.expired:
+            self.refresh()
+        array = self.arrays.get(name)
+        if array is None:
+            return None, {}
+        return array[0], array[1]
+
+    def is_running(self, name, indexes=None) -> bool:
+        '''
+        If the pbs job missing, return False
+        If the pbs job has finished, return False
+        Otherwise, return True
+        :param indexes: for a job array, only check these elements
+        '''
+        if self.expired:
+            self.refresh()
+        if name not in self.states:
+            return False
+        if indexes is not None and name in self.arrays:
+            finished = self.arrays[name][2]
+            for index in indexes:
+                if index in finished and not finished[index]:
+                    return True
+            return False
+        return not self.finished[name]
+
+
+_snapshots = {}
+
+
+def get_snapshot(jobmanager, refresh=False) -> SchedulerSnapshot:
+    '''
+    Get the snapshot of a job manager. One snapshot per job manager per process
+    :param refresh: query the job manager now. Use it before deciding whether to submit jobs,
+                    a snapshot up to PBS_SNAPSHOT_TTL old may miss jobs submitted or finished since then
+    '''
+    snapshot = _snapshots.get(id(jobmanager))
+    if snapshot is None:
+        snapshot = SchedulerSnapshot(jobmanager, ttl=getattr(Config, 'PBS_SNAPSHOT_TTL', 300))
+        _snapshots[id(jobmanager)] = snapshot
+    if refresh:
+        snapshot.refresh()
+    return snapshot
+
+
+class LocalPbsJob:
+    class State:
+        NONE = 0
+        PENDING = 1
+        RUNNING = 2
+        DONE = 9
+
+    def __init__(self, id, name, state, workdir=None):
+        self.id = id
+        self.name = name
+        self.state = state
+        self.workdir = workdir
+
+    def __repr__(self):
+        return '<LocalPbsJob: %s %s %s>' % (self.id, self.name, self.state)
+
+
+class LocalJobManager:
+    '''
+    A fake job manager running on local machine, for testing and benchmarking the monitor without a cluster
+    If run is False, submitted jobs are not executed. Their states are controlled by set_state()
+    latency is the time (seconds) of each query, to mimic squeue or qstat on a busy cluster
+    '''
+
+    def __init__(self, queue='local', nprocs=1, ngpu=0, nprocs_request=None, env_cmd=None, run=True, latency=0.):
+        self.queue = queue
+        self.nprocs = nprocs
+        self.ngpu = ngpu
+        self.nprocs_request = nprocs_request or nprocs
+        self.env_cmd = env_cmd or ''
+        self.run = run
+        self.latency = latency
+        self.sh = '_job_local.sh'
+        self.submit_cmd = 'bash'
+        self.time = 240
+        self.is_remote = False
+        self.stored_jobs = []
+        self.n_query = 0
+        self._jobs = {}  # {id: [name, sh, Popen or state]}
+        self._id = 0
+
+    def __repr__(self):
+        return '<LocalJobManager: %i jobs>' % len(self._jobs)
+
+    def is_working(self) -> bool:
+        return True
+
+    def generate_sh(self, workdir, commands, name, sh=None, **kwargs):
+        if sh is None:
+            sh = os.path.join(workdir, self.sh)
+        with open(sh, 'w') as f:
+            f.write('#!/bin/bash\n'
+                    '#LOCAL --job-name=%s\n'
+                    '%s\n\n'
+                    'cd %s\n' % (name, self.env_cmd, workdir))
+            for cmd in commands:
+                f.write(cmd + '\n')
+
+    @staticmethod
+    def _get_name_array(sh):
+        name = os.path.basename(sh)
+        array = None
+        with open(sh) as f:
+            for line in f:
+                if line.startswith('#LOCAL --job-name='):
+                    name = line.strip().split('=', 1)[1]
+                elif line.startswith('#SBATCH --array=0-'):
+                    array = int(line.strip().split('-')[-1]) + 1
+        return name, array
+
+    def submit(self, sh=None, **kwargs) -> bool:
+        sh = sh or self.sh
+        if not os.path.exists(sh):
+            return False
+        self._id += 1
+        name, array = self._get_name_array(sh)
+        indexes = [None] if array is None else list(range(array))
+        for index in indexes:
+            if self.run:
+                env = dict(os.environ)
+                if index is not None:
+                    env['SLURM_ARRAY_TASK_ID'] = str(index)
+                proc = subprocess.Popen([self.submit_cmd, sh], cwd=os.path.dirname(os.path.abspath(sh)), env=env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            else:
+                proc = LocalPbsJob.State.PENDING
+            id = str(self._id) if index is None else '%i_%i' % (self._id, index)
+            self._jobs[id] = [name, sh, proc]
+        return True
+
+    def set_state(self, name, state):
+        for job in self._jobs.values():
+            if job[0] == name and not isinstance(job[2], subprocess.Popen):
+                job[2] = state
+
+    def kill_job(self, name) -> bool:
+        for job in self._jobs.values():
+            if job[0] != name:
+                continue
+            if isinstance(job[2], subprocess.Popen):
+                job[2].kill()
+            else:
+                job[2] = LocalPbsJob.State.DONE
+        return True
+
+    def get_all_jobs(self) -> [LocalPbsJob]:
+        self.n_query += 1
+        time.sleep(self.latency)
+        jobs = []
+        for id, (name, sh, proc) in self._jobs.items():
+            if isinstance(proc, subprocess.Popen):
+                state = LocalPbsJob.State.RUNNING if proc.poll() is None else LocalPbsJob.State.DONE
+            else:
+                state = proc
+            jobs.append(LocalPbsJob(id, name, state, workdir=os.path.dirname(sh)))
+        return jobs
+
+    def update_stored_jobs(self):
+        # latest job first, in case jobs with same name
+        self.stored_jobs = self.get_all_jobs()[::-1]
+
+    def get_job_from_name(self, name):
+        # one query per call, like mstools job managers without stored jobs
+        for job in self.get_all_jobs()[::-1]:
+            if job.name == name:
+                return job
+        return None
+
+    def is_running(self, name) -> bool:
+        job = self.get_job_from_name(name)
+        if job is None:
+            return False
+        return job.state != LocalPbsJob.State.DONE
+
+    @property
+    def n_running_jobs(self) -> int:
+        return len([job for job in self.stored_jobs if job.state != LocalPbsJob.State.DONE])
@@ -18,12 +18,13 @@ class StatAction():
             # 'Tc85': [],
         }
 
+        smiles_task_id = Task.get_task_ids(smiles_list, procedure=None)
         for smiles in smiles_list:
             nist = NistMolecule.query.filter(NistMolecule.smiles == smiles).first()
             if nist is None:
                 continue
 
-            task = Task.query.filter(Task.smiles_list == json.dumps([smiles])).first()
+            task = Task.query.get(smiles_task_id[smiles]) if smiles in smiles_task_id else None
             if task is None or task.post_result is None:
                 continue
 
@@ -57,7 +58,7 @@ class StatAction():
             if nist is None:
                 continue
 
-            slab = Task.query.filter(Task.smiles_list == json.dumps([smiles])).first()
+            slab = Task.query.filter(Task.smiles_hash == get_smiles_hash([smiles])).filter(Task.n_components == 1).first()
             if slab is None or slab.post_result is None:
                 continue
 
@@ -404,7 +405,8 @@ class VleAction():
         import numpy as np
 
         self.nist = NistMolecule.query.filter(NistMolecule.smiles == smiles).first()
-        slab = Task.query.filter(Task.smiles_list == json.dumps([smiles])).filter_by(procedure='nvt-slab').first()
+        slab = Task.query.filter(Task.smiles_hash == get_smiles_hash([smiles])).filter(Task.n_components == 1) \
+            .filter_by(procedure='nvt-slab').first()
         if self.nist is None or slab is None or slab.post_result is None:
             return False
 
@@ -0,0 +1,103 @@
+from sqlalchemy import inspect, text
+
+from . import db
+from . import models  # register the tables in db.metadata
+
+
+# filled once, right after the column is added, for rows whose value cannot be a column default
+BACKFILL = {
+    # tasks post-processed before post_dirty existed are up to date. NULL would mean never post-processed,
+    # and every finished task would be post-processed again at the first start of the monitor
+    ('task', 'post_dirty'): "UPDATE task SET post_dirty = '[]' WHERE post_result IS NOT NULL",
+}
+
+
+def _default_literal(column):
+    default = column.default
+    if default is None or not default.is_scalar:
+        return None
+    value = default.arg
+    if isinstance(value, bool):
+        return str(int(value))
+    elif isinstance(value, (int, float)):
+        return str(value)
+    elif isinstance(value, str):
+        return "'%s'" % value.replace("'", "''")
+    return None
+
+
+def get_tables(metadata=None, bind_key=None):
+    '''
+    Tables of the metadata which are stored in the database of bind_key. None is the default database
+    '''
+    metadata = metadata or db.metadata
+    return [table for table in metadata.sorted_tables if table.info.get('bind_key') == bind_key]
+
+
+def get_missing_columns(engine, metadata=None, bind_key=None) -> [str]:
+    '''
+    Tables and columns of the models which are not in the database, as "table" or "table.column"
+    Nothing is written, so it works on read-only engines
+    '''
+    tables = get_tables(metadata, bind_key)
+    inspector = inspect(engine)
+    exist_tables = inspector.get_table_names()
+    missing = []
+    for table in tables:
+        if table.name not in exist_tables:
+            missing.append(table.name)
+            continue
+        exist_columns = [column['name'] for column in inspector.get_columns(table.name)]
+        missing += ['%s.%s' % (table.name, column.name) for column in table.columns if column.name not in exist_columns]
+    return missing
+
+
+def migrate(engine, metadata=None, bind_key=None, indexes=True) -> [str]:
+    '''
+    Bring an existing database up to date with the models
+    Missing tables are created, missing columns are added by ALTER TABLE and missing indexes are created
+    Columns are never dropped or altered. Running it again on an up-to-date database changes nothing
+    Columns in BACKFILL are filled in the same transaction as they are added
+    :param indexes: create missing indexes. Set False to get a database without indexes, for benchmark
+    :return: list of the SQL executed
+    '''
+    tables = get_tables(metadata, bind_key)
+    inspector = inspect(engine)
+    exist_tables = inspector.get_table_names()
+    changes = []
+    for table in tables:
+        if table.name not in exist_tables:
+            table.create(bind=engine)
+            changes.append('CREATE TABLE %s' % table.name)
+            continue
+
+        exist_columns = [column['name'] for column in inspector.get_columns(table.name)]
+        for column in table.columns:
+            if column.name in exist_columns:
+                continue
+            sql = 'ALTER TABLE %s ADD COLUMN %s %s' % (
+                table.name, column.name, column.type.compile(dialect=engine.dialect))
+            default = _default_literal(column)
+            if default is not None:
+                sql += ' DEFAULT %s' % default
+                if not column.nullable:
+                    sql += ' NOT NULL'
+            with engine.begin() as conn:
+                conn.execute(text(sql))
+                changes.append(sql)
+                backfill = BACKFILL.get((table.name, column.name))
+                if backfill is not None:
+                    conn.execute(text(backfill))
+                    changes.append(backfill)
+
+        if not indexes:
+            continue
+        exist_indexes = [index['name'] for index in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name in exist_indexes:
+                continue
+            index.create(bind=engine)
+            changes.append('CREATE INDEX %s ON %s (%s)' % (
+                index.name, table.name, ', '.join(column.name for column in index.columns)))
+
+    return changes
@@ -1,3 +1,5 @@
+import copy
+import hashlib
 import json
 import re
 import shutil
@@ -5,14 +7,18 @@ import sys
 import time
 import traceback
 from datetime import datetime
-from functools import partial
+from functools import partial, lru_cache
 
-from sqlalchemy import Column, ForeignKey, Integer, Text, String, Boolean, DateTime, and_
+from sqlalchemy import Column, ForeignKey, Integer, Float, Text, String, Boolean, DateTime, and_, or_
+from sqlalchemy.orm import joinedload
 
 from flask import current_app
 
 from config import Config
 from . import db
+from .jobmanager import get_snapshot, generate_array_sh, get_sentinel, sentinel_commands, append_sentinel, \
+    split_cpu_commands, cpu_stage_commands, gpu_stage_commands, early_stop_commands
+from .cache import cycle_cached
 
 sys.path.append(Config.MS_TOOLS_DIR)
 from mstools.simulation.procedure import Procedure
@@ -25,23 +31,46 @@ import numpy as np, pandas as pd
 NotNullColumn = partial(Column, nullable=False)
 
 
-def init_simulation(procedure, extend=False, bugfix=False):
+@lru_cache(maxsize=None)
+def _canonical_smiles(smiles) -> str:
+    try:
+        return get_canonical_smiles(smiles)
+    except Exception:
+        return smiles
+
+
+SMILES_HASH_VERSION = 2  # increase it when the key of get_smiles_hash() changes, old hashes are refilled at startup
+
+
+def get_smiles_hash(smiles_list) -> str:
+    '''
+    Fingerprint of the molecules in a task: sha1 of the sorted canonical SMILES, prefixed with SMILES_HASH_VERSION
+    It does not depend on JSON formatting, order of components or the way SMILES is written
+    Tasks of the same molecules but different n_mol_ratio share the same hash
+    Components are joined with newline, which is not a SMILES character. Joined with '.', one multi-fragment
+    component (e.g. an ion pair) would have the same hash as its fragments as separate components
+    '''
+    key = '\n'.join(sorted(_canonical_smiles(smiles) for smiles in smiles_list))
+    return '%i:%s' % (SMILES_HASH_VERSION, hashlib.sha1(key.encode()).hexdigest())
+
+
+def _build_simulation(procedure, app, extend=False, bugfix=False):
     from mstools.simulation import gmx as simulationEngine
-    kwargs = {'packmol'   : current_app.packmol,
-              'dff'       : current_app.dff,
-              'gmx'       : current_app.gmx,
-              'jobmanager': current_app.jobmanager
+    kwargs = {'packmol'   : app.packmol,
+              'dff'       : app.dff,
+              'gmx'       : app.gmx,
+              'jobmanager': app.jobmanager
               }
     if extend:
         kwargs.update({
-            'gmx'       : current_app.gmx_extend,
-            'jobmanager': current_app.jm_extend
+            'gmx'       : app.gmx_extend,
+            'jobmanager': app.jm_extend
         })
     if bugfix:
         kwargs.update({
-            'gmx_bin'   : current_app.config['BUGFIX_GMX_BIN'],
-            'gmx_mdrun' : current_app.config['BUGFIX_GMX_MDRUN'],
-            'jobmanager': current_app.jm_bugfix
+            'gmx_bin'   : app.config['BUGFIX_GMX_BIN'],
+            'gmx_mdrun' : app.config['BUGFIX_GMX_MDRUN'],
+            'jobmanager': app.jm_bugfix
         })
 
     if procedure in ['npt', 'npt-multi', 'npt-v-rescale', 'npt-2', 'npt-3']:
@@ -59,39 +88,296 @@ def init_simulation(procedure, extend=False, bugfix=False):
     return sim
 
 
+_simulations = {}  # {(app, procedure, extend, bugfix): simulation engine}
+
+
+def init_simulation(procedure, extend=False, bugfix=False, app=None):
+    '''
+    Simulation engine of the procedure
+    Only one engine per app and (procedure, extend, bugfix) is built in a process. Each call returns a shallow copy of it,
+    with its own copy of list and dict attributes, so that callers do not see the state set by each other
+    :param app: object holding the tools set by Config.init_app(), for scripts without app. current_app if not set
+    '''
+    app = app or current_app._get_current_object()
+    key = (id(app), procedure, extend, bugfix)
+    template = _simulations.get(key)
+    if template is None:
+        template = _build_simulation(procedure, app, extend=extend, bugfix=bugfix)
+        _simulations[key] = template
+    sim = copy.copy(template)
+    for k, v in template.__dict__.items():
+        if isinstance(v, (list, dict, set)):
+            sim.__dict__[k] = copy.copy(v)
+    return sim
+
+
 def wrapper_cls_func(cls_func_args_kwargs):
     cls, func, args, kwargs = cls_func_args_kwargs
     func = getattr(cls, func)
     return func(*args, **kwargs)
 
 
+def build_model(procedure, smiles_list, n_mol_list=None, prior_n_mol_list=None):
+    '''
+    Build the simulation box of a task in current directory
+    This function does not touch the database, so it can be called in a worker process
+    :return: n_mol_list
+    '''
+    sim = init_simulation(procedure)
+    if n_mol_list is None:
+        if procedure in ['npt', 'npt-multi', 'npt-v-rescale']:
+            sim.set_system(smiles_list, n_atoms=Config.NATOMS, n_mols=Config.NMOLS)
+            sim.build(ppf=Config.PPF)
+            return sim.n_mol_list
+        elif procedure == 'nvt-slab':
+            sim.set_system(smiles_list)
+            sim.build(ppf=Config.PPF)
+            return sim.n_mol_list
+
+        if prior_n_mol_list is None:
+            raise Exception('Prior task of procedure=%s need to be built first' % (procedure))
+        if procedure == 'ppm':
+            return (np.array(prior_n_mol_list) * 2).tolist()
+        elif procedure in ['nvt-multi', 'nvt-multi-2', 'nvt-multi-3']:
+            return prior_n_mol_list
+        elif procedure in ['npt-2', 'npt-3']:
+            n_mol_list = (np.array(prior_n_mol_list) * int(procedure[-1])).tolist()
+            sim.set_system(smiles_list, n_mol_list=n_mol_list)
+            sim.build(ppf=Config.PPF)
+            return n_mol_list
+    else:
+        if procedure == 'npt':
+            sim.set_system(smiles_list, n_mol_list=n_mol_list)
+            sim.build(ppf=Config.PPF)
+            return n_mol_list
+        else:
+            raise Exception('for procedure=%s, n_mol_list cannot assigned' % (procedure))
+
+
+def prepare_job(procedure, job_dir, T, P, jobname, repeat_id, prior_job_dir=None):
+    '''
+    Prepare the input files of a job in job_dir
+    This function does not touch the database, so it can be called in a worker process
+    :return: commands of the job
+    '''
+    cd_or_create_and_cd(job_dir)
+    sim = init_simulation(procedure)
+
+    # Using Temperature dependent parameters or not
+    if Config.DFF_TABLE == 'IL':
+        T_basic = 350
+        drde = True
+    elif Config.DFF_TABLE == 'MGI':
+        T_basic = 298
+        drde = True
+    else:
+        return
+    # prepare
+    if procedure in ['npt', 'npt-2', 'npt-3']:
+        commands = sim.prepare(model_dir='../../build', T=T, P=P, jobname=jobname,
+                               drde=drde, T_basic=T_basic)
+    elif procedure == 'npt-v-rescale':
+        commands = sim.prepare(model_dir='../../build', T=T, P=P, jobname=jobname,
+                               dt=0.001, nst_trr=50, tcoupl='v-rescale', drde=drde,
+                               acf=True, mstools_dir=Config.MS_TOOLS_DIR)
+    elif procedure == 'npt-multi':
+        commands = sim.prepare(model_dir='../../build', T=T, P=P, jobname=jobname, dt=0.001,
+                               nst_trr=50, nst_edr=5, tcoupl='v-rescale', drde=drde, random_seed=repeat_id,
+                               acf=True, diff_gk=Config.DIFF_GK, mstools_dir=Config.MS_TOOLS_DIR)
+    elif procedure in ['nvt-multi', 'nvt-multi-2', 'nvt-multi-3']:
+        commands = sim.prepare(prior_job_dir=prior_job_dir, T=T, jobname=jobname, gro='npt.gro',
+                               tcoupl='v-rescale', random_seed=repeat_id, nst_run=int(2E6),
+                               acf=True, diff_gk=Config.DIFF_GK, mstools_dir=Config.MS_TOOLS_DIR)
+    elif procedure == 'ppm':
+        commands = sim.prepare(prior_job_dir=prior_job_dir, T=T, P=P, jobname=jobname,
+                               gro='npt.gro', replicate=(1, 1, 2), random_seed=repeat_id)
+    elif procedure == 'nvt-slab':
+        commands = sim.prepare(model_dir='../../build', T=T, jobname=jobname,
+                               drde=drde)
+    else:
+        return
+    # Using LJ 9-6 potential
+    if Config.LJ96:
+        sim.gmx._LJ96 = True
+        if procedure in ['npt', 'npt-2', 'npt-3', 'npt-v-rescale', 'npt-multi']:
+            sim.gmx.modify_lj96(['topol.itp'],
+                                ['topol.top', 'topol-hvap.top'],
+                                ['grompp-em.mdp', 'grompp-anneal.mdp', 'grompp-eq.mdp', 'grompp-npt.mdp',
+                                 'grompp-hvap.mdp'],
+                                ['em.xvg', 'anneal.xvg', 'eq.xvg', 'npt.xvg', 'hvap.xvg'])
+        elif procedure in ['nvt-multi', 'nvt-multi-2', 'nvt-multi-3']:
+            sim.gmx.modify_lj96([], [], ['grompp-eq.mdp', 'grompp-nvt.mdp'], ['eq.xvg', 'nvt.xvg'])
+        elif procedure == 'ppm':
+            mdp_list = ['grompp-eq-%.3f.mdp' % (a) for a in sim.amplitudes_steps.keys()] \
+                       + ['grompp-ppm-%.3f.mdp' % (a) for a in sim.amplitudes_steps.keys()]
+            xvg_list = ['eq-%.3f.xvg' % (a) for a in sim.amplitudes_steps.keys()] \
+                       + ['ppm-%.3f.xvg' % (a) for a in sim.amplitudes_steps.keys()]
+            sim.gmx.modify_lj96([], [], mdp_list, xvg_list)
+
+    # all jobs under one task share same commands, save this for GMX -multidir simulation
+    return commands
+
+
+def analyze_job(job_dir, procedure, n_mol_list=None, charge_list=None, sim=None, **kwargs):
+    '''
+    Analyze a finished job in job_dir
+    This function does not touch the database, so it can be called in a worker process
+    :param sim: simulation engine of the procedure. Built by init_simulation() if not set, which requires an app
+    :return: dict of the attributes of Job to be updated. status is always returned.
+             converged and result are returned only if the analysis succeeded
+    '''
+    os.chdir(job_dir)
+    sim = sim or init_simulation(procedure)
+    try:
+        if procedure in ['npt-multi', 'nvt-multi', 'nvt-multi-2', 'nvt-multi-3']:
+            current = charge_list is not None and set(charge_list) != {0}
+            result = sim.analyze_acf(mstools_dir=Config.MS_TOOLS_DIR, n_mol_list=n_mol_list,
+                                     charge_list=charge_list, current=current,
+                                     delete_trr=not Config.DEBUG, diff_gk=Config.DIFF_GK)
+        else:
+            result = sim.analyze(**kwargs)
+    except Exception as e:
+        # One kine of fail -- simulation fail
+        return {
+            'exception': repr(e),
+            'status'   : Compute.Status.FAILED,
+        }
+
+    if procedure == 'ppm':
+        from collections import Counter
+        if Counter(result.get('failed'))[True] <= 2 or result.get('failed') == [False, False, False, True, True, True]:
+            if result.get('converged'):
+                # simulation converged and normally ended
+                _status = Compute.Status.ANALYZED
+                _converged = True
+                # Clean intermediate files if converged
+                sim.clean()
+            else:
+                # simulation not converged, need to extend simulation
+                _status = Compute.Status.ANALYZED
+                _converged = False
+        else:
+            # simulation failed, cannot extend
+            _status = Compute.Status.FAILED
+            _converged = False
+    else:
+        if not result.get('failed')[0]:
+            if not result.get('continue')[0]:
+                # simulation converged and normally ended
+                if procedure == 'npt-v-rescale':
+                    result.update(sim.analyze_diff(n_mol_list=n_mol_list, charge_list=charge_list))
+                _status = Compute.Status.ANALYZED
+                _converged = True
+                # Clean intermediate files if converged
+                sim.clean()
+                if procedure in ['npt-multi', 'nvt-multi', 'nvt-multi-2', 'nvt-multi-3']:
+                    # parse the time series for post-processing here in the worker. The cache is optional
+                    from .gk import cache_job_series
+                    try:
+                        cache_job_series(job_dir, result, current=current, diff_gk=Config.DIFF_GK)
+                    except Exception:
+                        print('Failed to cache time series of %s' % job_dir)
+                        traceback.print_exc()
+            else:
+                # simulation not converged, need to extend simulation
+                _status = Compute.Status.ANALYZED
+                _converged = False
+        else:
+            # simulation failed, cannot extend
+            _status = Compute.Status.FAILED
+            _converged = False
+
+    return {
+        'exception': None,
+        'status'   : _status,
+        'converged': _converged,
+        'result'   : json.dumps(result),
+    }
+
+
 class PbsJob(db.Model):
     '''
     A PbsJob record corresponds to a PBS Job submitted to queue system like Slurm and Torque
     '''
     __tablename__ = 'pbs_job'
+    __table_args__ = (
+        db.Index('ix_pbs_job_submitted', 'submitted'),
+    )
     id = NotNullColumn(Integer, primary_key=True)
     name = NotNullColumn(String(200))
     sh_file = NotNullColumn(Text)
     extend = NotNullColumn(Boolean, default=False)
     submitted = NotNullColumn(Boolean, default=False)
     bugfix = NotNullColumn(Boolean, default=False)
+    # CPU stage after MD. It is submitted by the GPU stage, never by the monitor, so submitted is always False
+    # Its running state is read from the scheduler snapshot by name, the same as other PBS jobs
+    cpu = NotNullColumn(Boolean, default=False)
+    # job array
+    array_id = Column(String(200), nullable=True)
+    array_jobs = Column(Text, nullable=True)  # {job_id: [index]}
+    array_state = Column(Text, nullable=True)  # {index: state}
 
     def __repr__(self):
         return '<PbsJob: %i: %s %s>' % (self.id, self.name, self.submitted)
 
+    @property
+    def is_array(self) -> bool:
+        return self.array_jobs is not None
+
+    def get_array_indexes(self, job_id):
+        '''
+        :return: elements of the job array which run the job, or None if this is not a job array
+        '''
+        if not self.is_array:
+            return None
+        return json.loads(self.array_jobs).get(str(job_id), [])
+
+    def update_array_state(self):
+        '''
+        Save the array id and the state of each element from the scheduler snapshot. Commit is left to the caller
+        An empty array_state means the job array has left the queue, and it is not updated any more
+        '''
+        array_id, states = get_snapshot(self.jm).get_array(self.name)
+        if array_id is not None:
+            self.array_id = array_id
+            self.array_state = json.dumps({index: str(state) for index, state in states.items()})
+        elif self.array_id is not None or self.is_array_done():
+            # the job array has left the queue, or finished before any snapshot saw it
+            self.array_state = json.dumps({})
+
+    def is_array_done(self) -> bool:
+        '''
+        Check if all elements of a job array are done, without the job manager
+        An element is done if its jobs are not STARTED, are run by other PBS jobs, or have written their sentinels
+        '''
+        job_indexes = json.loads(self.array_jobs)
+        job_ids = [int(job_id) for job_id in job_indexes.keys()]
+        for i in range(0, len(job_ids), 500):
+            for job in Job.query.filter(Job.id.in_(job_ids[i:i + 500])):
+                if job.status != Compute.Status.STARTED or self.id not in json.loads(job.pbs_jobs_id or '[]'):
+                    continue
+                if not Config.JOB_SENTINEL:
+                    return False
+                for index in job_indexes[str(job.id)]:
+                    if not os.path.exists(get_sentinel(job.dir, self.name, index)):
+                        return False
+        return True
+
     @property
     def jm(self):
         if self.extend:
             return current_app.jm_extend
         elif self.bugfix:
             return current_app.jm_bugfix
+        elif self.cpu:
+            return current_app.jm_cpu
         else:
             return current_app.jobmanager
 
     def submit(self, **kwargs):
         if self.jm.submit(self.sh_file, **kwargs):
             self.submitted = True
+            get_snapshot(self.jm).invalidate()
         else:
             self.submitted = False
             current_app.logger.warning('Submit PBS job failed %s' % self.sh_file)
@@ -101,14 +387,16 @@ class PbsJob(db.Model):
         if not self.jm.kill_job(self.name):
             current_app.logger.warning('Kill PBS job failed %s' % self.name)
 
-    def is_running(self):
+    def is_running(self, indexes=None):
         '''
         If the pbs job missing, return False
         If the pbs job has finished, return False
         Otherwise, return True
+        The state is read from the per-cycle snapshot of the job manager
+        :param indexes: for a job array, only check these elements
         :return:
         '''
-        return self.jm.is_running(self.name)
+        return get_snapshot(self.jm).is_running(self.name, indexes=indexes)
 
 
 class Compute(db.Model):
@@ -146,8 +434,16 @@ class Compute(db.Model):
 
             prior_procedure = Procedure.prior.get(procedure)
 
+            # existing tasks of the procedure and the prior procedure, in one query
+            # {(procedure, smiles_hash, n_mol_ratio): [task]}
+            exist_tasks = {}
+            for task in Task.query.filter(Task.procedure.in_([procedure, prior_procedure])):
+                exist_tasks.setdefault((task.procedure, task.get_smiles_hash(), task.n_mol_ratio), []).append(task)
+
             N = 0
             M = 0
+            mappings = []
+            created_keys = set()
             for combination in combinations:
                 # check for smiles and name
                 smiles_list = combination['smiles']
@@ -174,16 +470,16 @@ class Compute(db.Model):
 
                 # smiles_list = [get_canonical_smiles(smiles) for smiles in
                 # smiles_list]
-                tasks = Task.query.filter(Task.smiles_list == json.dumps(smiles_list)).filter(
-                    Task.procedure == procedure). \
-                    filter(Task.n_mol_ratio == json.dumps(n_mol_ratio))
+                smiles_hash = get_smiles_hash(smiles_list)
+                # the same combination appears again in this compute
+                if (smiles_hash, json.dumps(n_mol_ratio)) in created_keys:
+                    continue
+                tasks = exist_tasks.get((procedure, smiles_hash, json.dumps(n_mol_ratio)), [])
                 # get t p list from prior task
                 if prior_procedure is not None:
-                    prior_tasks = Task.query.filter(Task.smiles_list == json.dumps(smiles_list)).filter(
-                        Task.procedure == prior_procedure). \
-                        filter(Task.n_mol_ratio == json.dumps(n_mol_ratio))
-                    if prior_tasks.count() == 1:
-                        prior_task = prior_tasks.first()
+                    prior_tasks = exist_tasks.get((prior_procedure, smiles_hash, json.dumps(n_mol_ratio)), [])
+                    if len(prior_tasks) == 1:
+                        prior_task = prior_tasks[0]
                     else:
                         continue
                     if t_list == p_list == []:
@@ -197,8 +493,8 @@ class Compute(db.Model):
                             if p not in json.loads(prior_task.p_list):
                                 p_list.remove(p)
                 # alter exist task t p list
-                if tasks.count() == 1 and alter_task:
-                    task = tasks.first()
+                if len(tasks) == 1 and alter_task:
+                    task = tasks[0]
                     t_list_new = list(set(json.loads(task.t_list) + t_list))
                     t_list_new.sort()
                     p_list_new = list(set(json.loads(task.p_list) + p_list))
@@ -222,23 +518,27 @@ class Compute(db.Model):
                         db.session.commit()
                 # Ignore existed task
                 # add a new task
-                elif tasks.count() == 0 and create_task:
-                    task = Task()
-                    if Task.query.count() != 0:
-                        task.id = Task.query.order_by(Task.id)[-1].id + 1
-                    task.compute_id = self.id
-                    task.n_components = len(smiles_list)
-                    task.smiles_list = json.dumps(smiles_list)
-                    task.procedure = procedure
-                    task.t_list = json.dumps(t_list)
-                    task.p_list = json.dumps(p_list)
-                    task.n_mol_ratio = json.dumps(n_mol_ratio)
-                    if name_list is not None:
-                        task.name = '_'.join(name_list) + '_' + random_string(4)
-                    db.session.add(task)
-                    db.session.commit()
+                elif len(tasks) == 0 and create_task:
+                    # id is assigned by database autoincrement
+                    mapping = {
+                        'compute_id'  : self.id,
+                        'n_components': len(smiles_list),
+                        'smiles_list' : json.dumps(smiles_list),
+                        'smiles_hash' : smiles_hash,
+                        'procedure'   : procedure,
+                        't_list'      : json.dumps(t_list),
+                        'p_list'      : json.dumps(p_list),
+                        'n_mol_ratio' : json.dumps(n_mol_ratio),
+                        'name'        : '_'.join(name_list) + '_' + random_string(4) if name_list is not None
+                        else random_string(),
+                        'stage'       : Compute.Stage.SUBMITTED,
+                        'status'      : Compute.Status.DONE,
+                    }
+                    mappings.append(mapping)
+                    created_keys.add((smiles_hash, mapping['n_mol_ratio']))
                     N += 1
 
+            db.session.bulk_insert_mappings(Task, mappings)
             db.session.commit()
             current_app.logger.info('%i tasks created, %i tasks altered, %s' % (N, M, self))
         except Exception as e:
@@ -278,10 +578,16 @@ class Task(db.Model):
     A Task record can produce a lots of Job records
     '''
     __tablename__ = 'task'
+    __table_args__ = (
+        db.Index('ix_task_procedure_stage_status', 'procedure', 'stage', 'status'),
+        db.Index('ix_task_smiles_list_procedure', 'smiles_list', 'procedure'),
+        db.Index('ix_task_smiles_hash_procedure', 'smiles_hash', 'procedure'),
+    )
     id = NotNullColumn(Integer, primary_key=True)
     compute_id = NotNullColumn(Integer, ForeignKey(Compute.id))
     n_components = NotNullColumn(Integer)
     smiles_list = NotNullColumn(Text)
+    smiles_hash = Column(String(50), nullable=True)  # get_smiles_hash(smiles_list)
     n_mol_list = Column(Text, nullable=True)
     procedure = NotNullColumn(String(200))
     t_list = Column(Text)
@@ -293,6 +599,8 @@ class Task(db.Model):
     commands = Column(Text, nullable=True)
     remark = Column(Text, nullable=True)
     post_result = Column(Text, nullable=True)
+    post_cache = Column(Text, nullable=True)  # {'t-p': [t, p, result]}, results of state points before fitting
+    post_dirty = Column(Text, nullable=True)  # [[t, p]] changed since last post-processing. None if never processed
     atom_type = Column(Text)
 
     compute = db.relationship(Compute)
@@ -302,6 +610,7 @@ class Task(db.Model):
         return '<Task: %i: %s %s %s>' % (self.id, self.procedure, self.name, self.smiles_list)
 
     @property
+    @cycle_cached
     def dir(self) -> str:
         return os.path.join(Config.WORK_DIR, self.procedure, self.name)
 
@@ -313,6 +622,7 @@ class Task(db.Model):
             return self.dir
 
     @property
+    @cycle_cached
     def prior_task(self):
         def is_subset(a, b):# if a is a subset of b, return True
             for x in a:
@@ -324,7 +634,9 @@ class Task(db.Model):
             return None
 
         # TODO Herein we suppose there is no duplicated task. Do not consider T and P
-        tasks = Task.query.filter(Task.smiles_list == self.smiles_list).filter(Task.procedure == prior_procedure)
+        # order of components must be the same, because n_mol_list of prior task is reused
+        tasks = Task.query.filter(Task.smiles_hash == self.get_smiles_hash()).filter(
+            Task.smiles_list == self.smiles_list).filter(Task.procedure == prior_procedure)
         for task in tasks:
             if is_subset(json.loads(self.t_list), json.loads(task.t_list)) and is_subset(json.loads(self.p_list), json.loads(task.p_list)):
                 return task
@@ -334,17 +646,39 @@ class Task(db.Model):
     def n_mol_total(self) -> int:
         return sum(json.loads(self.n_mol_list))
 
+    def get_n_mol_list(self):
+        if self.n_mol_list is None:
+            return None
+        else:
+            return json.loads(self.n_mol_list)
+
+    def get_prior_n_mol_list(self):
+        prior_task = self.prior_task
+        if prior_task is None:
+            return None
+        else:
+            return prior_task.get_n_mol_list()
+
+    @cycle_cached
     def get_charge_list(self):
         smiles_list = self.get_smiles_list()
-        charge_list = []
         if smiles_list == None:
             return None
-        else:
-            import pybel
-            for smiles in smiles_list:
-                mol = pybel.readstring('smi', smiles)
-                charge_list.append(mol.charge * Config.CHARGE_SCALE)
-        return charge_list
+        from .molecule import get_molecules
+        molecules = get_molecules(smiles_list)
+        return [molecules[smiles].charge * Config.CHARGE_SCALE for smiles in smiles_list]
+
+    def get_n_atoms(self, molecules=None) -> int:
+        '''
+        Number of atoms in the simulation box, including hydrogen. The atoms of each molecule are read from MoleculeCache
+        :param molecules: {smiles: MoleculeCache} from get_molecules(), for many tasks at once
+        '''
+        smiles_list = json.loads(self.smiles_list)
+        if molecules is None:
+            from .molecule import get_molecules
+            molecules = get_molecules(smiles_list)
+        return sum(molecules[smiles].get_n_atoms() * n_mol
+                   for smiles, n_mol in zip(smiles_list, json.loads(self.n_mol_list)))
 
     def get_smiles_list(self):
         if self.smiles_list is None:
@@ -360,21 +694,42 @@ class Task(db.Model):
         return name_list
 
     def get_LJ_atom_type(self):
+        '''
+        Set self.atom_type from ff.ppf. Nothing is done if it is already set
+        For single-component tasks, the atom types are shared with other tasks of the same molecule via MoleculeCache
+        '''
+        if self.atom_type is not None:
+            return
+        molecule = None
+        if self.n_components == 1:
+            from .molecule import update_molecule_cache, query_molecules
+            # the atom types are written into the cache, so the molecule must be in it
+            smiles = _canonical_smiles(self.get_smiles_list()[0])
+            update_molecule_cache([smiles], commit=False)
+            molecule = query_molecules([smiles])[smiles]
+            if molecule.lj_atom_type is not None:
+                self.atom_type = molecule.lj_atom_type
+                db.session.commit()
+                return
+
         if self.prior_task is None:
             ppf = os.path.join(self.dir, 'build', 'ff.ppf')
         else:
             ppf = os.path.join(self.prior_task.dir, 'build', 'ff.ppf')
         if os.path.exists(ppf):
             LJ_atom_type = []
-            for line in open(ppf, 'r').readlines():
-                if line.startswith('N12_6:'):
-                    atom_type = line.split()[1].split(':')[0]
-                    if atom_type not in LJ_atom_type:
-                        LJ_atom_type.append(atom_type)
-                    else:
-                        return
+            with open(ppf, 'r') as f:
+                for line in f:
+                    if line.startswith('N12_6:'):
+                        atom_type = line.split()[1].split(':')[0]
+                        if atom_type not in LJ_atom_type:
+                            LJ_atom_type.append(atom_type)
+                        else:
+                            return
             LJ_atom_type.sort()
             self.atom_type = json.dumps(LJ_atom_type)
+            if molecule is not None:
+                molecule.lj_atom_type = self.atom_type
             db.session.commit()
         else:
             return
@@ -392,18 +747,56 @@ class Task(db.Model):
         else:
             return json.loads(self.post_result)
 
+    @cycle_cached
     def get_t_list(self):
         return json.loads(self.t_list)
 
+    @cycle_cached
     def get_p_list(self):
         if self.p_list != '[]':
             return json.loads(self.p_list)
         else:
             return [None]
 
+    def get_smiles_hash(self) -> str:
+        if self.smiles_hash is None or not self.smiles_hash.startswith('%i:' % SMILES_HASH_VERSION):
+            self.smiles_hash = get_smiles_hash(json.loads(self.smiles_list))
+        return self.smiles_hash
+
     @classmethod
     def get_task(cls, smiles, procedure='npt'):
-        return Task.query.filter(Task.smiles_list == json.dumps([smiles])).filter(Task.procedure == procedure).first()
+        return Task.query.filter(Task.smiles_hash == get_smiles_hash([smiles])).filter(
+            Task.n_components == 1).filter(Task.procedure == procedure).first()
+
+    @classmethod
+    def get_task_ids(cls, smiles_lists, procedure='npt', batch=500) -> {object: int}:
+        '''
+        Map many SMILES lists to the id of their tasks with one indexed query per `batch` distinct hashes
+        Tasks are selected by smiles_hash, then checked against the exact smiles_list in the same order of components,
+        because the hash does not depend on the order
+        :param smiles_lists: [[smiles]], or [smiles] for single-component tasks
+        :param procedure: tasks of any procedure if None
+        :return: {smiles_list as tuple, or smiles: task_id}, the first task by id. Those without task are not in the dict
+        '''
+        hash_keys = {}
+        for item in smiles_lists:
+            key = item if isinstance(item, str) else tuple(item)
+            _list = [item] if isinstance(item, str) else list(item)
+            hash_keys.setdefault(get_smiles_hash(_list), {})[key] = [_canonical_smiles(smiles) for smiles in _list]
+        hashes = list(hash_keys.keys())
+        key_task_id = {}
+        # SQLite limits the number of variables in one query
+        for i in range(0, len(hashes), batch):
+            query = db.session.query(Task.id, Task.smiles_hash, Task.smiles_list) \
+                .filter(Task.smiles_hash.in_(hashes[i:i + batch]))
+            if procedure is not None:
+                query = query.filter(Task.procedure == procedure)
+            for task_id, smiles_hash, smiles_list in query.order_by(Task.id):
+                canonical_list = [_canonical_smiles(smiles) for smiles in json.loads(smiles_list)]
+                for key, _canonical_list in hash_keys[smiles_hash].items():
+                    if canonical_list == _canonical_list:
+                        key_task_id.setdefault(key, task_id)
+        return key_task_id
 
     def build(self):
         current_app.logger.info('Build %s' % self)
@@ -415,41 +808,10 @@ class Task(db.Model):
             self.status = Compute.Status.STARTED
             db.session.commit()
 
-            sim = init_simulation(self.procedure)
-            smiles_list = json.loads(self.smiles_list)
-            if self.n_mol_list is None:
-                if self.procedure in ['npt', 'npt-multi', 'npt-v-rescale']:
-                    sim.set_system(smiles_list, n_atoms=Config.NATOMS, n_mols=Config.NMOLS)
-                    sim.build(ppf=Config.PPF)
-                    self.n_mol_list = json.dumps(sim.n_mol_list)
-                elif self.procedure == 'nvt-slab':
-                    sim.set_system(smiles_list)
-                    sim.build(ppf=Config.PPF)
-                    self.n_mol_list = json.dumps(sim.n_mol_list)
-                elif self.procedure == 'ppm':
-                    n_mol_list = json.loads(self.prior_task.n_mol_list)
-                    n_mol_list = (np.array(n_mol_list) * 2).tolist()
-                    self.n_mol_list = json.dumps(n_mol_list)
-                elif self.procedure in ['nvt-multi', 'nvt-multi-2', 'nvt-multi-3']:
-                    self.n_mol_list = self.prior_task.n_mol_list
-                elif self.procedure == 'npt-2':
-                    n_mol_list = json.loads(self.prior_task.n_mol_list)
-                    n_mol_list = (np.array(n_mol_list) * 2).tolist()
-                    self.n_mol_list = json.dumps(n_mol_list)
-                    sim.set_system(smiles_list, n_mol_list=json.loads(self.n_mol_list))
-                    sim.build(ppf=Config.PPF)
-                elif self.procedure == 'npt-3':
-                    n_mol_list = json.loads(self.prior_task.n_mol_list)
-                    n_mol_list = (np.array(n_mol_list) * 3).tolist()
-                    self.n_mol_list = json.dumps(n_mol_list)
-                    sim.set_system(smiles_list, n_mol_list=json.loads(self.n_mol_list))
-                    sim.build(ppf=Config.PPF)
-            else:
-                if self.procedure == 'npt':
-                    sim.set_system(smiles_list, n_mol_list=json.loads(self.n_mol_list))
-                    sim.build(ppf=Config.PPF)
-                else:
-                    raise Exception('for procedure=%s, n_mol_list cannot assigned' % (self.procedure))
+            n_mol_list = build_model(self.procedure, json.loads(self.smiles_list),
+                                     n_mol_list=self.get_n_mol_list(), prior_n_mol_list=self.get_prior_n_mol_list())
+            if n_mol_list is not None:
+                self.n_mol_list = json.dumps(n_mol_list)
         except Exception as e:
             current_app.logger.error('Build task failed %s: %s' % (self, repr(e)))
             traceback.print_exc()
@@ -469,6 +831,76 @@ class Task(db.Model):
                 self.status = Compute.Status.DONE
             db.session.commit()
 
+    def get_build_spec(self):
+        '''
+        Prepare a task for building in a worker process
+        New jobs are not inserted here. Their rows are carried in the spec, and inserted by set_build_result()
+        only if the build succeeds
+        The returned dict contains only plain data, so that it can be sent to a worker process
+        :return: dict, or None if the task cannot be built now
+        '''
+        os.makedirs(os.path.join(self.dir, 'build'), exist_ok=True)
+        self.stage = Compute.Stage.BUILDING
+        self.status = Compute.Status.STARTED
+        mappings = self.get_job_mappings()
+        if mappings is None:
+            self.reset()
+            return None
+
+        # the first job of each state point of the prior task, as Job.prior_job
+        prior_jobs = {}
+        if self.prior_task is not None:
+            for prior_job in self.prior_task.jobs.order_by(Job.id):
+                prior_jobs.setdefault((prior_job.t, prior_job.p), prior_job)
+
+        jobs = []
+        for job in self.jobs.filter(Job.status == Compute.Status.STARTED):
+            jobs.append((job.dir, job.t, job.p, job.name, job.repeat_id))
+        for mapping in mappings:
+            if mapping['status'] == Compute.Status.STARTED:
+                t, p, repeat_id = mapping['t'], mapping['p'], mapping['repeat_id']
+                job_dir = os.path.join(self.dir, '%i-%i' % (t, p or 0), 'repeat-%i' % repeat_id)
+                jobs.append((job_dir, t, p, mapping['name'], repeat_id))
+        job_specs = []
+        for job_dir, t, p, name, repeat_id in jobs:
+            prior_job = prior_jobs.get((t, p))
+            if prior_job is not None and not prior_job.converged:
+                current_app.logger.warning('Prepare job %s Prior job not converged' % job_dir)
+                prior_job = None
+            job_specs.append({
+                'dir'          : job_dir,
+                't'            : t,
+                'p'            : p,
+                'name'         : name,
+                'repeat_id'    : repeat_id,
+                'prior_job_dir': None if prior_job is None else prior_job.dir,
+            })
+        return {
+            'task_id'         : self.id,
+            'dir'             : self.dir,
+            'procedure'       : self.procedure,
+            'smiles_list'     : json.loads(self.smiles_list),
+            'n_mol_list'      : self.get_n_mol_list(),
+            'prior_n_mol_list': self.get_prior_n_mol_list(),
+            'jobs'            : job_specs,
+            'job_mappings'    : mappings,
+        }
+
+    def set_build_result(self, result):
+        '''
+        Save the result returned by a build worker. Commit is left to the caller
+        '''
+        if result.get('exception') is not None:
+            current_app.logger.error('Build task failed %s: %s' % (self, result['exception']))
+            self.status = Compute.Status.FAILED
+            return
+        self.insert_job_mappings(result.get('job_mappings') or [])
+        if result.get('n_mol_list') is not None:
+            self.n_mol_list = json.dumps(result['n_mol_list'])
+        if result.get('commands') is not None:
+            self.commands = json.dumps(result['commands'])
+        self.status = Compute.Status.DONE
+
     def _rebuild(self):
         '''
         For debug
@@ -480,60 +912,109 @@ class Task(db.Model):
         sim.set_system(json.loads(self.smiles_list), n_mol_list=json.loads(self.n_mol_list))
         sim.build()
 
-    def insert_jobs(self):
+    def get_repeat_number(self) -> int:
+        '''
+        Number of repeats inserted for each state point at the beginning
+        With Config.ADAPTIVE_REPEAT, GK procedures start with one batch, and more are added by add_repeats()
+        '''
+        from .postprocess import GK_PROCEDURES
+        if Config.ADAPTIVE_REPEAT and self.procedure in GK_PROCEDURES:
+            return min(Config.REPEAT_BATCH, current_app.config['REPEAT_NUMBER'])
+        return current_app.config['REPEAT_NUMBER']
+
+    def insert_jobs(self, repeat_dict=None):
+        '''
+        Insert the jobs of all state points which are not in the database
+        :param repeat_dict: {(t, p): n_repeat}, number of repeats of the state points. Other state points are skipped
+                            By default, all state points have get_repeat_number() repeats
+        '''
         if not os.path.exists(os.path.join(self.dir, 'build')):
             raise Exception('Should build simulation box first')
 
+        mappings = self.get_job_mappings(repeat_dict=repeat_dict)
+        if mappings is None:
+            self.reset()
+            return
+        self.insert_job_mappings(mappings)
+        db.session.commit()
+
+    def get_job_mappings(self, repeat_dict=None):
+        '''
+        Rows of the jobs of all state points which are not in the database. Nothing is inserted here
+        :param repeat_dict: see insert_jobs()
+        :return: [dict] for insert_job_mappings(), or None if the prior task is not analyzed yet
+        '''
         if json.loads(self.p_list) == []:
             p_list = [None]
         else:
             p_list = json.loads(self.p_list)
-        if Job.query.count() != 0:
-            job_id = Job.query.order_by(Job.id)[-1].id + 1
-        else:
-            job_id = 1
+        # existing (t, p, repeat_id) of this task, in one query
+        exist_keys = set(db.session.query(Job.t, Job.p, Job.repeat_id).filter(Job.task_id == self.id))
+        new_keys = []
         for p in p_list:
             for t in json.loads(self.t_list):
-                for i in range(current_app.config['REPEAT_NUMBER']):
-                    if Job.query.filter(Job.task_id == self.id).filter(Job.t == t).filter(
-                            Job.p == p).filter(Job.repeat_id == i + 1).first() is not None:
-                        continue
-                    job = Job()
-                    job.id = job_id
-                    job_id += 1
-                    job.task_id = self.id
-                    job.t = t
-                    job.p = p
-                    job.repeat_id = i + 1
-                    job.name = '%s-%i-%i' % (self.name, t or 0, p or 0)
-                    prior_procedure = Procedure.prior.get(self.procedure)
-                    if prior_procedure != None:
-                        if self.prior_task == None or self.prior_task.status != Compute.Status.ANALYZED:
-                            self.reset()
-                            return
-                            # job.status = Compute.Status.FAILED
-                            # job.result = {'failed': True,
-                            # 'reason': 'prior %s job need to be done first' % (prior_procedure)}
-                        elif self.prior_task.jobs.filter(and_(Job.t == t, Job.p == p)).first() == None:
-                            job.status = Compute.Status.FAILED
-                            job.result = {'failed': True,
-                                          'reason': 'prior %s job need to be done first in condition t=%f p=%f' % (
-                                              prior_procedure, t, p)}
-                        elif not self.prior_task.jobs.filter(and_(Job.t == t, Job.p == p)).first().converged:
-                            job.status = Compute.Status.FAILED
-                            job.result = {'failed': True,
-                                          'reason': 'prior %s job do not converge in condition t=%f p=%f' % (
-                                              prior_procedure, t, p)}
-                    db.session.add(job)
-                    db.session.commit()
-
+                if repeat_dict is None:
+                    n_repeat = self.get_repeat_number()
+                else:
+                    n_repeat = repeat_dict.get((t, p), 0)
+                for i in range(n_repeat):
+                    if (t, p, i + 1) not in exist_keys:
+                        new_keys.append((t, p, i + 1))
+        if new_keys == []:
+            return []
 
-        db.session.commit()
+        prior_procedure = Procedure.prior.get(self.procedure)
+        prior_converged = {}  # {(t, p): converged}
+        if prior_procedure != None:
+            if self.prior_task == None or self.prior_task.status != Compute.Status.ANALYZED:
+                return None
+            for t, p, converged in db.session.query(Job.t, Job.p, Job.converged) \
+                    .filter(Job.task_id == self.prior_task.id).order_by(Job.id):
+                prior_converged.setdefault((t, p), converged)
+
+        # id is assigned by database autoincrement
+        mappings = []
+        for t, p, repeat_id in new_keys:
+            mapping = {
+                'task_id'  : self.id,
+                't'        : t,
+                'p'        : p,
+                'repeat_id': repeat_id,
+                'name'     : '%s-%i-%i' % (self.name, t or 0, p or 0),
+            }
+            if prior_procedure != None:
+                if (t, p) not in prior_converged:
+                    mapping['status'] = Compute.Status.FAILED
+                    mapping['result'] = json.dumps({'failed': True,
+                                                    'reason': 'prior %s job need to be done first in condition t=%f p=%f' % (
+                                                        prior_procedure, t, p)})
+                elif not prior_converged[(t, p)]:
+                    mapping['status'] = Compute.Status.FAILED
+                    mapping['result'] = json.dumps({'failed': True,
+                                                    'reason': 'prior %s job do not converge in condition t=%f p=%f' % (
+                                                        prior_procedure, t, p)})
+            mapping.setdefault('status', Compute.Status.STARTED)
+            mapping.setdefault('result', None)
+            mapping.update({'cycle': 0, 'converged': False, 'bugfix': False})
+            mappings.append(mapping)
+        return mappings
+
+    def insert_job_mappings(self, mappings):
+        '''
+        Insert the rows from get_job_mappings(). Commit is left to the caller
+        '''
+        if mappings == []:
+            return
+        # all rows have the same keys, so they are inserted with one executemany
+        now = datetime.now()
+        for mapping in mappings:
+            mapping['time'] = now
+        db.session.bulk_insert_mappings(Job, mappings)
 
     # this function is used to extend a task with more repeated jobs using different initial random number
     def check_task_jobs(self):
         current_app.logger.info('check %s' % self)
-        if self.jobs.count() != (current_app.config['REPEAT_NUMBER'] * len(self.get_t_list()) * len(self.get_p_list())) and self.jobs.count() != 0:
+        if self.jobs.count() < (self.get_repeat_number() * len(self.get_t_list()) * len(self.get_p_list())) and self.jobs.count() != 0:
             current_app.logger.info('add repeated jobs %s' % self)
             self.insert_jobs()
             for job in self.jobs:
@@ -543,6 +1024,48 @@ class Task(db.Model):
             self.status = Compute.Status.DONE
             db.session.commit()
 
+    def add_repeats(self) -> int:
+        '''
+        Adaptive repeats, see Config.ADAPTIVE_REPEAT. Called after post-processing, when all jobs are finished
+        Repeats are added to the state points whose fitted stderr does not reach Config.REPEAT_TARGET_STDERR
+        The task is set back to run the new jobs, and is post-processed again after they are analyzed
+        :return: number of jobs added
+        '''
+        from .postprocess import get_n_more_repeats
+        if self.post_cache is None:
+            return 0
+
+        n_repeat = {}  # {(t, p): largest repeat_id}
+        n_converged = {}  # {(t, p): number of converged jobs}
+        for t, p, repeat_id, converged in db.session.query(Job.t, Job.p, Job.repeat_id, Job.converged) \
+                .filter(Job.task_id == self.id):
+            n_repeat[(t, p)] = max(n_repeat.get((t, p), 0), repeat_id or 0)
+            if converged:
+                n_converged[(t, p)] = n_converged.get((t, p), 0) + 1
+        repeat_dict = {}
+        for t, p, result in json.loads(self.post_cache).values():
+            n_more = get_n_more_repeats(result, n_converged.get((t, p), 0), n_repeat.get((t, p), 0),
+                                        current_app.config['REPEAT_NUMBER'])
+            if n_more > 0:
+                repeat_dict[(t, p)] = n_repeat[(t, p)] + n_more
+        if repeat_dict == {}:
+            return 0
+
+        n_job = self.jobs.count()
+        self.insert_jobs(repeat_dict=repeat_dict)
+        n_added = self.jobs.count() - n_job
+        current_app.logger.info('Add %i repeated jobs %s' % (n_added, self))
+        for job in self.jobs.filter(Job.status == Compute.Status.STARTED).filter(Job.pbs_jobs_id == None):
+            if not os.path.exists(job.dir):
+                job.prepare()
+        self.stage = Compute.Stage.BUILDING
+        self.status = Compute.Status.DONE
+        # the task is post-processed again when the new jobs are analyzed
+        self.post_result = None
+        save_task_fits([self])
+        db.session.commit()
+        return n_added
+
     def get_exist_pbs_number(self):
         i = 0
         while os.path.exists(os.path.join(self.dir, '_job.run-%i.sh' % (i))):
@@ -591,14 +1114,21 @@ class Task(db.Model):
                     time.sleep(0.2)
             else:
                 # Generate sh for multi simulation based on self.commands
-                multi_dirs = [job.dir for job in jobs_to_run]
+                jobs_list = jobs_to_run.all()
+                multi_dirs = [job.dir for job in jobs_list]
                 multi_cmds = json.loads(self.commands)
+                cpu_cmds = []
+                if current_app.config.get('CPU_STAGE') and not current_app.config.get('GMX_MULTI_ARRAY'):
+                    multi_cmds, cpu_cmds = split_cpu_commands(multi_cmds)
 
                 sim = init_simulation(self.procedure)
                 commands_list = sim.gmx.generate_gpu_multidir_cmds(multi_dirs, multi_cmds,
                                                                    n_parallel=multi_njob,
                                                                    n_gpu=current_app.jobmanager.ngpu,
                                                                    n_omp=current_app.config['GMX_MULTI_NOMP'])
+                for i in range(len(commands_list)):
+                    commands_list[i] = early_stop_commands(commands_list[i], self.procedure,
+                                                           multi_dirs[i * multi_njob:(i + 1) * multi_njob])
                 njobs_command = []
                 n = len(multi_dirs)
                 while True:
@@ -609,41 +1139,98 @@ class Task(db.Model):
                         njobs_command.append(n + multi_njob)
                         break
 
-                n = self.get_exist_pbs_number()
-                for i, commands in enumerate(commands_list):
-                    # instead of run directly, we add a record to pbs_job
-                    sh = os.path.join(self.dir, '_job.run-%i.sh' % (i + n))
-                    pbs_name = '%s-run-%i' % (self.name, (i + n))
-
-                    if current_app.config['GMX_MULTI_NOMP'] is None:
-                        n_tasks = None
-                    else:
-                        n_tasks = current_app.config['GMX_MULTI_NJOB'] * current_app.config['GMX_MULTI_NOMP'] * \
-                                  current_app.jobmanager.nprocs_request / current_app.jobmanager.nprocs
+                if current_app.config['GMX_MULTI_NOMP'] is None:
+                    n_tasks = None
+                else:
+                    n_tasks = current_app.config['GMX_MULTI_NJOB'] * current_app.config['GMX_MULTI_NOMP'] * \
+                              current_app.jobmanager.nprocs_request / current_app.jobmanager.nprocs
 
+                def get_ngpu(njobs):
                     if current_app.config['PBS_ARGS'][0] != 'gtx':
-                        ngpu = None
-                    elif njobs_command[i] % 2 == 0:
-                        ngpu = 2
+                        return None
+                    elif njobs % 2 == 0:
+                        return 2
                     else:
-                        ngpu = 1
-                    current_app.jobmanager.generate_sh(self.dir, commands, name=pbs_name, sh=sh, n_tasks=n_tasks, ngpu=ngpu)
-
-                    pbs_job = PbsJob()
-                    pbs_job.name = pbs_name
-                    pbs_job.sh_file = sh
-                    db.session.add(pbs_job)
-                    db.session.flush()
-
-                    # save pbs_job_id for jobs
-                    # updated jobs will be removed from jobs_to_run
-                    for job in jobs_to_run[0: current_app.config['GMX_MULTI_NJOB']]:
-                        job.pbs_jobs_id = json.dumps([pbs_job.id])
-                    db.session.commit()
-
-                    # submit job, record if success or failed
-                    pbs_job.submit(remote_dir=self.remote_dir, local_dir=self.dir)
-                    time.sleep(0.2)
+                        return 1
+
+                n = self.get_exist_pbs_number()
+                if current_app.config.get('GMX_MULTI_ARRAY'):
+                    # bundles are submitted as job arrays, one array for each GPU count. All elements of an array
+                    # request the same resources, so a short last bundle may need its own array
+                    ngpu_groups = {}
+                    for i in range(len(commands_list)):
+                        ngpu_groups.setdefault(get_ngpu(njobs_command[i]), []).append(i)
+                    for k, (ngpu, indexes) in enumerate(ngpu_groups.items()):
+                        # element j of the array runs bundle indexes[j]
+                        sh = os.path.join(self.dir, '_job.run-%i.sh' % (n + k))
+                        pbs_name = '%s-run-%i' % (self.name, n + k)
+                        bundles = [jobs_list[i * multi_njob:(i + 1) * multi_njob] for i in indexes]
+                        array_commands_list = []
+                        for j, i in enumerate(indexes):
+                            array_commands_list.append(commands_list[i] + sentinel_commands(
+                                current_app.jobmanager, [job.get_script_spec() for job in bundles[j]], pbs_name,
+                                index=j))
+                        generate_array_sh(current_app.jobmanager, self.dir, array_commands_list, name=pbs_name,
+                                          sh=sh, n_tasks=n_tasks, ngpu=ngpu)
+
+                        pbs_job = PbsJob()
+                        pbs_job.name = pbs_name
+                        pbs_job.sh_file = sh
+                        db.session.add(pbs_job)
+                        db.session.flush()
+
+                        array_jobs = {}
+                        for j, bundle in enumerate(bundles):
+                            for job in bundle:
+                                job.pbs_jobs_id = json.dumps([pbs_job.id])
+                                array_jobs[str(job.id)] = [j]
+                        pbs_job.array_jobs = json.dumps(array_jobs)
+                        db.session.commit()
+
+                        pbs_job.submit(remote_dir=self.remote_dir, local_dir=self.dir)
+                else:
+                    for i, commands in enumerate(commands_list):
+                        # instead of run directly, we add a record to pbs_job
+                        sh = os.path.join(self.dir, '_job.run-%i.sh' % (i + n))
+                        pbs_name = '%s-run-%i' % (self.name, (i + n))
+                        bundle = jobs_list[i * multi_njob:(i + 1) * multi_njob]
+                        specs = [job.get_script_spec() for job in bundle]
+                        pbs_jobs_id = []
+                        if cpu_cmds != []:
+                            # the CPU stage is submitted by the GPU stage, with afterok dependency
+                            cpu_sh = os.path.join(self.dir, '_job.run-%i-cpu.sh' % (i + n))
+                            cpu_name = '%s-run-%i-cpu' % (self.name, (i + n))
+                            cpu_commands = cpu_stage_commands([job.dir for job in bundle], cpu_cmds,
+                                                              current_app.config['GMX_MDRUN'],
+                                                              current_app.config['CPU_GMX_MDRUN']) + \
+                                           sentinel_commands(current_app.jm_cpu, specs, cpu_name)
+                            current_app.jm_cpu.generate_sh(self.dir, cpu_commands, name=cpu_name, sh=cpu_sh)
+                            cpu_pbs_job = PbsJob(name=cpu_name, sh_file=cpu_sh, cpu=True)
+                            db.session.add(cpu_pbs_job)
+                            db.session.flush()
+                            pbs_jobs_id.append(cpu_pbs_job.id)
+                            commands = commands + gpu_stage_commands(current_app.jobmanager, current_app.jm_cpu,
+                                                                     specs, pbs_name, cpu_sh)
+                        else:
+                            commands = commands + sentinel_commands(current_app.jobmanager, specs, pbs_name)
+                        current_app.jobmanager.generate_sh(self.dir, commands, name=pbs_name, sh=sh, n_tasks=n_tasks,
+                                                           ngpu=get_ngpu(njobs_command[i]))
+
+                        pbs_job = PbsJob()
+                        pbs_job.name = pbs_name
+                        pbs_job.sh_file = sh
+                        db.session.add(pbs_job)
+                        db.session.flush()
+
+                        # save pbs_job_id for jobs
+                        # updated jobs will be removed from jobs_to_run
+                        for job in jobs_to_run[0: current_app.config['GMX_MULTI_NJOB']]:
+                            job.pbs_jobs_id = json.dumps([pbs_job.id] + pbs_jobs_id)
+                        db.session.commit()
+
+                        # submit job, record if success or failed
+                        pbs_job.submit(remote_dir=self.remote_dir, local_dir=self.dir)
+                        time.sleep(0.2)
 
         except Exception as e:
             current_app.logger.error('Run task failed %s %s' % (self, repr(e)))
@@ -656,47 +1243,50 @@ class Task(db.Model):
             db.session.commit()
             return n_pbs_run
 
-    def check_finished_multiprocessing(self):
+    def check_finished_multiprocessing(self, wait=True):
         """
         check if all jobs in this tasks are finished
         if finished, analyze the job
+        :param wait: if False, return after the finished jobs are sent to the analysis pool.
+                     The results are saved by AnalysisPool.collect()
         """
-        from multiprocessing import Pool
-
         current_app.logger.info('Check status Multi %s' % self)
-        for job in self.jobs.filter(Job.status == Compute.Status.STARTED):
-            try:
-                job.check_finished()
-            except Exception as e:
-                current_app.logger.error('Check job status failed %s %s' % (job, repr(e)))
-                traceback.print_exc()
-
-        jobs_to_analyze = self.jobs.filter(Job.status == Compute.Status.DONE).all()
-
-        for job in jobs_to_analyze:
-            current_app.logger.info('Analyze %s' % job)
-
-        n_process = 8
-        n_group = int(math.ceil(len(jobs_to_analyze) / n_process))
-        for i in range(n_group):
-            job_group = jobs_to_analyze[i * n_process:(i + 1) * n_process]
-            with Pool(n_process) as p:
-                return_dicts = p.map(wrapper_cls_func,
-                                     [(job, 'analyze_multiprocessing', [],
-                                       {'job_dir': job.dir, 'job_procedure': job.task.procedure})
-                                      for job in job_group])
-            for j, job in enumerate(job_group):
-                return_dict = return_dicts[j]
-                exception = return_dict.pop('exception')
-                if exception is not None:
-                    current_app.logger.error('Analyze failed %s %s' % (job, exception))
-                for k, v in return_dict.items():
-                    setattr(job, k, v)
+        Task.check_finished_tasks([self], wait=wait)
 
-            db.session.commit()
-
-        # Set status as DONE if all jobs are converged or failed
-        # Set status as ANALYZED only if all jobs are converged
+    @staticmethod
+    def check_finished_tasks(tasks, wait=True) -> [int]:
+        """
+        check_finished_multiprocessing() for many tasks with a fixed number of queries
+        Jobs, PbsJobs and finished jobs of all tasks are loaded in one query each, and committed once
+        :return: id of tasks which have jobs sent to the analysis pool
+        """
+        task_ids = [task.id for task in tasks]
+        if task_ids == []:
+            return []
+        jobs_started = Job.query.options(joinedload(Job.task)).filter(Job.task_id.in_(task_ids)) \
+            .filter(Job.status == Compute.Status.STARTED).all()
+        Job.check_finished_jobs(jobs_started)
+
+        # analyze DONE jobs in the analysis pool shared by all tasks
+        from .analyze import get_analysis_pool
+        pool = get_analysis_pool()
+        submitted_ids = []
+        for job in Job.query.options(joinedload(Job.task)).filter(Job.task_id.in_(task_ids)) \
+                .filter(Job.status == Compute.Status.DONE):
+            if pool.submit(job) and job.task_id not in submitted_ids:
+                submitted_ids.append(job.task_id)
+
+        if wait:
+            pool.collect(wait=True)
+            for task in tasks:
+                task.update_status()
+        return submitted_ids
+
+    def update_status(self):
+        '''
+        Set status as DONE if all jobs are converged or failed
+        Set status as ANALYZED only if all jobs are converged
+        '''
         _failed = []
         for job in self.jobs:
             # at least one of the job is failed
@@ -720,6 +1310,7 @@ class Task(db.Model):
             db.session.commit()
 
     def reset(self, add_mol_list=None):
+        delete_job_properties([job_id for (job_id,) in db.session.query(Job.id).filter(Job.task_id == self.id)])
         for job in self.jobs:
             if job.pbs_jobs_id is not None and job.is_running():
                 for pbs_job in job.pbs_jobs():
@@ -743,6 +1334,9 @@ class Task(db.Model):
         self.status = Compute.Status.DONE
         self.commands = None
         self.post_result = None
+        self.post_cache = None
+        self.post_dirty = None
+        save_task_fits([self])
         db.session.commit()
 
     def remove(self):
@@ -751,213 +1345,160 @@ class Task(db.Model):
         db.session.delete(self)
         db.session.commit()
 
+    def is_ready_for_post_process(self) -> bool:
+        return self.stage == Compute.Stage.RUNNING and self.status in [Compute.Status.DONE, Compute.Status.ANALYZED]
+
     def post_process(self, force=False, t_list=None, p_list=None, repeat_number=None, overwrite=False):
         if self.post_result is not None and not overwrite:
             return
         if not force:
-            if not (self.stage == Compute.Stage.RUNNING and self.status in [Compute.Status.DONE, Compute.Status.ANALYZED]):
+            if not self.is_ready_for_post_process():
                 return
-        T_list = []
-        P_list = []
-        result_list = []
+        from .postprocess import post_process_state_point
 
+        state_results = []
+        for spec in self.get_post_process_specs(t_list=t_list, p_list=p_list, repeat_number=repeat_number):
+            current_app.logger.info('Post-process, t=%i,p=%i task=%s' % (spec['t'], spec['p'] or 0, self))
+            state_results.append((spec['t'], spec['p'], post_process_state_point(spec)))
+        return self.save_post_process(state_results)
+
+    def get_post_process_specs(self, t_list=None, p_list=None, repeat_number=None, tp_list=None) -> [dict]:
+        '''
+        Plain data for post-processing each state point with converged jobs, in the order of t_list and p_list
+        All converged jobs of the task are loaded in one query
+        :param tp_list: only these (t, p), e.g. the state points changed since the last post-processing
+        '''
         if t_list is None:
             t_list = self.get_t_list()
         if p_list is None:
             p_list = self.get_p_list()
+        jobs_dict = {}
+        for job in self.jobs.filter(Job.converged == True).order_by(Job.id):
+            jobs_dict.setdefault((job.t, job.p), []).append(job)
 
+        specs = []
         for t in t_list:
             for p in p_list:
-                current_app.logger.info('Post-process, t=%i,p=%i task=%s' % (t, p or 0, self))
-                jobs = self.jobs.filter(Job.t == t).filter(Job.p == p).filter(Job.converged)
-                if jobs.count() == 0:
+                if tp_list is not None and (t, p) not in tp_list:
                     continue
-                if repeat_number is not None and repeat_number < jobs.count():
-                    jobs = jobs.limit(repeat_number)
-
-                if self.procedure in ['nvt-multi', 'nvt-multi-2', 'nvt-multi-3', 'npt-multi']:
-
-                    viscosity, score1 = self.post_process_GK(t, p, jobs, property='viscosity')
-                    electrical_conductivity, score2 = self.post_process_GK(t, p, jobs,
-                                                                           property='electrical conductivity')
+                jobs = jobs_dict.get((t, p), [])
+                if jobs == []:
+                    continue
+                if repeat_number is not None:
+                    jobs = jobs[:repeat_number]
+                specs.append({
+                    'task_id'  : self.id,
+                    'procedure': self.procedure,
+                    'dir'      : self.dir,
+                    't'        : t,
+                    'p'        : p,
+                    'mol_names': self.get_distinct_mol_name_list() if Config.DIFF_GK else [],
+                    'jobs'     : [{'dir': job.dir, 'result': job.result} for job in jobs],
+                })
+        return specs
+
+    def get_post_dirty(self):
+        '''
+        State points changed since the last post-processing
+        :return: [(t, p)], or None if the task is never post-processed
+        '''
+        if self.post_dirty is None or self.post_cache is None:
+            return None
+        return [tuple(tp) for tp in json.loads(self.post_dirty)]
 
-                    info_dict = {
-                        'diffusion constant': {}, # {name: [diff, stderr]}
-                        'Nernst-Einstein electrical conductivity': [],
-                    }
-                    for name in (json.loads(jobs[0].result)).get('diffusion constant').keys():
-                        info_dict.get('diffusion constant').update({name: []})
-                    for job in jobs:
-                        result = json.loads(job.result)
-                        info_dict.get('Nernst-Einstein electrical conductivity').append(
-                            result.get('Nernst-Einstein electrical conductivity')[0])
-                        for name in result.get('diffusion constant').keys():
-                            info_dict.get('diffusion constant').get(name).append(
-                                result.get('diffusion constant').get(name)[0])
-                    econ = np.array(info_dict.get('Nernst-Einstein electrical conductivity'))
-                    info_dict['Nernst-Einstein electrical conductivity'] = [econ.mean(), econ.std()]
-                    for name in info_dict.get('diffusion constant').keys():
-                        diff = np.array(info_dict.get('diffusion constant').get(name))
-                        info_dict.get('diffusion constant')[name] = [diff.mean(), diff.std()]
-
-                    # too slow to use green-kubo method to calculate diffusion constants
-                    if Config.DIFF_GK:
-                        diffusion_constant_score = {}
-                        diff, s = self.post_process_GK(t, p, jobs, property='diffusion constant', name='System')
-                        diffusion_constant_score.update({'System': [diff, s]})
-                        for name in self.get_distinct_mol_name_list():
-                            diff, s = self.post_process_GK(t, p, jobs, property='diffusion constant', name=name)
-                            diffusion_constant_score.update({name: [diff, s]})
-                        info_dict.update({
-                            'diffusion constant-gk and score': diffusion_constant_score, # {name: [diff, score]} # time-decomposition method
-                        })
-                        diffusion_constant_list = {}
-                        diffusion_constant_list['System'] = []
-                        for name in self.get_distinct_mol_name_list():
-                            diffusion_constant_list[name] = []
-                        for job in jobs:
-                            result = json.loads(job.result)
-                            diffusion_constant_list['System'].append(result['diffusion constant-gk']['System'])
-                            for name in self.get_distinct_mol_name_list():
-                                diffusion_constant_list[name].append(result['diffusion constant-gk'][name])
-                        diffusion_constant_stderr = {}
-                        diffusion_constant_stderr['System'] = [np.mean(diffusion_constant_list['System']), np.std(diffusion_constant_list['System'])]
-                        for name in self.get_distinct_mol_name_list():
-                            diffusion_constant_stderr[name] = [np.mean(diffusion_constant_list[name]), np.std(diffusion_constant_list[name])]
-                        info_dict.update({
-                            'diffusion constant-gk and stderr': diffusion_constant_stderr, # {name: [diff, stderr]} #
-                        })
-
-                    info_dict.update({
-                        'viscosity': viscosity,
-                        'vis_score': score1,
-                        'electrical conductivity': electrical_conductivity,
-                        'econ_score': score2,
-                    })
-                    T_list.append(t)
-                    P_list.append(p)
-                    result_list.append(info_dict)
-                else:
-                    T_list.append(t)
-                    P_list.append(p)
-                    result_list.append(json.loads(jobs[0].result))
+    def save_post_process(self, state_results, cached=False, failed_list=None):
+        '''
+        Fit the results of all state points with sim.post_process(), and save post_result
+        :param state_results: [(t, p, result)]
+        :param cached: take state points not in state_results from the results of the last post-processing
+        :param failed_list: [(t, p)] failed in post-processing. They are kept dirty and retried next time
+        '''
+        cache = json.loads(self.post_cache) if cached and self.post_cache is not None else {}
+        for t, p, result in state_results:
+            cache['%s-%s' % (t, p)] = [t, p, result]
+        self.post_cache = json.dumps(cache)
+        self.post_dirty = json.dumps(sorted(set(failed_list or []), key=lambda x: (x[0], x[1] or 0)))
 
+        T_list = []
+        P_list = []
+        result_list = []
+        for t, p, result in sorted(cache.values(), key=lambda x: (x[0], x[1] or 0)):
+            T_list.append(t)
+            P_list.append(p)
+            result_list.append(result)
         sim = init_simulation(self.procedure)
         post_result, post_info = sim.post_process(T_list=T_list, P_list=P_list, result_list=result_list,
                                                   n_mol_list=json.loads(self.n_mol_list))
 
-        if post_result is not None:
-            self.post_result = json.dumps(post_result)
-            db.session.commit()
-        else:
+        # a task with post_result is post-processed again when its state points change
+        # the old post_result is dropped if the new fit fails, so that it never disagrees with post_cache
+        self.post_result = json.dumps(post_result) if post_result is not None else None
+        save_task_fits([self])
+        if post_result is None:
             print(post_info)
+        db.session.commit()
         return post_info
 
-    def post_process_GK(self, t, p, jobs, property=None, fit=True, name=None, plot_not_converged=False):
-        from mstools.analyzer.acf import get_block_average, Property_dict
-        from mstools.analyzer.fitting import polyval, polyfit, ExpConstfit, ExpConstval
-        from mstools.analyzer.plot import plot
-
-        def get_property_mean_std_list(jobs, property=None, weight=0.00, scale=1., name=None):
-            from mstools.analyzer.acf import get_t_property_list
-            t_list = []
-            data_list = []
-            for job in jobs:
-                tl, data = get_t_property_list(dir=job.dir, property=property, weight=weight, name=name)
-                if tl is None or data is None:
-                    continue
-                t_list.append(tl)
-                data_list.append(data)
-                if not (tl.size == data.size == t_list[0].size == data_list[0].size):
-                    t_list.remove(tl)
-                    data_list.remove(data)
-            # calculate averaged viscosity and its std over many independent parallel simulations
-            mean = np.linspace(0, 0, data_list[0].size)  # averaged value of target property
-            stderr = np.linspace(0, 0, data_list[0].size)  # stderr
-            for data in data_list:
-                mean += data
-            mean /= len(data_list)
-            for data in data_list:
-                stderr += (data - mean) ** 2
-            stderr = np.sqrt(stderr / (len(data_list) - 1))
-            if property == 'electrical conductivity':
-                scale = Config.CHARGE_SCALE ** 2
-            return t_list[0], mean*scale, stderr*scale
-
-        t_list, mean, stderr = get_property_mean_std_list(jobs, property=property, name=name)
-
-        if fit:
-            # fit the std of data using function y(t)=At^b
-            _log_t = np.log(t_list)
-            _log_stderr = np.log(stderr)
-            c1, s1 = polyfit(_log_t, _log_stderr, 1)
-
-            # fit the data using exponential function
-            n_block = len([t for t in t_list if t < 1])
-            t_list_block = get_block_average(t_list, n_block=n_block)
-            if property == 'viscosity':
-                bounds = ([-np.inf, 0, 0], [0, np.inf, np.inf])
-                c2, s2 = ExpConstfit(t_list_block[2:], get_block_average(mean, n_block=n_block)[2:],
-                                 bounds=bounds)
-            elif property == 'electrical conductivity':
-                # bounds = ([0, 0, 0], [np.inf, np.inf, np.inf])
-                bounds = ([0, 0, 0], [100, 100, 100])
-                c2, s2 = ExpConstfit(t_list_block[2:], get_block_average(mean, n_block=n_block)[2:],
-                                 bounds=bounds)
-            elif property == 'diffusion constant':
-                factor = math.floor(math.log10(mean.mean()))
-                bounds = ([0, 0, 0], [100, 100, 100])
-                c2, s2 = ExpConstfit(t_list_block[2:], get_block_average(mean * 10 ** (-factor), n_block=n_block)[2:],
-                                 bounds=bounds)
-                c2[0] *= 10 ** (factor)
-                c2[1] *= 10 ** (factor)
-            else:
-                return None, 0
-            if abs(ExpConstval(t_list[-1], c2) - ExpConstval(t_list[-1] / 2, c2)) / ExpConstval(t_list[-1], c2) > 0.01:
-                if plot_not_converged:
-                    plot(t_list, mean, ExpConstval(t_list, c2))
-                return None, 0.
-
-            t_p_dir = os.path.join(self.dir, '%i-%i' % (t, p))
-            if name is not None:
-                file_name1 = Property_dict.get(property).get('abbr') + '-%s.txt' % (name)
-            else:
-                file_name1 = Property_dict.get(property).get('abbr') + '.txt'
-            f1 = open(os.path.join(t_p_dir, file_name1), 'w')
-            f1.write('#time(ps)\t%s\tfit\n' % (Property_dict.get(property).get('property_unit')))
+    def get_vis_with_weight(self, t, p, weight_list):
+        '''
+        Job.get_vis_with_weight() for all converged repeats of a state point at once
+        The ACFs are truncated to the shortest one, and integrated for all repeats and weights in one NumPy pass
+        '''
+        from .gk import weighted_running_integral, write_vis_with_weight
+
+        jobs = self.jobs.filter(Job.t == t).filter(Job.p == p).filter(Job.converged).all()
+        dir_list, acf_list, convert_list = [], [], []
+        t_list = None
+        for job in jobs:
+            tl, acf, convert = job.get_acf_pab()
+            if tl is None:
+                continue
+            if t_list is None or tl.size < t_list.size:
+                t_list = tl
+            dir_list.append(job.dir)
+            acf_list.append(acf)
+            convert_list.append(convert)
+        if dir_list == []:
+            return
+        size = t_list.size
+        acf = np.array([acf[:size] for acf in acf_list])
+        weight_list = np.atleast_1d(weight_list)
+        vis = weighted_running_integral(t_list, acf, weight_list, convert=np.array(convert_list))
+        for i, w in enumerate(weight_list):
+            for j, dir in enumerate(dir_list):
+                write_vis_with_weight(dir, w, t_list, vis[i, j])
 
-            if name is not None:
-                file_name2 = Property_dict.get(property).get('abbr') + '-%s-stderr.txt' % (name)
-            else:
-                file_name2 = Property_dict.get(property).get('abbr') + '-stderr.txt'
-            f2 = open(os.path.join(t_p_dir, file_name2), 'w')
-            f2.write('#time(ps)\t%s_stderr\tfit\n' % (Property_dict.get(property).get('property_unit')))
-            for i in range(mean.size):
-                f1.write('%#.5e\t%#.5e\t%#.5e\n' % (t_list[i], mean[i], ExpConstval(t_list[i], c2)))
-                f2.write('%#.5e\t%#.5e\t%#.5e\n' % (t_list[i], stderr[i], np.exp(polyval(np.log(t_list[i]), c1))))
-            return c2[1], s2
-        else:
-            t_p_dir = os.path.join(self.dir, '%i-%i' % (t, p))
-            f1 = open(os.path.join(t_p_dir, '%s.txt' % (self.Property_dict.get(property).get('abbr'))), 'w')
-            f1.write('#time(ps)\t%s\tfit\n' % (self.Property_dict.get(property).get('property_unit')))
-            f2 = open(os.path.join(t_p_dir, '%s_stderr.txt' % (self.Property_dict.get(property).get('abbr'))), 'w')
-            f2.write('#time(ps)\t%s_stderr\tfit\n' % (self.Property_dict.get(property).get('property_unit')))
-            for i in range(mean.size):
-                f1.write('%f\t%f\n' % (t_list[i], mean[i]))
-                f2.write('%f\t%f\n' % (t_list[i], stderr[i]))
-            return 0, 0
+    def post_process_GK(self, t, p, jobs, property=None, fit=True, name=None, plot_not_converged=False):
+        from .gk import post_process_GK
+        return post_process_GK(os.path.join(self.dir, '%i-%i' % (t, p)), [job.dir for job in jobs],
+                               property=property, fit=fit, name=name, plot_not_converged=plot_not_converged)
 
     def get_post_data(self, T=298, P=1):
         sim = init_simulation(self.procedure)
         post_data = sim.get_post_data(post_result=self.get_post_result(), T=T, P=P, smiles_list=self.get_smiles_list())
         return post_data
 
+    def get_post_data_list(self, TP_list) -> [dict]:
+        '''
+        get_post_data() at many state points. The engine, post_result and smiles_list are prepared only once
+        :param TP_list: [(T, P)]
+        '''
+        sim = init_simulation(self.procedure)
+        post_result = self.get_post_result()
+        smiles_list = self.get_smiles_list()
+        return [sim.get_post_data(post_result=post_result, T=T, P=P, smiles_list=smiles_list) for T, P in TP_list]
+
 
 class Job(db.Model):
     '''
     A Job record corresponds to one molecule and one physical state (T and P)
     '''
     __tablename__ = 'job'
+    __table_args__ = (
+        db.Index('ix_job_task_id_status', 'task_id', 'status'),
+        db.Index('ix_job_task_id_t_p_repeat_id', 'task_id', 't', 'p', 'repeat_id'),
+        db.Index('ix_job_status_converged_cycle', 'status', 'converged', 'cycle'),
+    )
     id = NotNullColumn(Integer, primary_key=True)
     task_id = NotNullColumn(Integer, ForeignKey(Task.id))
     t = Column(Integer, nullable=True)
@@ -971,6 +1512,7 @@ class Job(db.Model):
     pbs_jobs_id = Column(Text)
     repeat_id = Column(Integer, nullable=True)
     bugfix = NotNullColumn(Boolean, default=False)
+    simulation_part = Column(Text, nullable=True)
 
     task = db.relationship(Task)
 
@@ -978,6 +1520,7 @@ class Job(db.Model):
         return '<Job: %i: %s %i>' % (self.id, self.name, self.cycle)
 
     @property
+    @cycle_cached
     def dir(self) -> str:
         dir_name = '%i-%i' % (self.t, self.p or 0)
         repeat_name = 'repeat-%i' % (self.repeat_id)
@@ -1024,43 +1567,76 @@ class Job(db.Model):
         else:
             return json.loads(self.result)
 
-    def get_simulation_part(self, name): # The job with same value of this function can be simulated together using GPU.
+    def get_simulation_part(self, name, cache=True): # The job with same value of this function can be simulated together using GPU.
+        '''
+        Count the 'Started mdrun' lines in the GROMACS log
+        The counter is cached in self.simulation_part as {name: [n, offset, mtime, size]}
+        The log is read only if its mtime or size changed, and only the part appended after offset
+        The caller is responsible for committing the session
+        :param cache: save the updated counter in self.simulation_part. Set False for callers which do not write
+        '''
         if name == 'nvt-slab':
             name = 'nvt'
         log = os.path.join(self.dir, '%s.log' % name)
-        f = open(log, 'r')
-        n = 1
-        for line in f.readlines():
-            if line.startswith('Started mdrun'):
-                n += 1
+        stat = os.stat(log)
+        parts = json.loads(self.simulation_part or '{}')
+        n, offset, mtime, size = parts.get(name, [1, 0, None, None])
+        if mtime == stat.st_mtime and size == stat.st_size:
+            return n
+        if stat.st_size < offset:
+            # log file is rewritten
+            n, offset = 1, 0
+        with open(log, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                if line.startswith(b'Started mdrun'):
+                    n += 1
+        if cache:
+            parts[name] = [n, offset, stat.st_mtime, stat.st_size]
+            self.simulation_part = json.dumps(parts)
         return n
 
+    def get_acf_pab(self):
+        '''
+        t_list and ACF of the pressure tensor, and the factor converting its integral into viscosity
+        All None if the job has no ACF
+        '''
+        from .gk import load_series
+
+        f_acf = os.path.join(self.dir, 'P_acf.txt')
+        if not os.path.exists(f_acf):
+            return None, None, None
+
+        def loader():
+            acf_info = pd.read_csv(f_acf, sep='\s+', header=0)
+            return np.array(acf_info['#time(ps)']), np.array(acf_info['ACF(Pab)'])
+
+        t_list, acf_list = load_series(self.dir, 'P_acf', [f_acf], loader)
+        with open(os.path.join(self.dir, 'nvt.gro')) as f:
+            box = f.readlines()[-1].split()
+        volume = float(box[0]) * float(box[1]) * float(box[2])
+        convert = 6.022 * 0.001 * volume / (8.314 * self.t)
+        return t_list, acf_list, convert
+
     def get_vis_with_weight(self, weight=None):
+        '''
+        Write the viscosity integrated with weighted ACF into vis-{weight}.txt
+        :param weight: a weight or a list of weights, all integrated in one pass
+        '''
         if weight is None:
             return
-        f_acf = os.path.join(self.dir, 'P_acf.txt')
-        if not os.path.exists(f_acf):
+        t_list, acf_list, convert = self.get_acf_pab()
+        if t_list is None:
             return
-        acf_info = pd.read_csv(f_acf, sep='\s+', header=0)
-        t_list = np.array(acf_info['#time(ps)'])
-        acf_list = np.array(acf_info['ACF(Pab)'])
-        dt = t_list[1] - t_list[0]
-        temperature = self.t
-        gro = os.path.join(self.dir, 'nvt.gro')
-        f = open(gro, 'r')
-        box = f.readlines()[-1].split()
-        volume = float(box[0]) * float(box[1]) * float(box[2])
-        convert = 6.022 * 0.001 * volume / (8.314 * temperature)
-        vis = convert * acf_list[0] * dt / 2
-        f_vis = os.path.join(self.dir, 'vis-%.2f.txt' % (weight))
-        f = open(f_vis, 'w')
-        f.write('#time(ps)\tviscosity(mPa·s)\n')
-        for i in range(1, len(t_list)):
-            f.write('%f\t%f\n' % (t_list[i]-0.5*dt, vis))
-            if t_list[i] <= 1:
-                vis += convert * acf_list[i] * dt
-            else:
-                vis += convert * acf_list[i] * dt * t_list[i] ** (-weight)
+        from .gk import weighted_running_integral, write_vis_with_weight
+
+        weight_list = np.atleast_1d(weight)
+        vis = weighted_running_integral(t_list, acf_list, weight_list, convert=convert)
+        for i, w in enumerate(weight_list):
+            write_vis_with_weight(self.dir, w, t_list, vis[i])
 
     def prepare(self):
         if self.status == Compute.Status.STARTED:
@@ -1074,62 +1650,8 @@ class Job(db.Model):
                 else:
                     prior_job_dir = prior_job.dir
 
-            cd_or_create_and_cd(self.dir)
-            sim = init_simulation(self.task.procedure)
-
-            # Using Temperature dependent parameters or not
-            if Config.DFF_TABLE == 'IL':
-                T_basic = 350
-                drde = True
-            elif Config.DFF_TABLE == 'MGI':
-                T_basic = 298
-                drde = True
-            else:
-                return
-            # prepare
-            if self.task.procedure in ['npt', 'npt-2', 'npt-3']:
-                commands = sim.prepare(model_dir='../../build', T=self.t, P=self.p, jobname=self.name,
-                                       drde=drde, T_basic=T_basic)
-            elif self.task.procedure == 'npt-v-rescale':
-                commands = sim.prepare(model_dir='../../build', T=self.t, P=self.p, jobname=self.name,
-                                       dt=0.001, nst_trr=50, tcoupl='v-rescale', drde=drde,
-                                       acf=True, mstools_dir=Config.MS_TOOLS_DIR)
-            elif self.task.procedure == 'npt-multi':
-                commands = sim.prepare(model_dir='../../build', T=self.t, P=self.p, jobname=self.name, dt=0.001,
-                                       nst_trr=50, nst_edr=5, tcoupl='v-rescale', drde=drde, random_seed=self.repeat_id,
-                                       acf=True, diff_gk=Config.DIFF_GK, mstools_dir=Config.MS_TOOLS_DIR)
-            elif self.task.procedure in ['nvt-multi', 'nvt-multi-2', 'nvt-multi-3']:
-                commands = sim.prepare(prior_job_dir=prior_job_dir, T=self.t, jobname=self.name, gro='npt.gro',
-                                       tcoupl='v-rescale', random_seed=self.repeat_id, nst_run=int(2E6),
-                                       acf=True, diff_gk=Config.DIFF_GK, mstools_dir=Config.MS_TOOLS_DIR)
-            elif self.task.procedure == 'ppm':
-                commands = sim.prepare(prior_job_dir=prior_job_dir, T=self.t, P=self.p, jobname=self.name,
-                                       gro='npt.gro', replicate=(1, 1, 2), random_seed=self.repeat_id)
-            elif self.task.procedure == 'nvt-slab':
-                commands = sim.prepare(model_dir='../../build', T=self.t, jobname=self.name,
-                                       drde=drde)
-            else:
-                return
-            # Using LJ 9-6 potential
-            if Config.LJ96:
-                sim.gmx._LJ96 = True
-                if self.task.procedure in ['npt', 'npt-2', 'npt-3', 'npt-v-rescale', 'npt-multi']:
-                    sim.gmx.modify_lj96(['topol.itp'],
-                                        ['topol.top', 'topol-hvap.top'],
-                                        ['grompp-em.mdp', 'grompp-anneal.mdp', 'grompp-eq.mdp', 'grompp-npt.mdp',
-                                         'grompp-hvap.mdp'],
-                                        ['em.xvg', 'anneal.xvg', 'eq.xvg', 'npt.xvg', 'hvap.xvg'])
-                elif self.task.procedure in ['nvt-multi', 'nvt-multi-2', 'nvt-multi-3']:
-                    sim.gmx.modify_lj96([], [], ['grompp-eq.mdp', 'grompp-nvt.mdp'], ['eq.xvg', 'nvt.xvg'])
-                elif self.task.procedure == 'ppm':
-                    mdp_list = ['grompp-eq-%.3f.mdp' % (a) for a in sim.amplitudes_steps.keys()] \
-                               + ['grompp-ppm-%.3f.mdp' % (a) for a in sim.amplitudes_steps.keys()]
-                    xvg_list = ['eq-%.3f.xvg' % (a) for a in sim.amplitudes_steps.keys()] \
-                               + ['ppm-%.3f.xvg' % (a) for a in sim.amplitudes_steps.keys()]
-                    sim.gmx.modify_lj96([], [], mdp_list, xvg_list)
-
-            # all jobs under one task share same commands, save this for GMX -multidir simulation
-            return commands
+            return prepare_job(self.task.procedure, self.dir, self.t, self.p, self.name, self.repeat_id,
+                               prior_job_dir=prior_job_dir)
 
     def run(self) -> bool:
         try:
@@ -1143,6 +1665,8 @@ class Job(db.Model):
         pbs_job.sh_file = os.path.join(self.dir, current_app.jobmanager.sh)
         db.session.add(pbs_job)
         db.session.flush()
+        append_sentinel(pbs_job.sh_file, sentinel_commands(current_app.jobmanager,
+                                                           [self.get_script_spec()], pbs_job.name))
 
         self.pbs_jobs_id = json.dumps([pbs_job.id])
         self.status = Compute.Status.STARTED
@@ -1171,6 +1695,7 @@ class Job(db.Model):
         self.cycle = 0
         self.converged = False
         self.result = None
+        save_job_properties([self])
         db.session.commit()
 
         cd_or_create_and_cd(self.dir)
@@ -1237,6 +1762,7 @@ class Job(db.Model):
         info = json.loads(self.result)
         if set(info.get('continue')) != [False]:
             sim.extend(jobname=pbs_name, sh=sh, info=info, dt=sim.dt, hipri=hipri)
+            append_sentinel(sh, sentinel_commands(sim.jobmanager, [self.get_script_spec(cycle=self.cycle + 1)], pbs_name))
 
         pbs_job = PbsJob(extend=True)
         pbs_job.name = pbs_name
@@ -1283,6 +1809,7 @@ class Job(db.Model):
                 n_amplitude = len(sim.amplitudes_steps.keys())
                 commands += json.loads(self.task.commands)[4*(i+1):4*n_amplitude]
                 sh = '_job.bugfix.sh'
+                commands += sentinel_commands(sim.jobmanager, [self.get_script_spec()], pbs_name)
                 sim.jobmanager.generate_sh(os.getcwd(), commands, name=pbs_name or self.task.procedure, sh=sh)
                 pbs_job = PbsJob(bugfix=True)
                 pbs_job.name = pbs_name
@@ -1290,6 +1817,7 @@ class Job(db.Model):
                 db.session.add(pbs_job)
                 db.session.flush()
                 self.result = None
+                save_job_properties([self])
                 self.pbs_jobs_id = json.dumps([pbs_job.id])
                 self.status = Compute.Status.STARTED
                 self.task.status = Compute.Status.STARTED
@@ -1311,31 +1839,116 @@ class Job(db.Model):
         else:
             return True
 
-    def is_running(self) -> bool:
+    def is_running(self, pbs_job_dict=None) -> bool:
         '''
         check if the job is running
 
         If the pbs job has not been generated, return False
         If the all pbs jobs are not running, return False
         Otherwise, return True
+        :param pbs_job_dict: {id: PbsJob} prefetched by the task, to avoid one query per job
         :return:
         '''
         if not self.is_pbs_generated():
             return False
         pbs_jobs_id = json.loads(self.pbs_jobs_id)
-        pbs_jobs = PbsJob.query.filter(PbsJob.id.in_(pbs_jobs_id))
+        if pbs_job_dict is not None:
+            pbs_jobs = [pbs_job_dict[id] for id in pbs_jobs_id if id in pbs_job_dict]
+        else:
+            pbs_jobs = PbsJob.query.filter(PbsJob.id.in_(pbs_jobs_id))
         for pbs_job in pbs_jobs:
-            if pbs_job.is_running():
+            if pbs_job.is_running(indexes=pbs_job.get_array_indexes(self.id)):
                 return True
         return False
 
-    def is_running_finished(self) -> bool:
-        if self.is_pbs_generated() and not self.is_running():
+    def is_running_finished(self, pbs_job_dict=None) -> bool:
+        if self.is_pbs_generated() and not self.is_running(pbs_job_dict=pbs_job_dict):
             return True
         else:
             return False
 
-    def check_finished(self) -> bool:
+    def get_script_spec(self, cycle=None) -> dict:
+        '''
+        Plain data of this job for the sentinel and in-situ analysis commands of job scripts
+        :param cycle: the cycle run by the script, if the job is not updated yet
+        '''
+        return {
+            'id'            : self.id,
+            'dir'           : self.dir,
+            'procedure'     : self.task.procedure,
+            'cycle'         : self.cycle if cycle is None else cycle,
+            'analyze_kwargs': self.get_analyze_kwargs(),
+        }
+
+    def get_insitu_result(self):
+        '''
+        Result of the in-situ analysis on the compute node, in the format of analyze_job()
+        The file is removed once it is read. Results of other cycles are ignored
+        :return: dict or None
+        '''
+        from .jobmanager import INSITU_RESULT
+        f_result = os.path.join(self.dir, INSITU_RESULT)
+        if not os.path.exists(f_result):
+            return None
+        try:
+            with open(f_result) as f:
+                return_dict = json.load(f)
+        except Exception as e:
+            current_app.logger.warning('Cannot read in-situ result %s %s' % (self, repr(e)))
+            return None
+        if return_dict.pop('cycle', None) != self.cycle:
+            return None
+        os.remove(f_result)
+        return return_dict
+
+    def get_sentinels(self, pbs_job_dict=None) -> [str]:
+        '''
+        Completion sentinels expected from all PBS jobs of this job
+        Return [] if sentinels are disabled or the PBS jobs were generated without sentinel
+        '''
+        if not Config.JOB_SENTINEL or not self.is_pbs_generated():
+            return []
+        pbs_jobs_id = json.loads(self.pbs_jobs_id)
+        if pbs_job_dict is not None:
+            pbs_jobs = [pbs_job_dict[id] for id in pbs_jobs_id if id in pbs_job_dict]
+        else:
+            pbs_jobs = PbsJob.query.filter(PbsJob.id.in_(pbs_jobs_id)).all()
+        sentinels = []
+        for pbs_job in pbs_jobs:
+            indexes = pbs_job.get_array_indexes(self.id)
+            for index in (indexes if indexes is not None else [None]):
+                sentinels.append(get_sentinel(self.dir, pbs_job.name, index))
+        return sentinels
+
+    def is_sentinel_finished(self, pbs_job_dict=None) -> bool:
+        '''
+        Check if the completion sentinels of all PBS jobs of this job are written, without asking the job manager
+        Return False if any PBS job was generated without sentinel
+        '''
+        sentinels = self.get_sentinels(pbs_job_dict=pbs_job_dict)
+        if sentinels == []:
+            return False
+        return all(os.path.exists(sentinel) for sentinel in sentinels)
+
+    def get_sentinel_error(self, pbs_job_dict=None):
+        '''
+        Read the exit codes in the completion sentinels of this job. Sentinels not written are skipped
+        :return: the content of the first sentinel with non-zero exit code, or None if all of them exited normally
+        '''
+        for sentinel in self.get_sentinels(pbs_job_dict=pbs_job_dict):
+            if not os.path.exists(sentinel):
+                continue
+            try:
+                with open(sentinel) as f:
+                    info = json.load(f)
+            except Exception as e:
+                current_app.logger.warning('Cannot read sentinel %s %s' % (sentinel, repr(e)))
+                continue
+            if info.get('exit', 0) != 0:
+                return info
+        return None
+
+    def check_finished(self, pbs_job_dict=None, commit=True) -> bool:
         if self.status in (Compute.Status.FAILED, Compute.Status.ANALYZED):
             return True
         elif self.status == Compute.Status.DONE:
@@ -1343,7 +1956,8 @@ class Job(db.Model):
                 return True
             else:
                 return False
-        if not self.is_running_finished():
+        if not (self.is_sentinel_finished(pbs_job_dict=pbs_job_dict)
+                or self.is_running_finished(pbs_job_dict=pbs_job_dict)):
             return False
 
         os.chdir(self.dir)
@@ -1355,82 +1969,61 @@ class Job(db.Model):
         #     if not current_app.jobmanager.download(remote_dir=self.remote_dir):
         #         return False
 
+        sentinel_error = self.get_sentinel_error(pbs_job_dict=pbs_job_dict)
         sim = init_simulation(self.task.procedure)
-        if sim.check_finished():
+        if sentinel_error is not None:
+            self.status = Compute.Status.FAILED
+            current_app.logger.error('Job failed %s exit %s on %s' % (self, sentinel_error.get('exit'),
+                                                                      sentinel_error.get('host')))
+        elif sim.check_finished():
             self.status = Compute.Status.DONE
         else:
             self.status = Compute.Status.FAILED
             current_app.logger.error('Job failed %s' % self)
-        db.session.commit()
+        if commit:
+            db.session.commit()
         return True
 
-    def analyze_multiprocessing(self, job_dir, job_procedure, **kwargs):
-        _exception = None
-        _status = self.status
-        _converged = self.converged
-        _result = self.result
-
-        os.chdir(job_dir)
-        sim = init_simulation(job_procedure)
-        try:
-            if self.task.procedure in ['npt-multi', 'nvt-multi', 'nvt-multi-2', 'nvt-multi-3']:
-                result = sim.analyze_acf(mstools_dir=Config.MS_TOOLS_DIR, n_mol_list=json.loads(self.task.n_mol_list),
-                                         charge_list=self.task.get_charge_list(), current=self.is_charged_system(),
-                                         delete_trr=not Config.DEBUG, diff_gk=Config.DIFF_GK)
-            else:
-                result = sim.analyze(**kwargs)
-        except Exception as e:
-            # One kine of fail -- simulation fail
-            _status = Compute.Status.FAILED
-            _exception = repr(e)
-        else:
-            if self.task.procedure == 'ppm':
-                from collections import Counter
-                if Counter(result.get('failed'))[True] <= 2 or result.get('failed') == [False, False, False, True, True, True]:
-                    if result.get('converged'):
-                        # simulation converged and normally ended
-                        _status = Compute.Status.ANALYZED
-                        _converged = True
-                        _result = json.dumps(result)
-                        # Clean intermediate files if converged
-                        sim.clean()
-                    else:
-                        # simulation not converged, need to extend simulation
-                        _status = Compute.Status.ANALYZED
-                        _converged = False
-                        _result = json.dumps(result)
-                else:
-                    # simulation failed, cannot extend
-                    _status = Compute.Status.FAILED
-                    _result = json.dumps(result)
-            else:
-                if not result.get('failed')[0]:
-                    if not result.get('continue')[0]:
-                        # simulation converged and normally ended
-                        if self.task.procedure == 'npt-v-rescale':
-                            result.update(sim.analyze_diff(n_mol_list=json.loads(self.task.n_mol_list), charge_list=self.task.get_charge_list()))
-                        _status = Compute.Status.ANALYZED
-                        _converged = True
-                        _result = json.dumps(result)
-                        # Clean intermediate files if converged
-                        sim.clean()
-                    else:
-                        # simulation not converged, need to extend simulation
-                        _status = Compute.Status.ANALYZED
-                        _converged = False
-                        _result = json.dumps(result)
-                else:
-                    # simulation failed, cannot extend
-                    _status = Compute.Status.FAILED
-                    _result = json.dumps(result)
+    @staticmethod
+    def check_finished_jobs(jobs):
+        '''
+        check_finished() for many jobs, with PbsJob records loaded in one query and one commit
+        '''
+        pbs_jobs_id = []
+        for job in jobs:
+            if job.pbs_jobs_id is not None:
+                pbs_jobs_id += json.loads(job.pbs_jobs_id)
+        pbs_job_dict = {pbs_job.id: pbs_job for pbs_job in PbsJob.query.filter(PbsJob.id.in_(set(pbs_jobs_id)))}
+        for job in jobs:
+            try:
+                job.check_finished(pbs_job_dict=pbs_job_dict, commit=False)
+            except Exception as e:
+                current_app.logger.error('Check job status failed %s %s' % (job, repr(e)))
+                traceback.print_exc()
+        db.session.commit()
 
+    def get_analyze_kwargs(self):
+        '''
+        Plain data required by analyze_job() for this job
+        '''
+        if self.task.procedure in ['npt-multi', 'nvt-multi', 'nvt-multi-2', 'nvt-multi-3', 'npt-v-rescale']:
+            return {
+                'n_mol_list' : json.loads(self.task.n_mol_list),
+                'charge_list': self.get_charge_list(),
+            }
+        return {}
 
-        return {
-            'exception': _exception,
-            'status': _status,
-            'converged': _converged,
-            'result': _result,
+    def analyze_multiprocessing(self, job_dir, job_procedure, **kwargs):
+        return_dict = {
+            'exception': None,
+            'status'   : self.status,
+            'converged': self.converged,
+            'result'   : self.result,
         }
+        kwargs.update(self.get_analyze_kwargs())
+        return_dict.update(analyze_job(job_dir, job_procedure, **kwargs))
+        return return_dict
+
     '''
     def analyze_simple(self, job_dir, job_procedure, weight=None):
         os.chdir(job_dir)
@@ -1448,20 +2041,222 @@ class Job(db.Model):
         except:
             current_app.logger.warning('Remove job %s Cannot remove folder: %s' % (self, self.dir))
 
+        delete_job_properties([self.id])
         db.session.delete(self)
         db.session.commit()
 
 
-class ExtendJob:
-    def __init__(self, job, continue_n):
-        self.job = job
-        self.continue_n = continue_n
 
-    def __le__(self, other):
-        return self.continue_n < other.continue_n
+class JobProperty(db.Model):
+    '''
+    One number from Job.result, so that a property of many jobs can be queried without parsing the JSON
+    Written alongside Job.result by save_job_properties()
+    '''
+    __tablename__ = 'job_property'
+    __table_args__ = (
+        db.Index('ix_job_property_property_job_id', 'property', 'job_id'),
+    )
+    id = NotNullColumn(Integer, primary_key=True)
+    job_id = NotNullColumn(Integer, ForeignKey(Job.id))
+    property = NotNullColumn(String(200))
+    value = NotNullColumn(Float)
+    stderr = Column(Float, nullable=True)
+    score = Column(Float, nullable=True)
+
+    def __repr__(self):
+        return '<JobProperty: %i: %s %f>' % (self.job_id, self.property, self.value)
+
+
+class TaskFit(db.Model):
+    '''
+    One fitted function from Task.post_result, e.g. density-poly4
+    Written alongside Task.post_result by save_task_fits()
+    '''
+    __tablename__ = 'task_fit'
+    __table_args__ = (
+        db.Index('ix_task_fit_property_task_id', 'property', 'task_id'),
+    )
+    id = NotNullColumn(Integer, primary_key=True)
+    task_id = NotNullColumn(Integer, ForeignKey(Task.id))
+    property = NotNullColumn(String(200))
+    coefficients = NotNullColumn(Text)  # json list
+    score = Column(Float, nullable=True)
+
+    def __repr__(self):
+        return '<TaskFit: %i: %s %s>' % (self.task_id, self.property, self.score)
+
+    def get_coefficients(self):
+        return json.loads(self.coefficients)
+
+
+class MoleculeCache(db.Model):
+    '''
+    Properties of a molecule which are expensive to compute from SMILES, keyed by canonical SMILES
+    Written only by app.molecule.update_molecule_cache(), and read by models and scripts with get_molecules()
+    '''
+    __tablename__ = 'molecule_cache'
+    id = NotNullColumn(Integer, primary_key=True)
+    smiles = NotNullColumn(String(500), unique=True, index=True)  # canonical SMILES
+    charge = NotNullColumn(Integer)  # formal charge, not scaled
+    formula = NotNullColumn(String(200))
+    n_heavy = NotNullColumn(Integer)
+    n_ring = NotNullColumn(Integer)
+    lj_atom_type = Column(Text, nullable=True)  # json list, from ff.ppf of the single-component task
+    smarts_flags = Column(Text, nullable=True)  # json {group: matched}, groups are app.molecule.SMARTS_GROUPS
+    smarts_version = Column(String(40), nullable=True)  # app.molecule.SMARTS_VERSION of smarts_flags
+
+    def __repr__(self):
+        return '<MoleculeCache: %i: %s>' % (self.id, self.smiles)
+
+    def get_lj_atom_type(self):
+        if self.lj_atom_type is None:
+            return None
+        return json.loads(self.lj_atom_type)
+
+    def get_smarts_flags(self) -> {str: bool}:
+        if self.smarts_flags is None:
+            return {}
+        return json.loads(self.smarts_flags)
+
+    def get_n_atoms(self) -> int:
+        '''
+        Number of atoms including hydrogen, counted from the formula, e.g. C2H6O
+        '''
+        return sum(int(n or 1) for element, n in re.findall(r'([A-Z][a-z]?)(\d*)', self.formula))
+
+
+def _is_number(x) -> bool:
+    return isinstance(x, (int, float)) and not isinstance(x, bool)
+
+
+def flatten_job_result(result) -> [(str, float, float, float)]:
+    '''
+    Numbers in Job.result as [(property, value, stderr, score)]
+    value, [value, stderr] and [value, stderr, score] are recognized
+    {name: value} is flattened as property/name, e.g. diffusion constant/System
+    Flags like failed, continue and continue_n are not numbers of a property and are skipped
+    '''
+    rows = []
+
+    def add(property, v):
+        if _is_number(v):
+            rows.append((property, v, None, None))
+        elif isinstance(v, list) and 2 <= len(v) <= 3 and all(_is_number(x) or x is None for x in v) \
+                and _is_number(v[0]):
+            rows.append((property, v[0], v[1], v[2] if len(v) == 3 else None))
+
+    for k, v in result.items():
+        if k in ['failed', 'continue', 'continue_n', 'name']:
+            continue
+        if isinstance(v, dict):
+            for name, v_name in v.items():
+                add('%s/%s' % (k, name), v_name)
+        else:
+            add(k, v)
+    return rows
+
+
+def flatten_post_result(post_result) -> [(str, list, float)]:
+    '''
+    Fitted functions in Task.post_result as [(property, coefficients, score)]
+    A fit is stored as [coefficients..., score], where coefficients may be a nested list
+    Data of state points, [[t, p, value], ...], are not fits and are skipped
+    '''
+    rows = []
+    for k, v in post_result.items():
+        if not isinstance(v, list) or len(v) < 2 or not _is_number(v[-1]):
+            continue
+        coefficients = []
+        for x in v[:-1]:
+            if isinstance(x, list) and all(_is_number(c) for c in x):
+                coefficients += x
+            elif _is_number(x):
+                coefficients.append(x)
+            else:
+                break
+        else:
+            rows.append((k, coefficients, v[-1]))
+    return rows
+
+
+def delete_job_properties(job_ids):
+    '''
+    Delete the rows in job_property of the jobs. The caller is responsible for committing the session
+    '''
+    # SQLite limits the number of variables in one query
+    for i in range(0, len(job_ids), 500):
+        JobProperty.query.filter(JobProperty.job_id.in_(job_ids[i:i + 500])).delete(synchronize_session=False)
 
-    def __eq__(self, other):
-        return self.continue_n == other.continue_n
 
-    def __gt__(self, other):
-        return self.continue_n > other.continue_n
+def save_job_properties(jobs):
+    '''
+    Replace the rows in job_property of the jobs with the numbers in their result
+    Call it wherever Job.result is changed. Jobs without result are left without rows
+    The caller is responsible for committing the session
+    '''
+    delete_job_properties([job.id for job in jobs])
+    mappings = []
+    for job in jobs:
+        if job.result is None:
+            continue
+        result = json.loads(job.result)
+        if not isinstance(result, dict):
+            continue
+        for property, value, stderr, score in flatten_job_result(result):
+            mappings.append({'job_id': job.id, 'property': property, 'value': value, 'stderr': stderr, 'score': score})
+    db.session.bulk_insert_mappings(JobProperty, mappings)
+
+
+def mark_post_dirty(jobs):
+    '''
+    Mark the state points of jobs with new results for post-processing. Not committed
+    post_dirty is NULL only for tasks never post-processed, which are left unmarked because all their state points
+    will be processed. Tasks post-processed before the column existed are set to '[]' by the migration, see BACKFILL
+    '''
+    tp_dict = {}
+    for job in jobs:
+        if job.result is not None:
+            tp_dict.setdefault(job.task_id, set()).add((job.t, job.p))
+    task_ids = list(tp_dict.keys())
+    for i in range(0, len(task_ids), 500):
+        for task in Task.query.filter(Task.id.in_(task_ids[i:i + 500])).filter(Task.post_dirty != None):
+            tp_set = set(tuple(tp) for tp in json.loads(task.post_dirty)) | tp_dict[task.id]
+            task.post_dirty = json.dumps(sorted(tp_set, key=lambda x: (x[0], x[1] or 0)))
+
+
+def save_task_fits(tasks):
+    '''
+    Replace the rows in task_fit of the tasks with the fits in their post_result
+    The caller is responsible for committing the session
+    '''
+    task_ids = [task.id for task in tasks]
+    if task_ids == []:
+        return
+    TaskFit.query.filter(TaskFit.task_id.in_(task_ids)).delete(synchronize_session=False)
+    mappings = []
+    for task in tasks:
+        if task.post_result is None:
+            continue
+        for property, coefficients, score in flatten_post_result(json.loads(task.post_result)):
+            mappings.append({'task_id': task.id, 'property': property, 'coefficients': json.dumps(coefficients),
+                             'score': score})
+    db.session.bulk_insert_mappings(TaskFit, mappings)
+
+
+def backfill_smiles_hash(batch=1000) -> int:
+    '''
+    Fill Task.smiles_hash of tasks inserted before the column existed or inserted without it,
+    and refill the hashes computed with an older SMILES_HASH_VERSION
+    :return: number of tasks updated
+    '''
+    n = 0
+    while True:
+        tasks = Task.query.filter(or_(Task.smiles_hash == None,
+                                      ~Task.smiles_hash.startswith('%i:' % SMILES_HASH_VERSION))).limit(batch).all()
+        if tasks == []:
+            break
+        for task in tasks:
+            task.get_smiles_hash()
+        db.session.commit()
+        n += len(tasks)
+    return n
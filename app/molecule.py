@@ -0,0 +1,151 @@
+import hashlib
+import json
+from collections import OrderedDict
+from multiprocessing import Pool
+
+from config import Config
+from . import db
+from .models import MoleculeCache, _canonical_smiles
+
+# SMARTS of groups which are not covered or not well described by TEAM force field
+SMARTS_GROUPS = {
+    # Not covered by TEAM FF
+    'radicalC'                     : '[#6;v0,v1,v2,v3]',
+    '*=*=*'                        : '*=*=*',
+    '*#*~*#*'                      : '*#*~*#*',
+    '[F,Cl,Br]~[!#6]'              : '[F,Cl,Br]~[!#6]',
+    '*#*~[!#6]'                    : '*#*~[!#6]',
+    '[NX2,NX4]'                    : '[NX2,NX4]',
+    'O~N(~[!$([OX1])])~[!$([OX1])]': 'O~N(~[!$([OX1])])~[!$([OX1])]',
+    'peroxide'                     : 'O~O',
+    'N~N'                          : 'N~N',
+    '[O,N]*[O,N;H1,H2]'            : '[O,N]*[O,N;H1,H2]',
+    'C=C~[O,N;H1,H2]'              : 'C=C~[O,N;H1,H2]',
+    'beta-dicarbonyl'              : 'O=C~*~C=O',
+    'a=*'                          : 'a=*',
+    'o'                            : 'o',
+    '[n;r5]'                       : '[n;r5]',
+    'pyridine-N-oxide'             : '[nX3;r6]',
+    'triazine(zole)'               : '[$(nnn),$(nnan),$(nanan)]',
+    '[R3]'                         : '[R3]',
+    '[r3,r4;R2]'                   : '[r3,r4;R2]',
+    '[r3,r4;#6X3]'                 : '[r3,r4;#6X3]',
+    '[r3,r4]~[!#6]'                : '[r3,r4]~[!#6]',
+    'nitrate'                      : 'O[NX3](~[OX1])~[OX1]',
+    'amide'                        : 'O=C[NX3]',
+    'acyl-halide'                  : 'O=C[F,Cl,Br]',
+    'polybenzene'                  : 'c1ccc2c(c1)cccc2',
+    # Covered by TEAM FF but the results are not good
+    '[r5;#6X3]'                    : '[r5;#6X3]',
+    '[r5]~[!#6]'                   : '[r5]~[!#6]',
+    'cyclo-ester'                  : '[C;R](=O)O',
+    'C=C~[O,N;H0]'                 : 'C=C~[O,N;H0]',
+    'C=C-X'                        : 'C=C[F,Cl,Br]',
+    '[F,Cl,Br][#6][F,Cl,Br]'       : '[F,Cl,Br][#6][F,Cl,Br]',
+    'alkyne'                       : '[CX2]#[CX2]',
+    'acid'                         : 'C(=O)[OH]',
+    'nitrile'                      : '[NX1]#[CX2][C,c]',
+    'nitro'                        : '[C,c][NX3](~[OX1])~[OX1]',
+    'N-aromatic'                   : 'n',
+    'halogen'                      : '[F,Cl,Br]',
+}
+# cached SMARTS flags with another version are matched again
+SMARTS_VERSION = hashlib.sha1(json.dumps(SMARTS_GROUPS, sort_keys=True).encode()).hexdigest()[:8]
+
+
+def compute_molecule(smiles) -> dict:
+    '''
+    Parse the SMILES and match SMARTS groups. This function does not touch the database, so it runs in worker processes
+    :param smiles: canonical SMILES
+    :return: dict of the columns of MoleculeCache
+    '''
+    import pybel
+    mol = pybel.readstring('smi', smiles)
+    smarts_flags = {}
+    for name, smarts in SMARTS_GROUPS.items():
+        smarts_flags[name] = pybel.Smarts(smarts).findall(mol) != []
+    return {
+        'smiles'        : smiles,
+        'charge'        : mol.charge,
+        'formula'       : mol.formula,
+        'n_heavy'       : mol.OBMol.NumHvyAtoms(),
+        'n_ring'        : len(mol.OBMol.GetSSSR()),
+        'smarts_flags'  : json.dumps(smarts_flags),
+        'smarts_version': SMARTS_VERSION,
+    }
+
+
+def compute_molecules(smiles_list, n_process=None) -> [dict]:
+    '''
+    compute_molecule() of many canonical SMILES, in parallel if there are many
+    '''
+    n_process = n_process or Config.MOLECULE_NPROCS
+    if n_process > 1 and len(smiles_list) > n_process:
+        with Pool(n_process) as pool:
+            return pool.map(compute_molecule, smiles_list, chunksize=100)
+    return [compute_molecule(smiles) for smiles in smiles_list]
+
+
+def query_molecules(canonical_list) -> {str: MoleculeCache}:
+    '''
+    Cached molecules of the canonical SMILES, including those with SMARTS flags of another SMARTS_VERSION
+    '''
+    molecules = {}
+    # SQLite limits the number of variables in one query
+    for i in range(0, len(canonical_list), 500):
+        for molecule in MoleculeCache.query.filter(MoleculeCache.smiles.in_(canonical_list[i:i + 500])):
+            molecules[molecule.smiles] = molecule
+    return molecules
+
+
+def update_molecule_cache(smiles_list, n_process=None, commit=True) -> int:
+    '''
+    Compute the molecules not in cache, or with outdated SMARTS flags, and save them
+    This is the only function which writes molecule_cache. It is called by the monitor and by scripts which write
+    :param commit: commit the session. Set False to leave it to the caller
+    :return: number of molecules computed
+    '''
+    canonical_list = list(set(_canonical_smiles(smiles) for smiles in smiles_list))
+    exist = query_molecules(canonical_list)
+    missing = [smiles for smiles in canonical_list if smiles not in exist]
+    outdated = [smiles for smiles, molecule in exist.items() if molecule.smarts_version != SMARTS_VERSION]
+    if missing == [] and outdated == []:
+        return 0
+
+    mappings = compute_molecules(missing + outdated, n_process=n_process)
+    db.session.bulk_insert_mappings(MoleculeCache, mappings[:len(missing)])
+    for mapping in mappings[len(missing):]:
+        molecule = exist[mapping['smiles']]
+        molecule.smarts_flags = mapping['smarts_flags']
+        molecule.smarts_version = mapping['smarts_version']
+    if commit:
+        db.session.commit()
+    return len(mappings)
+
+
+TRANSIENT_SIZE = 10000  # molecules kept in memory by get_molecules(), the least recently used are dropped
+_transient = OrderedDict()  # {canonical SMILES: MoleculeCache} computed by get_molecules() and not in cache
+
+
+def get_molecules(smiles_list, n_process=None) -> {str: MoleculeCache}:
+    '''
+    MoleculeCache of the SMILES. Nothing is written into the database, so it works in read-only apps
+    Molecules not in cache, or with outdated SMARTS flags, are computed in memory and not saved
+    The last TRANSIENT_SIZE of them are kept, so that the long-running monitor does not grow without bound
+    :return: {smiles: MoleculeCache}, the keys are the SMILES as given, not canonicalized
+    '''
+    canonical_dict = {smiles: _canonical_smiles(smiles) for smiles in set(smiles_list)}
+    canonical_list = list(set(canonical_dict.values()))
+    molecules = {smiles: molecule for smiles, molecule in query_molecules(canonical_list).items()
+                 if molecule.smarts_version == SMARTS_VERSION}
+    for smiles in canonical_list:
+        if smiles not in molecules and smiles in _transient:
+            _transient.move_to_end(smiles)
+            molecules[smiles] = _transient[smiles]
+    missing = [smiles for smiles in canonical_list if smiles not in molecules]
+    for mapping in compute_molecules(missing, n_process=n_process):
+        # not added to the session
+        molecules[mapping['smiles']] = _transient[mapping['smiles']] = MoleculeCache(**mapping)
+    while len(_transient) > TRANSIENT_SIZE:
+        _transient.popitem(last=False)
+    return {smiles: molecules[canonical] for smiles, canonical in canonical_dict.items()}
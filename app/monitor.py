@@ -0,0 +1,116 @@
+import asyncio
+import contextvars
+import inspect
+import traceback
+
+from flask import current_app
+
+from . import db
+from .cache import new_cycle
+
+
+class Stage:
+    '''
+    A Stage corresponds to one step of the high-throughput workflow, e.g. build, run, check, extend or post-process
+    Each stage runs as its own coroutine. It wakes up every `interval` seconds for a full pass,
+    or as soon as an upstream stage puts work (task ids) into its queue
+
+    func(items) is called with the list of queued items, or with None for a full pass
+    The returned items are handed to the downstream stages
+    A blocking func, which does not yield to the event loop, is run in a thread so that other stages keep their cadence
+    '''
+
+    def __init__(self, name, func, interval=1800, downstream=None, delay=5, blocking=False):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.downstream = downstream or []
+        self.delay = delay  # wait a few seconds after woken up, so that items arriving together are processed together
+        self.blocking = blocking
+        self.queue = None
+
+    def __repr__(self):
+        return '<Stage: %s %is>' % (self.name, self.interval)
+
+    async def get_items(self):
+        '''
+        Wait for queued items until timeout
+        :return: list of items, or None if timeout and a full pass is required
+        '''
+        try:
+            item = await asyncio.wait_for(self.queue.get(), timeout=self.interval)
+        except asyncio.TimeoutError:
+            return None
+
+        await asyncio.sleep(self.delay)
+        items = [item]
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item not in items:
+                items.append(item)
+        return items
+
+
+class Monitor:
+    '''
+    Event-driven monitor. The stages are executed concurrently in one event loop
+    Stage functions that are coroutines yield to the other stages between work items
+    '''
+
+    def __init__(self):
+        self.stages = {}
+
+    def add_stage(self, name, func, interval=1800, downstream=None, **kwargs):
+        self.stages[name] = Stage(name, func, interval=interval, downstream=downstream, **kwargs)
+        return self.stages[name]
+
+    def notify(self, name, items):
+        stage = self.stages.get(name)
+        if stage is None or stage.queue is None:
+            return
+        for item in items:
+            stage.queue.put_nowait(item)
+
+    @staticmethod
+    def _run_blocking(app, func, items):
+        '''
+        Run a blocking stage in a worker thread, with its own app context and database session
+        The session is committed and removed when the app context is torn down
+        '''
+        with app.app_context():
+            return func(items)
+
+    async def run_stage(self, stage):
+        items = None  # full pass at start up
+        while True:
+            try:
+                # values memoized by models are valid within one run of a stage
+                new_cycle()
+                if stage.blocking:
+                    # the context is copied, so that the thread sees the cycle of this stage
+                    output = await asyncio.get_event_loop().run_in_executor(
+                        None, contextvars.copy_context().run, self._run_blocking,
+                        current_app._get_current_object(), stage.func, items)
+                else:
+                    output = stage.func(items)
+                if inspect.isawaitable(output):
+                    output = await output
+            except Exception as e:
+                current_app.logger.error('Stage %s failed %s' % (stage.name, repr(e)))
+                traceback.print_exc()
+                # the session is shared by all stages on the loop. A failed flush or commit leaves it unusable
+                db.session.rollback()
+                db.session.remove()
+            else:
+                if output and stage.downstream:
+                    for name in stage.downstream:
+                        self.notify(name, output)
+            items = await stage.get_items()
+
+    async def _run(self):
+        for stage in self.stages.values():
+            stage.queue = asyncio.Queue()
+        await asyncio.gather(*[self.run_stage(stage) for stage in self.stages.values()])
+
+    def run(self):
+        asyncio.get_event_loop().run_until_complete(self._run())
@@ -0,0 +1,182 @@
+import json
+import os
+import time
+
+from flask import current_app
+from sqlalchemy import or_, and_
+
+from . import db
+from .models import *
+from .molecule import get_molecules
+from .jobmanager import generate_array_sh, sentinel_commands, split_cpu_commands, cpu_stage_commands, \
+    gpu_stage_commands, early_stop_commands
+
+
+def pack_jobs(jobs, n_slot, key, size, flush=False, tolerance=None):
+    '''
+    Pack jobs into bundles of n_slot jobs
+    Jobs are grouped by key(job), and jobs in one bundle have similar size(job)
+    :param flush: if False, bundles which are not full are held back
+    :param tolerance: largest relative difference of size(job) in one bundle. None means no limit
+                      A bundle is closed before a job larger than (1 + tolerance) times its smallest job
+    :return: list of bundles, each bundle is a list of jobs
+    '''
+    groups = {}
+    for job in jobs:
+        groups.setdefault(key(job), []).append(job)
+
+    bundles = []
+    for group in groups.values():
+        group.sort(key=size)
+        bundle = []
+        for job in group + [None]:
+            if job is not None and bundle != [] and len(bundle) < n_slot and \
+                    (tolerance is None or size(job) <= size(bundle[0]) * (1 + tolerance)):
+                bundle.append(job)
+                continue
+            if bundle != [] and (len(bundle) == n_slot or flush):
+                bundles.append(bundle)
+            bundle = [job]
+    return bundles
+
+
+def run_packed(procedure, flush=False) -> [int]:
+    '''
+    Fill -multidir GPU bundles with ready jobs from any task of the procedure
+    Jobs in one bundle share the same command template and have similar number of atoms
+    :param flush: submit partly empty bundles. Otherwise they wait for jobs from tasks built later
+    :return: id of tasks which have jobs submitted
+    '''
+    jm = current_app.jobmanager
+    if not jm.is_working():
+        current_app.logger.warning('JobManager not working')
+        return []
+    if jm.is_remote:
+        raise Exception('Remote jobmanager is not compatible with packed bundles')
+
+    n_slot = current_app.config['GMX_MULTI_NJOB']
+    n_bundle_limit = current_app.config['PBS_NJOB_LIMIT'] - jm.n_running_jobs
+    if n_bundle_limit <= 0:
+        current_app.logger.warning('PBS_NJOB_LIMIT reached')
+        return []
+
+    # tasks are running as soon as part of their jobs are submitted, the remaining jobs wait for next bundles
+    tasks = Task.query.filter(Task.procedure == procedure).filter(
+        or_(and_(Task.stage == Compute.Stage.BUILDING, Task.status == Compute.Status.DONE),
+            and_(Task.stage == Compute.Stage.RUNNING, Task.status == Compute.Status.STARTED))) \
+        .filter(Task.commands != None).all()
+    task_dict = {task.id: task for task in tasks}
+    jobs = Job.query.filter(Job.task_id.in_(task_dict.keys())).filter(Job.status == Compute.Status.STARTED) \
+        .filter(Job.cycle == 0).filter(Job.pbs_jobs_id == None).all()
+    # atoms of the molecules are read from molecule_cache, filled before the tasks were built
+    molecules = get_molecules([smiles for task in tasks for smiles in task.get_smiles_list()])
+    n_atoms_dict = {task.id: task.get_n_atoms(molecules) for task in tasks}
+    # the same commands may be serialized differently, e.g. by different versions of json
+    commands_dict = {task.id: json.dumps(json.loads(task.commands)) for task in tasks}
+
+    bundles = pack_jobs(jobs, n_slot, key=lambda job: commands_dict[job.task_id],
+                        size=lambda job: n_atoms_dict[job.task_id], flush=flush,
+                        tolerance=current_app.config.get('GMX_MULTI_PACK_TOLERANCE'))
+    bundles = bundles[:n_bundle_limit]
+    if bundles == []:
+        return []
+    current_app.logger.info('Run %i packed bundles of %i jobs' % (len(bundles), sum(map(len, bundles))))
+
+    run_dir = os.path.join(current_app.config['WORK_DIR'], procedure, 'run_sh')
+    os.makedirs(run_dir, exist_ok=True)
+    os.chdir(run_dir)
+    n = 1
+    while os.path.exists(os.path.join(run_dir, '_job.run-%i.sh' % (n))):
+        n += 1
+
+    if current_app.config['GMX_MULTI_NOMP'] is None:
+        n_tasks = None
+    else:
+        n_tasks = n_slot * current_app.config['GMX_MULTI_NOMP'] * jm.nprocs_request / jm.nprocs
+
+    def get_ngpu(njobs):
+        if current_app.config['PBS_ARGS'][0] != 'gtx':
+            return None
+        elif njobs % 2 == 0:
+            return 2
+        else:
+            return 1
+
+    sim = init_simulation(procedure)
+    cpu_stage = current_app.config.get('CPU_STAGE') and not current_app.config.get('GMX_MULTI_ARRAY')
+    commands_list = []
+    cpu_cmds_list = []
+    for bundle in bundles:
+        multi_dirs = [job.dir for job in bundle]
+        multi_cmds = json.loads(task_dict[bundle[0].task_id].commands)
+        cpu_cmds = []
+        if cpu_stage:
+            multi_cmds, cpu_cmds = split_cpu_commands(multi_cmds)
+        cpu_cmds_list.append(cpu_cmds)
+        bundle_commands_list = sim.gmx.generate_gpu_multidir_cmds(multi_dirs, multi_cmds, n_parallel=n_slot, n_gpu=jm.ngpu,
+                                                                  n_omp=current_app.config['GMX_MULTI_NOMP'])
+        commands_list += [early_stop_commands(commands, procedure, multi_dirs) for commands in bundle_commands_list]
+
+    pbs_jobs = []
+    if current_app.config.get('GMX_MULTI_ARRAY'):
+        # one job array for each GPU count, all elements of an array request the same resources
+        ngpu_groups = {}
+        for i, bundle in enumerate(bundles):
+            ngpu_groups.setdefault(get_ngpu(len(bundle)), []).append(i)
+        for k, (ngpu, indexes) in enumerate(ngpu_groups.items()):
+            # element j of the array runs bundle indexes[j]
+            sh = os.path.join(run_dir, '_job.run-%i.sh' % (n + k))
+            pbs_name = '%s-packed-run-%i' % (procedure, n + k)
+            array_commands_list = [commands_list[i] + sentinel_commands(
+                jm, [job.get_script_spec() for job in bundles[i]], pbs_name, index=j) for j, i in enumerate(indexes)]
+            generate_array_sh(jm, run_dir, array_commands_list, name=pbs_name, sh=sh, n_tasks=n_tasks, ngpu=ngpu)
+            pbs_job = PbsJob(name=pbs_name, sh_file=sh)
+            db.session.add(pbs_job)
+            db.session.flush()
+            array_jobs = {}
+            for j, i in enumerate(indexes):
+                for job in bundles[i]:
+                    job.pbs_jobs_id = json.dumps([pbs_job.id])
+                    array_jobs[str(job.id)] = [j]
+            pbs_job.array_jobs = json.dumps(array_jobs)
+            pbs_jobs.append(pbs_job)
+    else:
+        for i, bundle in enumerate(bundles):
+            sh = os.path.join(run_dir, '_job.run-%i.sh' % (n + i))
+            pbs_name = '%s-packed-run-%i' % (procedure, n + i)
+            specs = [job.get_script_spec() for job in bundle]
+            pbs_jobs_id = []
+            if cpu_cmds_list[i] != []:
+                # the CPU stage is submitted by the GPU stage, with afterok dependency
+                cpu_sh = os.path.join(run_dir, '_job.run-%i-cpu.sh' % (n + i))
+                cpu_name = '%s-packed-run-%i-cpu' % (procedure, n + i)
+                cpu_commands = cpu_stage_commands([job.dir for job in bundle], cpu_cmds_list[i],
+                                                  current_app.config['GMX_MDRUN'],
+                                                  current_app.config['CPU_GMX_MDRUN']) + \
+                               sentinel_commands(current_app.jm_cpu, specs, cpu_name)
+                current_app.jm_cpu.generate_sh(run_dir, cpu_commands, name=cpu_name, sh=cpu_sh)
+                cpu_pbs_job = PbsJob(name=cpu_name, sh_file=cpu_sh, cpu=True)
+                db.session.add(cpu_pbs_job)
+                db.session.flush()
+                pbs_jobs_id.append(cpu_pbs_job.id)
+                commands_list[i] += gpu_stage_commands(jm, current_app.jm_cpu, specs, pbs_name, cpu_sh)
+            else:
+                commands_list[i] += sentinel_commands(jm, specs, pbs_name)
+            jm.generate_sh(run_dir, commands_list[i], name=pbs_name, sh=sh, n_tasks=n_tasks, ngpu=get_ngpu(len(bundle)))
+            pbs_job = PbsJob(name=pbs_name, sh_file=sh)
+            db.session.add(pbs_job)
+            db.session.flush()
+            for job in bundle:
+                job.pbs_jobs_id = json.dumps([pbs_job.id] + pbs_jobs_id)
+            pbs_jobs.append(pbs_job)
+
+    run_ids = list(set([job.task_id for bundle in bundles for job in bundle]))
+    for task_id in run_ids:
+        task_dict[task_id].stage = Compute.Stage.RUNNING
+        task_dict[task_id].status = Compute.Status.STARTED
+    db.session.commit()
+
+    for pbs_job in pbs_jobs:
+        pbs_job.submit()
+        time.sleep(0.2)
+    return run_ids
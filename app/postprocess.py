@@ -0,0 +1,160 @@
+import json
+import math
+import os
+import traceback
+from multiprocessing import Pool
+
+import numpy as np
+from flask import current_app
+
+from config import Config
+
+GK_PROCEDURES = ['nvt-multi', 'nvt-multi-2', 'nvt-multi-3', 'npt-multi']
+# keys of the fitted standard deviation between repeats in the result of a state point,
+# for the properties in Config.REPEAT_TARGET_STDERR
+STDERR_KEYS = {'viscosity': 'vis_stderr', 'electrical conductivity': 'econ_stderr'}
+
+
+def post_process_state_point(spec) -> dict:
+    '''
+    Post-process the converged jobs of one state point
+    This function does not touch the database, so it can be called in a worker process
+    :param spec: generated by Task.get_post_process_specs()
+    :return: the result of the state point, which is fitted by sim.post_process() together with other state points
+    '''
+    from .gk import post_process_GK
+
+    results = [json.loads(job['result']) for job in spec['jobs']]
+    if spec['procedure'] not in GK_PROCEDURES:
+        return results[0]
+
+    t_p_dir = os.path.join(spec['dir'], '%i-%i' % (spec['t'], spec['p']))
+    dir_list = [job['dir'] for job in spec['jobs']]
+    viscosity, score1, stderr1 = post_process_GK(t_p_dir, dir_list, property='viscosity', return_stderr=True)
+    electrical_conductivity, score2, stderr2 = post_process_GK(t_p_dir, dir_list, property='electrical conductivity',
+                                                               return_stderr=True)
+
+    info_dict = {
+        'diffusion constant': {},  # {name: [diff, stderr]}
+        'Nernst-Einstein electrical conductivity': [],
+    }
+    for name in results[0].get('diffusion constant').keys():
+        info_dict.get('diffusion constant').update({name: []})
+    for result in results:
+        info_dict.get('Nernst-Einstein electrical conductivity').append(
+            result.get('Nernst-Einstein electrical conductivity')[0])
+        for name in result.get('diffusion constant').keys():
+            info_dict.get('diffusion constant').get(name).append(
+                result.get('diffusion constant').get(name)[0])
+    econ = np.array(info_dict.get('Nernst-Einstein electrical conductivity'))
+    info_dict['Nernst-Einstein electrical conductivity'] = [econ.mean(), econ.std()]
+    for name in info_dict.get('diffusion constant').keys():
+        diff = np.array(info_dict.get('diffusion constant').get(name))
+        info_dict.get('diffusion constant')[name] = [diff.mean(), diff.std()]
+
+    # too slow to use green-kubo method to calculate diffusion constants
+    if Config.DIFF_GK:
+        name_list = ['System'] + spec['mol_names']
+        diffusion_constant_score = {}
+        for name in name_list:
+            diff, s = post_process_GK(t_p_dir, dir_list, property='diffusion constant', name=name)
+            diffusion_constant_score.update({name: [diff, s]})
+        diffusion_constant_stderr = {}
+        for name in name_list:
+            diffusion_constant_list = [result['diffusion constant-gk'][name] for result in results]
+            diffusion_constant_stderr[name] = [np.mean(diffusion_constant_list), np.std(diffusion_constant_list)]
+        info_dict.update({
+            'diffusion constant-gk and score': diffusion_constant_score,  # {name: [diff, score]} # time-decomposition method
+            'diffusion constant-gk and stderr': diffusion_constant_stderr,  # {name: [diff, stderr]}
+        })
+
+    info_dict.update({
+        'viscosity': viscosity,
+        'vis_score': score1,
+        'vis_stderr': stderr1,
+        'electrical conductivity': electrical_conductivity,
+        'econ_score': score2,
+        'econ_stderr': stderr2,
+    })
+    return info_dict
+
+
+def post_process_worker(spec) -> dict:
+    result = {
+        'task_id'  : spec['task_id'],
+        't'        : spec['t'],
+        'p'        : spec['p'],
+        'result'   : None,
+        'exception': None,
+    }
+    try:
+        result['result'] = post_process_state_point(spec)
+    except Exception as e:
+        traceback.print_exc()
+        result['exception'] = repr(e)
+    return result
+
+
+def post_process_tasks(tasks, n_process=None) -> int:
+    '''
+    Post-process the state points changed since the last post-processing of each task
+    State points of all tasks are processed together in worker processes, the database is updated only in this process
+    :return: number of state points processed
+    '''
+    specs = []
+    for task in tasks:
+        specs += task.get_post_process_specs(tp_list=task.get_post_dirty())
+    n_process = n_process or Config.POST_PROCESS_NPROCS
+    if n_process > 1 and len(specs) > 1:
+        with Pool(min(n_process, len(specs))) as pool:
+            results = pool.map(post_process_worker, specs, chunksize=1)
+    else:
+        results = [post_process_worker(spec) for spec in specs]
+
+    state_results = {task.id: [] for task in tasks}
+    failed_dict = {task.id: [] for task in tasks}
+    for result in results:
+        if result['exception'] is not None:
+            current_app.logger.error('Post-process failed task %i t=%s p=%s %s' % (
+                result['task_id'], result['t'], result['p'], result['exception']))
+            failed_dict[result['task_id']].append((result['t'], result['p']))
+            continue
+        state_results[result['task_id']].append((result['t'], result['p'], result['result']))
+    for task in tasks:
+        try:
+            post_info = task.save_post_process(state_results[task.id], cached=True, failed_list=failed_dict[task.id])
+        except Exception as e:
+            current_app.logger.error('Post-process failed %s %s' % (task, repr(e)))
+            traceback.print_exc()
+        else:
+            if task.post_result is None:
+                current_app.logger.warning('Post-process not fitted %s %s' % (task, post_info))
+    return len(specs)
+
+
+def get_n_more_repeats(result, n_converged, n_repeat, n_max) -> int:
+    '''
+    Sequential stopping rule of adaptive repeats for one state point, see Config.ADAPTIVE_REPEAT
+    The stderr saved in the result is the standard deviation between repeats, fitted at the end of the integration
+    The standard error of the Green-Kubo average is std / sqrt(n), so Config.REPEAT_TARGET_STDERR is reached with
+    n = (std / value / target) ** 2 repeats, which does not depend on the number of repeats already run
+    :param result: the result of the state point from post_process_state_point()
+    :param n_converged: number of converged repeats used in the result
+    :param n_repeat: number of repeats inserted, converged or not
+    :param n_max: upper limit of repeats
+    :return: number of repeats to add, 0 to stop
+    '''
+    if n_repeat >= n_max or n_converged == 0:
+        return 0
+    n_target = n_converged
+    for property, target in Config.REPEAT_TARGET_STDERR.items():
+        value = result.get(property)
+        std = result.get(STDERR_KEYS[property])
+        if value is None or std is None or value == 0:
+            # the integral is not converged, a smoother average may be fitted with more repeats
+            n_target = max(n_target, n_converged + Config.REPEAT_BATCH)
+        else:
+            n_target = max(n_target, int(math.ceil((std / abs(value) / target) ** 2)))
+    if n_target <= n_converged:
+        return 0
+    return min(max(n_target - n_converged, Config.REPEAT_BATCH), n_max - n_repeat)
@@ -0,0 +1,189 @@
+import json
+
+import numpy as np
+
+from . import db
+from .models import Task, Job, Compute, JobProperty, TaskFit
+
+
+def query_job_property(procedure, property, converged=True, t=None, p=None) -> {str: np.ndarray}:
+    '''
+    A property of all analyzed jobs of a procedure in one SQL query
+    e.g. query_job_property('npt', 'density') returns the density at all converged state points
+    :param converged: only converged jobs
+    :param t, p: only jobs at this temperature or pressure
+    :return: dict of arrays with keys job_id, task_id, t, p, value, stderr, score. Missing stderr or score is nan
+    '''
+    query = db.session.query(JobProperty.job_id, Job.task_id, Job.t, Job.p,
+                             JobProperty.value, JobProperty.stderr, JobProperty.score) \
+        .join(Job, Job.id == JobProperty.job_id).join(Task, Task.id == Job.task_id) \
+        .filter(Task.procedure == procedure) \
+        .filter(JobProperty.property == property) \
+        .filter(Job.status == Compute.Status.ANALYZED)
+    if converged:
+        query = query.filter(Job.converged == True)
+    if t is not None:
+        query = query.filter(Job.t == t)
+    if p is not None:
+        query = query.filter(Job.p == p)
+    rows = query.order_by(JobProperty.job_id).all()
+
+    keys = ['job_id', 'task_id', 't', 'p', 'value', 'stderr', 'score']
+    data = np.array(rows, dtype=float).reshape(len(rows), len(keys))
+    arrays = {key: data[:, i] for i, key in enumerate(keys)}
+    for key in ['job_id', 'task_id']:
+        arrays[key] = arrays[key].astype(int)
+    return arrays
+
+
+def query_task_fit(procedure, property, min_score=None) -> {str: np.ndarray}:
+    '''
+    A fitted function of all tasks of a procedure in one SQL query
+    e.g. query_task_fit('npt', 'density-poly4', min_score=0.999)
+    :return: dict of arrays with keys task_id, score and coefficients
+             coefficients is a 2D array, shorter rows are padded with nan
+    '''
+    query = db.session.query(TaskFit.task_id, TaskFit.coefficients, TaskFit.score) \
+        .join(Task, Task.id == TaskFit.task_id) \
+        .filter(Task.procedure == procedure) \
+        .filter(TaskFit.property == property)
+    if min_score is not None:
+        query = query.filter(TaskFit.score >= min_score)
+    rows = query.order_by(TaskFit.task_id).all()
+
+    coefficients_list = [json.loads(coefficients) for task_id, coefficients, score in rows]
+    n_coef = max([len(coefficients) for coefficients in coefficients_list] + [0])
+    coefficients = np.full((len(rows), n_coef), np.nan)
+    for i, c in enumerate(coefficients_list):
+        coefficients[i, :len(c)] = c
+    return {
+        'task_id'     : np.array([row[0] for row in rows], dtype=int),
+        'score'       : np.array([row[2] for row in rows], dtype=float),
+        'coefficients': coefficients,
+    }
+
+
+POST_DATA_COLUMNS = ['density', 'einter', 'hvap', 'expansion', 'compress', 'cp_inter', 'cp_pv']
+
+
+def _poly_exponents(n_coef, degree) -> [(int, int)]:
+    '''
+    Exponents of T and P of each coefficient of a polynomial fit
+    2D fit of T and P: 1, T, P, T^2, TP, P^2, T^3, ... (the order of PolynomialFeatures)
+    1D fit of T: T^degree, ..., T, 1 (the order of numpy.polyfit)
+    '''
+    if n_coef == (degree + 1) * (degree + 2) // 2:
+        return [(i - j, j) for i in range(degree + 1) for j in range(i + 1)]
+    elif n_coef == degree + 1:
+        return [(degree - i, 0) for i in range(degree + 1)]
+    raise Exception('%i coefficients do not match a polynomial of degree %i' % (n_coef, degree))
+
+
+def polyval_derivative(coefficients, T, P, degree):
+    '''
+    Evaluate polynomial fits of many tasks on a grid of state points in one vectorized call
+    :param coefficients: array of shape (n_task, n_coef)
+    :param T, P: arrays of shape (n_point,)
+    :return: value, d/dT, d/dP. Arrays of shape (n_task, n_point)
+    '''
+    exponents = np.array(_poly_exponents(coefficients.shape[1], degree))
+    a = exponents[:, 0][:, None]
+    b = exponents[:, 1][:, None]
+    T = np.asarray(T, dtype=float)[None, :]
+    P = np.asarray(P, dtype=float)[None, :]
+    terms = T ** a * P ** b  # (n_coef, n_point)
+    terms_dT = a * T ** np.maximum(a - 1, 0) * P ** b
+    terms_dP = b * T ** a * P ** np.maximum(b - 1, 0)
+    return coefficients @ terms, coefficients @ terms_dT, coefficients @ terms_dP
+
+
+def get_post_data_table(tasks, TP_list, degree=4, rtol=1e-6):
+    '''
+    Task.get_post_data() of many tasks on the same (T, P) grid, evaluated as NumPy arrays
+    The density and einter fits of all tasks are loaded from task_fit in one query per 500 tasks,
+    and evaluated with their T and P derivatives for all points in a few matrix products
+    The constants of hvap and cp_pv specific to a task, e.g. molar mass, are calibrated with Task.get_post_data()
+    at one point of the grid. Each task is then checked against get_post_data() at another point,
+    tasks which do not agree within rtol are evaluated point by point with Task.get_post_data_list()
+    Tasks without post_result are skipped
+    :param TP_list: [(T, P)], the same grid for all tasks
+    :return: DataFrame with columns task_id, T, P and POST_DATA_COLUMNS. Missing values are nan
+             The number of tasks evaluated point by point is in attrs['n_fallback']
+    '''
+    import pandas as pd
+
+    tasks = [task for task in tasks if task.post_result is not None]
+    task_index = {task.id: i for i, task in enumerate(tasks)}
+    T = np.array([tp[0] for tp in TP_list], dtype=float)
+    P = np.array([tp[1] or 0 for tp in TP_list], dtype=float)
+    n_task, n_point = len(tasks), len(TP_list)
+
+    # {property: {n_coef: (task rows, coefficient rows)}}, tasks with the same shape of fit are evaluated together
+    fits = {'density-poly%i' % degree: {}, 'einter-poly%i' % degree: {}}
+    task_ids = list(task_index.keys())
+    for i in range(0, len(task_ids), 500):
+        for task_id, property, coefficients in db.session.query(TaskFit.task_id, TaskFit.property, TaskFit.coefficients) \
+                .filter(TaskFit.task_id.in_(task_ids[i:i + 500])).filter(TaskFit.property.in_(fits.keys())):
+            coefficients = json.loads(coefficients)
+            rows = fits[property].setdefault(len(coefficients), ([], []))
+            rows[0].append(task_index[task_id])
+            rows[1].append(coefficients)
+
+    def evaluate(property):
+        value, dT, dP = [np.full((n_task, n_point), np.nan) for i in range(3)]
+        for n_coef, (rows, coefficients) in fits[property].items():
+            try:
+                v, t, p = polyval_derivative(np.array(coefficients), T, P, degree)
+            except Exception:
+                continue
+            value[rows], dT[rows], dP[rows] = v, t, p
+        return value, dT, dP
+
+    density, dDdT, dDdP = evaluate('density-poly%i' % degree)
+    einter, dEdT, dEdP = evaluate('einter-poly%i' % degree)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table = {
+            'density'  : density,  # g/mL
+            'einter'   : einter,  # kJ/mol
+            'hvap'     : np.full((n_task, n_point), np.nan),  # kJ/mol, c * T - einter
+            'expansion': -1 / density * dDdT,  # 1/K
+            'compress' : 1 / density * dDdP,  # 1/bar
+            'cp_inter' : dEdT * 1000,  # J/mol.K
+            'cp_pv'    : np.full((n_task, n_point), np.nan),  # J/mol.K, c * P / density^2 * dD/dT
+        }
+        pv = P[None, :] / density ** 2 * dDdT
+
+    # calibrate at a point with non-zero pressure, check at the last point
+    i_ref = next((i for i in range(n_point) if P[i] != 0), 0)
+    check_list = [i_ref] + ([n_point - 1] if n_point - 1 != i_ref else [])
+    n_fallback = 0
+    for i, task in enumerate(tasks):
+        if n_point == 0:
+            break
+        ref_list = task.get_post_data_list([TP_list[k] for k in check_list])
+        try:
+            ref = ref_list[0]
+            c_hvap = (float(ref['hvap']) + einter[i, i_ref]) / T[i_ref]
+            c_pv = float(ref['cp_pv']) / pv[i, i_ref] if pv[i, i_ref] != 0 else 0.
+            table['hvap'][i] = c_hvap * T - einter[i]
+            table['cp_pv'][i] = c_pv * pv[i]
+            agree = all(np.isclose(table[column][i, k], float(post_data[column]), rtol=rtol, atol=0)
+                        for k, post_data in zip(check_list, ref_list) for column in POST_DATA_COLUMNS)
+        except Exception:
+            agree = False
+        if not agree:
+            n_fallback += 1
+            post_data_list = task.get_post_data_list(TP_list)
+            for column in POST_DATA_COLUMNS:
+                table[column][i] = [np.nan if post_data.get(column) is None else post_data[column]
+                                    for post_data in post_data_list]
+
+    df = pd.DataFrame({
+        'task_id': np.repeat([task.id for task in tasks], n_point).astype(int),
+        'T'      : np.tile(T, n_task),
+        'P'      : np.tile(P, n_task),
+    })
+    for column in POST_DATA_COLUMNS:
+        df[column] = np.ravel(table[column])
+    df.attrs['n_fallback'] = n_fallback
+    return df
@@ -222,9 +222,11 @@ def task_selection(task, select=True, rule='not select'):
             return False
     smiles_list = json.loads(task.smiles_list)
     if ring is not None:
+        from .molecule import get_molecules
+        molecules = get_molecules(smiles_list)
         ring_number = 0
         for smiles in smiles_list:
-            ring_number += get_ring_number(smiles)
+            ring_number += molecules[smiles].n_ring
         if (ring and ring_number == 0) or (not ring and ring_number > 0):
             return False
     return True
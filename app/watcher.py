@@ -0,0 +1,81 @@
+import asyncio
+import os
+
+from sqlalchemy.orm import joinedload
+
+from .jobmanager import get_spool_dir
+from .models import Job, Compute
+
+
+class CompletionWatcher:
+    '''
+    Watch the spool directory where job scripts put the id of finished jobs, see jobmanager.sentinel_commands()
+    Linux inotify is used if inotify_simple is installed, so that finished jobs are reported as soon as they exit
+    inotify misses files written by other hosts on network filesystems, so the spool is also scanned periodically
+    '''
+
+    def __init__(self, procedure):
+        self.spool_dir = get_spool_dir(procedure)
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._inotify = None
+        self.started = False
+
+    def __repr__(self):
+        return '<CompletionWatcher: %s %s>' % (self.spool_dir, 'inotify' if self._inotify else 'scan')
+
+    def start(self, callback) -> bool:
+        '''
+        Call callback(job_ids) from the running event loop whenever inotify reports new spool entries
+        :return: False if inotify is not available, then only scan() works
+        '''
+        self.started = True
+        try:
+            from inotify_simple import INotify, flags
+            inotify = INotify()
+            inotify.add_watch(self.spool_dir, flags.CLOSE_WRITE | flags.MOVED_TO)
+        except Exception:
+            return False
+        self._inotify = inotify
+
+        def on_readable():
+            job_ids = [int(event.name) for event in self._inotify.read(timeout=0) if event.name.isdigit()]
+            if job_ids != []:
+                callback(job_ids)
+
+        asyncio.get_event_loop().add_reader(self._inotify.fd, on_readable)
+        return True
+
+    def scan(self) -> [int]:
+        return [int(name) for name in os.listdir(self.spool_dir) if name.isdigit()]
+
+    def consume(self, job_ids):
+        '''
+        Remove the spool entries of jobs which are taken by the monitor
+        '''
+        for job_id in job_ids:
+            try:
+                os.remove(os.path.join(self.spool_dir, str(job_id)))
+            except OSError:
+                pass
+
+
+def check_sentinel_jobs(job_ids) -> [int]:
+    '''
+    Check the jobs reported by completion sentinels, and send the finished ones to the analysis pool
+    The job manager is not queried if the sentinels of all PBS jobs of a job are written
+    :return: id of tasks which have jobs sent to the analysis pool
+    '''
+    from .analyze import get_analysis_pool
+
+    jobs = []
+    for i in range(0, len(job_ids), 500):
+        jobs += Job.query.options(joinedload(Job.task)).filter(Job.id.in_(job_ids[i:i + 500])) \
+            .filter(Job.status == Compute.Status.STARTED).all()
+    Job.check_finished_jobs(jobs)
+
+    pool = get_analysis_pool()
+    task_ids = []
+    for job in jobs:
+        if job.status == Compute.Status.DONE and pool.submit(job) and job.task_id not in task_ids:
+            task_ids.append(job.task_id)
+    return task_ids
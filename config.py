@@ -11,6 +11,15 @@ class Config:
     }
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
     SQLALCHEMY_TRACK_MODIFICATIONS = True
+    # WAL lets readers and the writer work at the same time, but it needs shared memory between the processes
+    # It is not safe if the database is accessed from several hosts through a network filesystem (NFS, Lustre)
+    # Set 'WAL' only if all processes run on the host which holds the database. None keeps the mode of the file
+    # The mode is stored in the database file, set 'DELETE' to turn WAL off again
+    SQLITE_JOURNAL_MODE = None
+    SQLITE_SYNCHRONOUS = None  # 'NORMAL' is safe with WAL and much faster than the default 'FULL'
+    SQLITE_BUSY_TIMEOUT = 60  # seconds. Wait for the lock instead of raising "database is locked"
+    SQLITE_POOL_SIZE = 5  # connection pool of each bind
+    SQLITE_POOL_OVERFLOW = 10
 
     MS_TOOLS_DIR = os.path.join(CWD, '..', 'AIMS_Tools')
     WORK_DIR = os.path.join(CWD, 'SimulationData')
@@ -34,8 +43,44 @@ class Config:
     LJ96 = False  # using LJ 9-6 non-bonded potential
     DIFF_GK = False  # using green-kubo method to calculate the diffusion constant. (Expensive, not suggest)
     DEBUG = False  # if true: do not delete the trajectory file in analyze process.
+    SERIES_CACHE = True  # cache time series parsed from text files as .npy in job directories, for post-processing
 
     EXTEND_CYCLE_LIMIT = 20
+    BUILD_NPROCS = 8  # number of worker processes for building tasks in monitor.py
+    BUILD_TIMEOUT = 3600  # seconds. A build (DFF typing, Packmol packing, job preparation) taking longer is failed
+    ANALYSIS_NPROCS = 8  # number of worker processes for analyzing finished jobs, shared by all tasks
+    MOLECULE_NPROCS = 8  # number of worker processes for filling molecule_cache
+    POST_PROCESS_NPROCS = 8  # number of worker processes for post-processing state points in monitor.py
+    # start GK procedures with REPEAT_BATCH repeats for each state point, and add more after each post-processing
+    # until the relative stderr of the properties reaches REPEAT_TARGET_STDERR, or REPEAT_NUMBER repeats are inserted
+    ADAPTIVE_REPEAT = False
+    REPEAT_BATCH = 16
+    REPEAT_TARGET_STDERR = {'viscosity': 0.05, 'electrical conductivity': 0.05}
+    JOB_SENTINEL = True  # job scripts write a completion sentinel, finished jobs are analyzed without polling scheduler
+    INSITU_ANALYSIS = False  # analyze jobs on the compute node at the end of job scripts. Requires JOB_SENTINEL
+    INSITU_PYTHON = sys.executable  # python on the compute node for in-situ analysis
+    # stop MD on the compute node once the energy file is converged, see run/early-stop.py. {procedure: settings}
+    # name: deffnm of the production run. properties: terms of gmx energy checked for convergence
+    # n_extend, extend: extend not converged runs in place at most n_extend times, by extend ps each time
+    # e.g. {'npt': {'name': 'npt', 'properties': ['Density', 'Potential'], 'n_extend': 2, 'extend': 1000}}
+    EARLY_STOP = {}
+    EARLY_STOP_INTERVAL = 600  # seconds between two reads of the energy file
+    # seconds. The state of all PBS jobs is queried once and reused within this time. Keep it below the check cadence
+    # stages which submit jobs (run, extend, bugfix) query again at their start, and every submission expires it
+    PBS_SNAPSHOT_TTL = 300
+
+    # cadence (seconds) of each stage in monitor.py
+    # a stage is also woken up as soon as its upstream stage hands over tasks
+    MONITOR_INTERVALS = {
+        'submit'      : 300,
+        'build'       : 600,
+        'run'         : 600,
+        'check'       : 600,
+        'analyze'     : 60,
+        'watch'       : 60,  # scan of the sentinel spool. With inotify, finished jobs are picked up at once
+        'extend'      : 1800,
+        'post_process': 1800,
+    }
 
     @classmethod
     def init_app(cls, app):
@@ -44,13 +89,14 @@ class Config:
         from mstools.wrapper.gmx import GMX
         from mstools.wrapper.dff import DFF
         from mstools.wrapper.packmol import Packmol
+        from app.jobmanager import LocalJobManager
 
         app.gmx = GMX(gmx_bin=cls.GMX_BIN, gmx_mdrun=cls.GMX_MDRUN)
         app.gmx_extend = GMX(gmx_bin=cls.EXTEND_GMX_BIN, gmx_mdrun=cls.EXTEND_GMX_MDRUN)
         app.dff = DFF(dff_root=cls.DFF_ROOT, default_table=cls.DFF_TABLE)
         app.packmol = Packmol(cls.PACKMOL_BIN)
 
-        _pbs_dict = {'slurm': Slurm, 'remote_slurm': RemoteSlurm, 'torque': Torque}
+        _pbs_dict = {'slurm': Slurm, 'remote_slurm': RemoteSlurm, 'torque': Torque, 'local': LocalJobManager}
         # run
         PBS = _pbs_dict[cls.PBS_MANAGER]
         jobmanager = PBS(*cls.PBS_ARGS, **cls.PBS_KWARGS)
@@ -80,9 +126,23 @@ class Config:
         if jm_bugfix.is_remote:
             raise Exception('Remote jobmanager is not compatible with bugfix')
 
+        # CPU stage after MD
+        jm_cpu = None
+        if getattr(cls, 'CPU_STAGE', False):
+            PBS = _pbs_dict[cls.CPU_PBS_MANAGER]
+            jm_cpu = PBS(*cls.CPU_PBS_ARGS, **cls.CPU_PBS_KWARGS)
+            if hasattr(cls, 'CPU_PBS_SUBMIT_CMD'):
+                jm_cpu.submit_cmd = cls.CPU_PBS_SUBMIT_CMD
+            if hasattr(cls, 'CPU_PBS_TIME_LIMIT'):
+                jm_cpu.time = cls.CPU_PBS_TIME_LIMIT
+            # the GPU stage submits the CPU stage with sbatch --dependency=afterok:$SLURM_JOB_ID
+            if cls.PBS_MANAGER != 'slurm' or cls.CPU_PBS_MANAGER != 'slurm':
+                raise Exception('CPU stage is only supported with slurm for both GPU and CPU stages')
+
         app.jobmanager = jobmanager
         app.jm_extend = jm_extend
         app.jm_bugfix = jm_bugfix
+        app.jm_cpu = jm_cpu
 
 
 class ClassificationConfig:
@@ -98,13 +158,16 @@ class SunRunConfig:
     Make sure that the version of GMX_BIN and GMX_MDRUN are the same
     '''
     PBS_NJOB_LIMIT = 100
-    PBS_MANAGER = 'slurm'
+    PBS_MANAGER = 'slurm'  # slurm, torque, remote_slurm. Use local to test without a cluster
     # Use GPU 
     PBS_ARGS = ('gtx', 32, 2, 16)  # partition, cpu(hyperthreading), gpu, cpu_request
     GMX_MDRUN = 'gmx_gpu mdrun'
     GMX_MULTI = True
     GMX_MULTI_NJOB = 8  # Use -multidir function of GROMACS. For Npt simulation, set it to 8. For NvtSlab simulation, 4 is better
     GMX_MULTI_NOMP = None  # Set the OpenMP threads. When set to None, use only one node and the best number of threads is automatically determined
+    GMX_MULTI_ARRAY = False  # Submit all -multidir bundles of a task as one Slurm job array
+    GMX_MULTI_PACK = False  # Fill -multidir bundles with jobs from different tasks, so that GPU nodes run full bundles
+    GMX_MULTI_PACK_TOLERANCE = 0.2  # largest relative difference of the number of atoms of the jobs in one packed bundle
 
     # Use CPU
     # PBS_ARGS = ('cpu', 8, 0, 8)  # partition, cpu(hyperthreading), gpu, cpu_request
@@ -124,6 +187,15 @@ class SunRunConfig:
     PBS_TIME_LIMIT = 240  # hour
     GMX_BIN = '/share/apps/gromacs/2018.6/bin/gmx_serial'
 
+    # Run the CPU-only steps after MD (hvap rerun of npt) as jobs in CPU partition, which depend on the GPU jobs
+    # Only for -multidir bundles not submitted as job array. Requires slurm
+    CPU_STAGE = False
+    CPU_PBS_MANAGER = 'slurm'
+    CPU_PBS_ARGS = ('cpu', 8, 0, 8)  # partition, cpu(hyperthreading), gpu, cpu_request
+    CPU_PBS_KWARGS = {'env_cmd': 'module purge; module load icc gromacs/2018.6'}
+    CPU_PBS_TIME_LIMIT = 24  # hour
+    CPU_GMX_MDRUN = 'gmx_serial mdrun'
+
 
 class SunExtendConfig:
     '''
@@ -137,6 +209,7 @@ class SunExtendConfig:
     EXTEND_GMX_MDRUN = 'gmx_gpu mdrun'
     EXTEND_GMX_MULTI = True
     EXTEND_GMX_MULTI_NJOB = 8
+    EXTEND_GMX_MULTI_ARRAY = False  # Submit all -multidir bundles of an extend round as one Slurm job array
 
     # Use CPU
     # EXTEND_PBS_ARGS = ('cpu', 8, 0, 8)
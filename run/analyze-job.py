@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+'''
+Analyze a finished job on the compute node, and write result.json into the job directory
+Appended to job scripts by jobmanager.sentinel_commands() when Config.INSITU_ANALYSIS is set
+The monitor ingests result.json instead of analyzing the job on the login node
+No app is created on the compute node. Only the tools of the config are set up, the databases and log are not touched
+Usage: analyze-job.py procedure job_dir cycle analyze_kwargs_json
+'''
+
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from config import configs
+from app.models import analyze_job, init_simulation
+from app.jobmanager import INSITU_RESULT
+
+
+def main():
+    procedure, job_dir, cycle, kwargs = sys.argv[1], sys.argv[2], int(sys.argv[3]), json.loads(sys.argv[4])
+    tools = SimpleNamespace()
+    configs[procedure].init_app(tools)
+    sim = init_simulation(procedure, app=tools)
+
+    return_dict = analyze_job(job_dir, procedure, sim=sim, **kwargs)
+    return_dict['cycle'] = cycle
+    # written to a temporary file first, the monitor never reads a partial result
+    f_result = os.path.join(job_dir, INSITU_RESULT)
+    with open(f_result + '.tmp', 'w') as f:
+        json.dump(return_dict, f)
+    os.replace(f_result + '.tmp', f_result)
+
+
+if __name__ == '__main__':
+    main()
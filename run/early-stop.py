@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+'''
+On-node convergence watcher of MD runs, inserted into job scripts by jobmanager.early_stop_commands()
+watch:  read the new frames of the energy file of each job every Config.EARLY_STOP_INTERVAL seconds
+        once all jobs are converged, mdrun is sent SIGINT. It writes a checkpoint and exits as a normal finished run
+extend: after mdrun exits, extend the runs which are not converged with convert-tpr
+        exit 0 if any run is extended and mdrun should continue from checkpoint, otherwise exit 1
+        The whole -multidir bundle is restarted from checkpoint, and watched again. Converged runs are not extended
+        A run which reached nsteps exits at once. A run stopped early by the watcher was stopped because all runs
+        were converged, which is re-checked here. If the check disagrees, the run continues toward nsteps
+        until the watcher of the new segment stops the bundle
+GROMACS is taken from the config of the procedure, the same as the job script
+The convergence is judged with the same criterion as the analysis, mstools.analyzer.series.is_converged()
+Usage: early-stop.py watch|extend procedure job_dir [job_dir ...]
+'''
+
+import os
+import signal
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from config import Config, configs
+
+sys.path.append(Config.MS_TOOLS_DIR)
+import pandas as pd
+from mstools.analyzer.series import is_converged
+
+
+class EnergySeries:
+    '''
+    Terms of the energy file of a job. Only the frames after the last read are parsed in each update
+    '''
+
+    def __init__(self, job_dir, name, properties, gmx_bin):
+        self.job_dir = job_dir
+        self.gmx_bin = gmx_bin
+        self.name = name
+        self.properties = properties
+        self.time_list = []
+        self.data_list = [[] for property in properties]
+
+    def __repr__(self):
+        return '<EnergySeries: %s %i frames>' % (self.job_dir, len(self.time_list))
+
+    def update(self):
+        edr = os.path.join(self.job_dir, '%s.edr' % self.name)
+        if not os.path.exists(edr):
+            return
+        xvg = os.path.join(self.job_dir, '_early_stop.xvg')
+        cmd = [self.gmx_bin, 'energy', '-f', edr, '-o', xvg]
+        if self.time_list != []:
+            cmd += ['-b', str(self.time_list[-1])]
+        subprocess.run(cmd, input='\n'.join(self.properties) + '\n\n', universal_newlines=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if not os.path.exists(xvg):
+            return
+        with open(xvg) as f:
+            for line in f:
+                if line.startswith(('#', '@')):
+                    continue
+                words = line.split()
+                t = float(words[0])
+                if len(words) < len(self.properties) + 1 or (self.time_list != [] and t <= self.time_list[-1]):
+                    continue
+                self.time_list.append(t)
+                for i in range(len(self.properties)):
+                    self.data_list[i].append(float(words[i + 1]))
+        os.remove(xvg)
+
+    def is_converged(self) -> bool:
+        if len(self.time_list) < 10:
+            return False
+        for data in self.data_list:
+            converged, when = is_converged(pd.Series(data, index=self.time_list))
+            if not converged:
+                return False
+        return True
+
+    def is_finished(self) -> bool:
+        log = os.path.join(self.job_dir, '%s.log' % self.name)
+        if not os.path.exists(log):
+            return False
+        with open(log, 'rb') as f:
+            f.seek(max(os.path.getsize(log) - 1000, 0))
+            return b'Finished mdrun' in f.read()
+
+
+def find_mdrun(job_dirs) -> [int]:
+    '''
+    Processes of mdrun owned by this user, running in one of the job directories or with them in the command line
+    '''
+    pids = []
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            if os.stat('/proc/%s' % pid).st_uid != os.getuid():
+                continue
+            with open('/proc/%s/cmdline' % pid, 'rb') as f:
+                cmdline = f.read().replace(b'\0', b' ').decode(errors='ignore')
+            cwd = os.readlink('/proc/%s/cwd' % pid)
+        except OSError:
+            continue
+        if 'mdrun' in cmdline and (cwd in job_dirs or any(job_dir in cmdline for job_dir in job_dirs)):
+            pids.append(int(pid))
+    return pids
+
+
+def watch(settings, job_dirs, gmx_bin):
+    series_list = [EnergySeries(job_dir, settings['name'], settings['properties'], gmx_bin) for job_dir in job_dirs]
+    while True:
+        time.sleep(Config.EARLY_STOP_INTERVAL)
+        if all(series.is_finished() for series in series_list):
+            return
+        for series in series_list:
+            series.update()
+        # -multidir runs all jobs in one mdrun, which can be stopped only if all of them are converged
+        if all(series.is_converged() for series in series_list):
+            for pid in find_mdrun(job_dirs):
+                os.kill(pid, signal.SIGINT)
+            return
+
+
+def extend(settings, job_dirs, gmx_bin) -> bool:
+    extended = False
+    for job_dir in job_dirs:
+        series = EnergySeries(job_dir, settings['name'], settings['properties'], gmx_bin)
+        series.update()
+        if series.is_converged():
+            continue
+        tpr = os.path.join(job_dir, '%s.tpr' % settings['name'])
+        subprocess.run([gmx_bin, 'convert-tpr', '-s', tpr, '-extend', str(settings['extend']), '-o', tpr],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        extended = True
+    return extended
+
+
+if __name__ == '__main__':
+    mode, procedure, job_dirs = sys.argv[1], sys.argv[2], [os.path.abspath(d) for d in sys.argv[3:]]
+    settings = Config.EARLY_STOP[procedure]
+    gmx_bin = configs[procedure].GMX_BIN
+    if mode == 'watch':
+        watch(settings, job_dirs, gmx_bin)
+    elif mode == 'extend':
+        sys.exit(0 if extend(settings, job_dirs, gmx_bin) else 1)
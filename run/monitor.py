@@ -2,11 +2,21 @@
 # coding=utf-8
 
 import os, sys, time
+import asyncio
 from sqlalchemy import func, or_
 
 sys.path.append('..')
 from app import create_app
 from app.models import *
+from app.monitor import Monitor
+from app.build import BuildExecutor
+from app.analyze import get_analysis_pool
+from app.packer import run_packed
+from app.extend import ExtendPlan
+from app.postprocess import post_process_tasks
+from app.molecule import update_molecule_cache
+from app.watcher import CompletionWatcher, check_sentinel_jobs
+from app.jobmanager import get_snapshot, generate_array_sh, sentinel_commands
 
 
 # necessary functions
@@ -18,54 +28,128 @@ def detect_exit():
         sys.exit()
 
 
-def process_pbs_job(n_pbs=20):
-    for pbs_job in PbsJob.query.filter(PbsJob.submitted == False).limit(n_pbs):
+async def process_pbs_job(task_ids=None, n_pbs=20):
+    # the CPU stage is submitted by its GPU stage, not here
+    for pbs_job in PbsJob.query.filter(PbsJob.submitted == False).filter(PbsJob.cpu == False).limit(n_pbs):
         detect_exit()
         pbs_job.submit()
+        await asyncio.sleep(0)
 
 
-def process_task_build(n_task=20, random=False):
+async def process_task_build(task_ids=None, n_task=20, random=False):
+    '''
+    Tasks are built in worker processes. Other stages keep running while waiting for the builds
+    :return: id of tasks which are built and ready to run
+    '''
     tasks = Task.query.filter(Task.stage == Compute.Stage.SUBMITTED).filter(Task.status == Compute.Status.DONE).filter(
         Task.procedure == procedure)
+    if task_ids is not None:
+        tasks = tasks.filter(Task.id.in_(task_ids))
     if random:
         tasks = tasks.order_by(func.random())
-    for task in tasks.limit(n_task):
+    detect_exit()
+    tasks = tasks.limit(n_task).all()
+    # molecules of new tasks are cached here, so that read paths like Task.get_charge_list() find them
+    update_molecule_cache([smiles for task in tasks for smiles in task.get_smiles_list()])
+    builder.dispatch(tasks)
+    built_ids = []
+    while builder.n_pending > 0:
+        await asyncio.sleep(5)
+        built_ids += builder.collect()
+    return built_ids
+
+
+async def process_task_run(task_ids=None, n_task=20, random=False):
+    '''
+    :return: id of tasks which are submitted
+    '''
+    # jobs are submitted from a fresh queue state, not from a snapshot of the last check
+    get_snapshot(app.jobmanager, refresh=True)
+    if app.config.get('GMX_MULTI_PACK'):
+        # jobs of all ready tasks are packed into full bundles
+        # partly empty bundles are submitted only if no task is waiting for build
+        n_building = Task.query.filter(Task.procedure == procedure).filter(
+            or_(Task.stage == Compute.Stage.SUBMITTED, Task.status == Compute.Status.STARTED)) \
+            .filter(Task.stage != Compute.Stage.RUNNING).count()
         detect_exit()
-        task.build()
-        if task.stage == Compute.Stage.BUILDING and task.status == Compute.Status.DONE:
-            task.run()
+        return run_packed(procedure, flush=n_building == 0)
 
-
-def process_task_run(n_task=20, random=False):
     tasks = Task.query.filter(Task.stage == Compute.Stage.BUILDING).filter(Task.status == Compute.Status.DONE).filter(
         Task.procedure == procedure)
+    if task_ids is not None:
+        tasks = tasks.filter(Task.id.in_(task_ids))
     if random:
         tasks = tasks.order_by(func.random())
-    for task in tasks.limit(n_task):
+    run_ids = []
+    for task in tasks.limit(n_task).all():
         detect_exit()
         if task.run() == -1:
             break
+        run_ids.append(task.id)
+        await asyncio.sleep(0)
+    return run_ids
 
 
-def process_task_check(n_task=20):
-    app.jobmanager.update_stored_jobs()
-    app.jm_extend.update_stored_jobs()
+async def process_task_check(task_ids=None, n_task=20):
+    '''
+    Finished jobs are sent to the analysis pool, the results are collected by process_analyze()
+    :return: id of tasks which have jobs being analyzed
+    '''
+    # one squeue/qstat call per job manager for this cycle
+    get_snapshot(app.jobmanager, refresh=True)
+    get_snapshot(app.jm_extend, refresh=True)
+    for pbs_job in PbsJob.query.filter(PbsJob.submitted == True).filter(PbsJob.array_jobs != None) \
+            .filter(or_(PbsJob.array_state == None, PbsJob.array_state != '{}')):
+        pbs_job.update_array_state()
+    db.session.commit()
     tasks = Task.query.filter(Task.stage == Compute.Stage.RUNNING).filter(Task.status == Compute.Status.STARTED) \
-        .filter(Task.procedure == procedure).limit(n_task)
-    for task in tasks:
-        detect_exit()
-        task.check_finished_multiprocessing()
-
-
-def process_extend(n_job=None):
-    jobs_extend_tmp = Job.query.filter(Job.status == Compute.Status.ANALYZED).filter(Job.converged == False) \
-        .filter(Job.cycle < Config.EXTEND_CYCLE_LIMIT)
-    jobs_extend = []
-    for job in jobs_extend_tmp:
-        if job.task.procedure == procedure and job.result is not None:
-            jobs_extend.append(job)
-    if n_job is not None and len(jobs_extend) > n_job:
-        jobs_extend = jobs_extend[0:n_job]
+        .filter(Task.procedure == procedure)
+    if task_ids is not None:
+        tasks = tasks.filter(Task.id.in_(task_ids))
+    detect_exit()
+    tasks = tasks.limit(n_task).all()
+    current_app.logger.info('Check status of %i tasks' % len(tasks))
+    # jobs of all tasks are checked with a fixed number of queries
+    return Task.check_finished_tasks(tasks, wait=False)
+
+
+async def process_watch(job_ids=None):
+    '''
+    Jobs reported by completion sentinels are checked and sent to the analysis pool at once
+    Without inotify, or for a full pass, the spool directory is scanned
+    '''
+    if not watcher.started:
+        watcher.start(lambda ids: monitor.notify('watch', ids))
+    if job_ids is None:
+        job_ids = watcher.scan()
+    if job_ids == []:
+        return []
+    watcher.consume(job_ids)
+    current_app.logger.info('Check %i jobs with completion sentinel' % len(job_ids))
+    return check_sentinel_jobs(job_ids)
+
+
+async def process_analyze(task_ids=None):
+    '''
+    Save the analysis results as soon as they come back from the analysis pool
+    Tasks with new analyzed jobs are handed to extend and post-process stages
+    No stage hands tasks to this stage. All results in the pool are collected on its own cadence, task_ids is not used
+    '''
+    pool = get_analysis_pool()
+    while True:
+        analyzed_ids = pool.collect()
+        if analyzed_ids:
+            monitor.notify('extend', analyzed_ids)
+            monitor.notify('post_process', analyzed_ids)
+        if pool.n_pending == 0:
+            break
+        await asyncio.sleep(10)
+
+
+def process_extend(task_ids=None, n_job=None):
+    get_snapshot(current_app.jm_extend, refresh=True)
+    extend_plan = ExtendPlan(procedure, n_job=n_job)
+    jobs_extend = extend_plan.jobs
     current_app.logger.info('Extend all jobs')
     if not current_app.jm_extend.is_working():
         current_app.logger.warning('JobManager not working')
@@ -78,20 +162,9 @@ def process_extend(n_job=None):
             current_app.logger.warning('%i job need extend' % (len(jobs_extend)))
             return
 
-        name_list = json.loads(jobs_extend[0].result).get('name')
-        extend_jobs_dict = {}
-        for name in name_list:
-            extend_jobs_dict.update({name: {}})
-        for job in jobs_extend:
-            result = json.loads(job.result)
-            continue_list = result.get('continue')
-            continue_n = result.get('continue_n')
-            for i, name in enumerate(name_list):
-                if continue_list[i] == True:
-                    simulation_part_n = job.get_simulation_part(name)
-                    if extend_jobs_dict.get(name).get(str(simulation_part_n)) == None:
-                        extend_jobs_dict.get(name)[str(simulation_part_n)] = []
-                    extend_jobs_dict.get(name).get(str(simulation_part_n)).append(ExtendJob(job, continue_n[i]))
+        name_list = extend_plan.name_list
+        # simulation part counters are committed together with the extended jobs
+        extend_jobs_dict = extend_plan.plan(commit=False)
         n_pbs_extend = 0
         multi_njob = current_app.config['EXTEND_GMX_MULTI_NJOB']
         for name in name_list:
@@ -116,6 +189,9 @@ def process_extend(n_job=None):
     try:
         if current_app.config['EXTEND_GMX_MULTI']:
             job_list = []
+            array_commands_list = []
+            array_jobs = {}  # {job_id: [index]}
+            array_bundles = []  # [[job]], jobs of each element of the array
             sim = init_simulation(procedure, extend=True)
             for name in name_list:
                 for simulation_part_n in extend_jobs_dict.get(name).keys():
@@ -153,6 +229,18 @@ def process_extend(n_job=None):
                         else:
                             break
 
+                    if current_app.config.get('EXTEND_GMX_MULTI_ARRAY'):
+                        # bundles of all names are collected into one job array below
+                        # the name of the array is not known yet, the sentinels are added when it is generated
+                        extend_jobs = extend_jobs_dict.get(name).get(simulation_part_n)
+                        for i, commands in enumerate(commands_list):
+                            bundle = [a.job for a in extend_jobs[i * multi_njob:(i + 1) * multi_njob]]
+                            for job in bundle:
+                                array_jobs.setdefault(str(job.id), []).append(len(array_commands_list))
+                            array_commands_list.append(commands)
+                            array_bundles.append(bundle)
+                        continue
+
                     for i, commands in enumerate(commands_list):
                         sh = os.path.join(extend_dir, '_job.extend-%s-%i.sh' % (name, n + i))
                         if procedure == 'npt-2':
@@ -162,6 +250,11 @@ def process_extend(n_job=None):
                         else:
                             pbs_name = '%s-global-extend-%i' % (name, n + i)
 
+                        bundle = extend_jobs_dict.get(name).get(simulation_part_n)[i * multi_njob:(i + 1) * multi_njob]
+                        # a job extended for several names is analyzed after all of them, not in-situ
+                        commands = commands + sentinel_commands(
+                            current_app.jm_extend, [a.job.get_script_spec() for a in bundle], pbs_name,
+                            insitu=len(name_list) == 1)
                         current_app.jm_extend.generate_sh(extend_dir, commands, name=pbs_name, sh=sh)
 
                         # instead of run directly, we add a record to pbs_job
@@ -181,6 +274,36 @@ def process_extend(n_job=None):
                         # submit job, record if success or failed
                         pbs_job.submit()
                         time.sleep(0.2)
+
+            if array_commands_list != []:
+                # all bundles of this extend round are submitted as one job array
+                extend_dir = os.path.join(current_app.config['WORK_DIR'], procedure, 'extend_sh')
+                n = 1
+                while os.path.exists(os.path.join(extend_dir, '_job.extend-array-%i.sh' % (n))):
+                    n += 1
+                sh = os.path.join(extend_dir, '_job.extend-array-%i.sh' % (n))
+                pbs_name = '%s-global-extend-array-%i' % (procedure, n)
+                for i, bundle in enumerate(array_bundles):
+                    array_commands_list[i] = array_commands_list[i] + sentinel_commands(
+                        current_app.jm_extend, [job.get_script_spec() for job in bundle], pbs_name, index=i,
+                        insitu=len(name_list) == 1)
+                generate_array_sh(current_app.jm_extend, extend_dir, array_commands_list, name=pbs_name, sh=sh)
+
+                pbs_job = PbsJob(extend=True)
+                pbs_job.name = pbs_name
+                pbs_job.sh_file = sh
+                pbs_job.array_jobs = json.dumps(array_jobs)
+                db.session.add(pbs_job)
+                db.session.flush()
+
+                for job in job_list:
+                    pbs_jobs_id = json.loads(job.pbs_jobs_id)
+                    pbs_jobs_id.append(pbs_job.id)
+                    job.pbs_jobs_id = json.dumps(pbs_jobs_id)
+                db.session.commit()
+
+                pbs_job.submit()
+                n_pbs_extend = 1
         else:
             for job in jobs_extend:
                 job.extend(hipri=current_app.config.get('HIPRI'))
@@ -194,16 +317,31 @@ def process_extend(n_job=None):
         return n_pbs_extend
 
 
-def process_post_process():
-    current_app.logger.info('Post process finished tasks')
-    tasks = Task.query.filter(Task.procedure == procedure).filter(Task.post_result == None)
-    current_app.logger.info('Total task = %i' % (tasks.count()))
-    count = 1
+async def process_post_process(task_ids=None):
+    '''
+    Post-process finished tasks with changed state points only
+    A task is selected if it is never post-processed, or has jobs analyzed since its last post-processing,
+    whether or not it has a post_result already
+    :return: id of tasks with repeats added, if Config.ADAPTIVE_REPEAT
+    '''
+    tasks = Task.query.filter(Task.procedure == procedure) \
+        .filter(Task.stage == Compute.Stage.RUNNING) \
+        .filter(Task.status.in_([Compute.Status.DONE, Compute.Status.ANALYZED])) \
+        .filter(or_(Task.post_dirty == None, Task.post_dirty != '[]'))
+    if task_ids is not None:
+        tasks = tasks.filter(Task.id.in_(task_ids))
+    tasks = tasks.all()
+    current_app.logger.info('Post process %i tasks' % len(tasks))
+    if tasks == []:
+        return
+    post_process_tasks(tasks)
+    repeat_ids = []
     for task in tasks:
-        sys.stdout.write('\rpresent task = %i' % (count))
-        count += 1
-        task.post_process(overwrite=False)
         task.get_LJ_atom_type()
+        if app.config['ADAPTIVE_REPEAT'] and task.add_repeats() > 0:
+            repeat_ids.append(task.id)
+        await asyncio.sleep(0)
+    return repeat_ids
 
 
 def config_check():
@@ -215,8 +353,11 @@ def config_check():
 
 
 # in ppm simulation, in a task, if the viscosity of highest temperature
-def extend_unfinished_jobs():
+def extend_unfinished_jobs(task_ids=None):
     current_app.logger.info('Continue abnormally terminated ppm jobs')
+    # a job is continued only if it is not running, the state must not be older than this stage
+    get_snapshot(current_app.jobmanager, refresh=True)
+    get_snapshot(current_app.jm_bugfix, refresh=True)
     tasks = Task.query.filter(Task.procedure == procedure)
     for task in tasks:
         for job in task.jobs:
@@ -274,22 +415,32 @@ app = create_app(procedure)
 app.app_context().push()
 
 CWD = os.getcwd()
-while True:
-    # process_task_bug_fix()
-    if not config_check():
-        break
-    # check_tasks_jobs() # use when you increase the repeat number in config.py
-
-    process_pbs_job(n_pbs=50)
-    process_task_run(n_task=20)
-    process_task_build(n_task=20)
-    process_task_check(n_task=4000)
-    if procedure == 'ppm':
-        extend_unfinished_jobs()  # in ppm simulation, in a task, if the viscosity of highest temperature is too slow, then the
+builder = BuildExecutor(n_process=app.config['BUILD_NPROCS'], timeout=app.config['BUILD_TIMEOUT'])
+watcher = CompletionWatcher(procedure)
+if not config_check():
+    sys.exit()
+# molecules of tasks created before the cache, or with outdated SMARTS flags
+update_molecule_cache([smiles for (smiles_list,) in db.session.query(Task.smiles_list).filter(Task.procedure == procedure)
+                       for smiles in json.loads(smiles_list)])
+# check_tasks_jobs() # use when you increase the repeat number in config.py
+
+# Each stage has its own cadence, and is woken up as soon as its upstream stage hands over task ids
+intervals = app.config['MONITOR_INTERVALS']
+monitor = Monitor()
+monitor.add_stage('submit', lambda ids: process_pbs_job(ids, n_pbs=50), interval=intervals['submit'])
+monitor.add_stage('build', lambda ids: process_task_build(ids, n_task=100), interval=intervals['build'],
+                  downstream=['run'])
+monitor.add_stage('run', lambda ids: process_task_run(ids, n_task=20), interval=intervals['run'],
+                  downstream=['check'])
+monitor.add_stage('check', lambda ids: process_task_check(ids, n_task=4000), interval=intervals['check'])
+monitor.add_stage('analyze', process_analyze, interval=intervals['analyze'])
+if app.config['JOB_SENTINEL']:
+    monitor.add_stage('watch', process_watch, interval=intervals['watch'], delay=1)
+if procedure == 'ppm':
+    # in ppm simulation, in a task, if the viscosity of highest temperature is too slow, then the
     # simulation failed in strong acceleration condition. Then the simulation at low temperature will also failed.
     # When GPU is used. single simulation failure will terminate the whole GPU task, use extend_unfinished_jobs() to fix this problem.
-    process_extend(n_job=200)
-    process_post_process()
-
-    app.logger.info('Sleep 1800 seconds ...')
-    time.sleep(1800)
+    monitor.add_stage('bugfix', extend_unfinished_jobs, interval=intervals['extend'], blocking=True)
+monitor.add_stage('extend', lambda ids: process_extend(ids, n_job=200), interval=intervals['extend'], blocking=True)
+monitor.add_stage('post_process', process_post_process, interval=intervals['post_process'], downstream=['run'])
+monitor.run()
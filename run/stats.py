@@ -7,6 +7,7 @@ sys.path.append('..')
 
 from app import create_app
 from app.models import *
+from app.extend import ExtendPlan
 
 procedure = sys.argv[1]
 app = create_app(procedure)
@@ -23,30 +24,13 @@ n_analyzed = tasks.filter(Task.procedure == sys.argv[1]).filter(Task.stage == 2)
 n_failed__ = tasks.filter(Task.procedure == sys.argv[1]).filter(Task.status == -1).count()
 
 def get_extend_info():
-    jobs_extend_tmp = Job.query.filter(Job.status == Compute.Status.ANALYZED).filter(Job.converged == False)\
-        .filter(Job.cycle < Config.EXTEND_CYCLE_LIMIT)
-    jobs_extend = []
-    for job in jobs_extend_tmp:
-        if job.task.procedure == procedure and job.result is not None:
-            jobs_extend.append(job)
-    if len(jobs_extend) == 0:
+    extend_plan = ExtendPlan(procedure)
+    if extend_plan.jobs == []:
         return
-    name_list = json.loads(jobs_extend[0].result).get('name')
-    extend_jobs_dict = {}
-    for name in name_list:
-        extend_jobs_dict.update({name: {}})
-    for i, job in enumerate(jobs_extend):
-        sys.stdout.write('\r%i / %i' % (i, len(jobs_extend)))
-        result = json.loads(job.result)
-        continue_list = result.get('continue')
-        continue_n = result.get('continue_n')
-        for i, name in enumerate(name_list):
-            if continue_list[i] == True:
-                simulation_part_n = job.get_simulation_part(name)
-                if extend_jobs_dict.get(name).get(str(simulation_part_n)) is None:
-                    extend_jobs_dict.get(name)[str(simulation_part_n)] = []
-                extend_jobs_dict.get(name).get(str(simulation_part_n)).append(ExtendJob(job, continue_n[i]))
-    for name in name_list:
+    # stats only reads, the simulation part counters are not saved
+    extend_jobs_dict = extend_plan.plan(
+        callback=lambda i, n: sys.stdout.write('\r%i / %i' % (i, n)), cache=False)
+    for name in extend_plan.name_list:
         for simulation_part_n in extend_jobs_dict.get(name).keys():
             print('%6i  %s-%s jobs need to extend' % (len(extend_jobs_dict.get(name).get(simulation_part_n)), name, simulation_part_n))
 
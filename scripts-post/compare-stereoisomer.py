@@ -44,7 +44,7 @@ for task in tasks:
         t_list = json.loads(task.t_list)
         p_list = json.loads(task.p_list)
         for stereo_smiles in stereo_smiles_list:
-            _task = tasks.filter(Task.smiles_list == json.dumps([stereo_smiles])).first()
+            _task = tasks.filter(Task.smiles_hash == get_smiles_hash([stereo_smiles])).filter(Task.n_components == 1).first()
             _cv = Cv.query.filter(Cv.smiles == stereo_smiles).first()
             if _task is not None:
                 for i, t in enumerate(t_list):
@@ -144,14 +144,14 @@ def get_simulation_cp(pressure, task):
     name = '-'.join(smiles_list)
     f = open('%s-%i-cp-sim.txt' % (name, pressure), 'w')
     t_list = json.loads(task.t_list)
-    for t in t_list:
+    post_data_list = task.get_post_data_list([(t, pressure) for t in t_list])
+    for t, post_data in zip(t_list, post_data_list):
         cp_qm = 0.
         for smiles in smiles_list:
             cv = Cv.query.filter(Cv.smiles == smiles).first()
             if cv is None:
                 return False
             cp_qm += cv.get_post_cv(t)
-        post_data = task.get_post_data(t, pressure)
         cp_inter = post_data.get('cp_inter')
         if cp_inter is None:
             return False
@@ -168,8 +168,8 @@ def get_simulation_hvap(pressure, smiles_list, task):
     name = '-'.join(smiles_list)
     f = open('%s-%i-hvap-sim.txt' % (name, pressure), 'w')
     t_list = json.loads(task.t_list)
-    for t in t_list:
-        post_data = task.get_post_data(t, pressure)
+    post_data_list = task.get_post_data_list([(t, pressure) for t in t_list])
+    for t, post_data in zip(t_list, post_data_list):
         hvap_sim = post_data['hvap']
         if hvap_sim is None:
             return False
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+'''
+Fill job_property and task_fit tables from Job.result and Task.post_result of existing records
+'''
+
+import sys
+
+sys.path.append('..')
+from app import create_app, db
+from app.models import Task, Job, Compute, save_job_properties, save_task_fits
+
+app = create_app(sys.argv[1])
+app.app_context().push()
+
+
+def main(batch=1000):
+    jobs = Job.query.filter(Job.status == Compute.Status.ANALYZED).filter(Job.result != None).order_by(Job.id)
+    n_total = jobs.count()
+    last_id = 0
+    n = 0
+    while True:
+        batch_jobs = jobs.filter(Job.id > last_id).limit(batch).all()
+        if batch_jobs == []:
+            break
+        save_job_properties(batch_jobs)
+        db.session.commit()
+        last_id = batch_jobs[-1].id
+        n += len(batch_jobs)
+        sys.stdout.write('\rjobs %i / %i' % (n, n_total))
+    print('')
+
+    tasks = Task.query.filter(Task.post_result != None).order_by(Task.id).all()
+    for i in range(0, len(tasks), batch):
+        save_task_fits(tasks[i:i + batch])
+        db.session.commit()
+    print('tasks %i' % len(tasks))
+
+
+if __name__ == '__main__':
+    main()
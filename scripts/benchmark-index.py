@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+'''
+Benchmark of the monitor queries on a synthetic database, before and after the migration adds indexes
+The synthetic database is generated only if it does not exist, so that it can be reused
+'''
+
+import os, sys, time, random
+from datetime import datetime
+
+sys.path.append('..')
+from sqlalchemy import create_engine, text
+from app.migrate import migrate, get_tables
+
+import argparse
+
+parser = argparse.ArgumentParser(description='Benchmark of database indexes')
+parser.add_argument('-n', '--njob', type=int, help='Number of jobs', default=1000000)
+parser.add_argument('--repeat', type=int, help='Number of jobs of each task', default=80)
+parser.add_argument('-r', '--nrun', type=int, help='Number of runs of each query', default=20)
+parser.add_argument('--db', type=str, help='Synthetic database', default='benchmark-index.sqlite')
+opt = parser.parse_args()
+random.seed(0)
+
+procedures = ['npt', 'nvt-slab', 'ppm']
+n_task = max(1, opt.njob // opt.repeat)
+t_list = [200 + 20 * i for i in range(opt.repeat // 4 or 1)]
+p_list = [1, 100, 500, 1000]
+
+
+def smiles_of(i):
+    return '["%s"]' % ('C' * (i % 40 + 1) + 'O' * (i // 40))
+
+
+def generate(engine):
+    tables = get_tables()
+    for table in tables:
+        table.create(bind=engine)
+        for index in table.indexes:
+            index.drop(bind=engine)
+
+    now = datetime.now()
+    with engine.begin() as conn:
+        rows = [{'id': i + 1, 'compute_id': 1, 'n_components': 1, 'smiles_list': smiles_of(i),
+                 'procedure': procedures[i % len(procedures)], 'name': 'task-%i' % i,
+                 'stage': random.choice([0, 1, 2]), 'status': random.choice([-1, 1, 9, 10])} for i in range(n_task)]
+        conn.execute(text('INSERT INTO task (id, compute_id, n_components, smiles_list, procedure, name, stage, status) '
+                          'VALUES (:id, :compute_id, :n_components, :smiles_list, :procedure, :name, :stage, :status)'),
+                     rows)
+
+    chunk = 100000
+    for start in range(0, opt.njob, chunk):
+        rows = []
+        for i in range(start, min(start + chunk, opt.njob)):
+            task_id = i // opt.repeat + 1
+            j = i % opt.repeat
+            rows.append({'task_id': task_id, 't': t_list[j % len(t_list)], 'p': p_list[j // len(t_list) % len(p_list)],
+                         'repeat_id': j // (len(t_list) * len(p_list)) + 1, 'time': now, 'name': 'job-%i' % i,
+                         'cycle': random.randint(0, 10), 'status': random.choice([-1, 1, 9, 10]),
+                         'converged': random.choice([0, 1]), 'bugfix': 0})
+        with engine.begin() as conn:
+            conn.execute(text('INSERT INTO job (task_id, t, p, repeat_id, time, name, cycle, status, converged, bugfix) '
+                              'VALUES (:task_id, :t, :p, :repeat_id, :time, :name, :cycle, :status, :converged, :bugfix)'),
+                         rows)
+        sys.stdout.write('\r%i / %i jobs' % (min(start + chunk, opt.njob), opt.njob))
+    print('')
+
+    with engine.begin() as conn:
+        rows = [{'name': 'pbs-%i' % i, 'sh_file': '_job.run-%i.sh' % i, 'submitted': int(i < n_task - 20)}
+                for i in range(n_task)]
+        conn.execute(text('INSERT INTO pbs_job (name, sh_file, extend, submitted, bugfix) '
+                          'VALUES (:name, :sh_file, 0, :submitted, 0)'), rows)
+
+
+# the queries used by run/monitor.py, with parameters picked from the synthetic data
+queries = [
+    ('task procedure,stage,status', 'SELECT id FROM task WHERE procedure = :procedure AND stage = 2 AND status = 1',
+     lambda: {'procedure': random.choice(procedures)}),
+    ('task smiles_list', 'SELECT id FROM task WHERE smiles_list = :smiles_list AND procedure = :procedure',
+     lambda: {'smiles_list': smiles_of(random.randrange(n_task)), 'procedure': random.choice(procedures)}),
+    ('job task_id,status', 'SELECT id FROM job WHERE task_id = :task_id AND status = 9',
+     lambda: {'task_id': random.randint(1, n_task)}),
+    ('job task_id,t,p,repeat_id', 'SELECT id FROM job WHERE task_id = :task_id AND t = :t AND p = :p AND repeat_id = 1',
+     lambda: {'task_id': random.randint(1, n_task), 't': random.choice(t_list), 'p': random.choice(p_list)}),
+    ('job status,converged,cycle', 'SELECT count(id) FROM job WHERE status = 10 AND converged = 0 AND cycle < 5',
+     lambda: {}),
+    ('pbs_job submitted', 'SELECT id FROM pbs_job WHERE submitted = 0 LIMIT 20',
+     lambda: {}),
+]
+
+
+def benchmark(engine):
+    timings = []
+    with engine.connect() as conn:
+        for name, sql, get_params in queries:
+            t0 = time.time()
+            for i in range(opt.nrun):
+                conn.execute(text(sql), get_params()).fetchall()
+            timings.append((time.time() - t0) / opt.nrun)
+    return timings
+
+
+engine = create_engine('sqlite:///%s' % os.path.abspath(opt.db))
+if not os.path.exists(opt.db):
+    print('Generate synthetic database %s' % opt.db)
+    generate(engine)
+else:
+    # make sure the benchmark starts from a database without indexes
+    for table in get_tables():
+        for index in table.indexes:
+            with engine.begin() as conn:
+                conn.execute(text('DROP INDEX IF EXISTS %s' % index.name))
+
+before = benchmark(engine)
+t0 = time.time()
+changes = migrate(engine)
+t_migrate = time.time() - t0
+after = benchmark(engine)
+
+for sql in changes:
+    print(sql)
+print('Migration takes %.1f s\n' % t_migrate)
+print('%-30s %12s %12s %8s' % ('query', 'before (ms)', 'after (ms)', 'speedup'))
+for (name, sql, get_params), t_before, t_after in zip(queries, before, after):
+    print('%-30s %12.3f %12.3f %8.1f' % (name, t_before * 1000, t_after * 1000, t_before / max(t_after, 1e-9)))
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+'''
+Compare Task.get_post_data() at each state point with the batch evaluator get_post_data_table()
+The relative deviation of each property from the mstools engine is reported, it should be within rounding error
+Usage: ./benchmark-post-data.py npt [n_task]
+'''
+
+import sys
+import time
+
+import numpy as np
+
+sys.path.append('..')
+from app import create_app
+from app.models import Task, Compute
+from app.query import get_post_data_table, POST_DATA_COLUMNS
+
+app = create_app(sys.argv[1], readonly=True)
+app.app_context().push()
+
+
+def main(n_task=100):
+    tasks = Task.query.filter(Task.procedure == sys.argv[1]).filter(Task.status == Compute.Status.ANALYZED) \
+        .filter(Task.post_result != None).limit(n_task).all()
+    TP_list = [(T, P) for T in range(200, 501, 10) for P in [1, 10, 100, 500, 1000]]
+    print('%i tasks, %i state points' % (len(tasks), len(TP_list)))
+
+    t0 = time.time()
+    point_data = [task.get_post_data_list(TP_list) for task in tasks]
+    t1 = time.time()
+    table = get_post_data_table(tasks, TP_list)
+    t2 = time.time()
+    print('per-point %.3f s, batch %.3f s, speedup %.1f' % (t1 - t0, t2 - t1, (t1 - t0) / max(t2 - t1, 1e-9)))
+    print('%i tasks evaluated point by point' % table.attrs['n_fallback'])
+
+    for prop in POST_DATA_COLUMNS:
+        expect = np.array([[np.nan if d.get(prop) is None else d[prop] for d in data] for data in point_data],
+                          dtype=float).ravel()
+        value = table[prop].values
+        mask = np.isfinite(expect) & np.isfinite(value) & (expect != 0)
+        deviation = np.abs(value[mask] - expect[mask]) / np.abs(expect[mask])
+        print('%-10s max relative deviation %.3e' % (prop, deviation.max() if mask.any() else np.nan))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[2]) if len(sys.argv) > 2 else 100)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+'''
+Compare the cost of checking job states one by one with the cost of reading a scheduler snapshot
+A LocalJobManager is used, so that no cluster is required
+'''
+
+import sys, time
+
+sys.path.append('..')
+from app.jobmanager import LocalJobManager, LocalPbsJob, SchedulerSnapshot
+
+import argparse
+
+parser = argparse.ArgumentParser(description='Benchmark of scheduler snapshot')
+parser.add_argument('-n', '--njob', type=int, help='Number of PBS jobs', default=4000)
+parser.add_argument('-l', '--latency', type=float, help='Latency (seconds) of one squeue call', default=0.002)
+opt = parser.parse_args()
+
+jm = LocalJobManager(run=False, latency=opt.latency)
+jm.stored_jobs = []
+names = []
+for i in range(opt.njob):
+    name = 'job-%i' % i
+    jm._id += 1
+    state = LocalPbsJob.State.RUNNING if i % 2 == 0 else LocalPbsJob.State.DONE
+    jm._jobs[str(jm._id)] = [name, '_job.run-%i.sh' % i, state]
+    names.append(name)
+
+t0 = time.time()
+n_query = jm.n_query
+running_1 = [jm.is_running(name) for name in names]
+t1 = time.time()
+print('%-10s %8.3f s %6i queries' % ('per-job', t1 - t0, jm.n_query - n_query))
+
+snapshot = SchedulerSnapshot(jm, ttl=300)
+n_query = jm.n_query
+running_2 = [snapshot.is_running(name) for name in names]
+t2 = time.time()
+print('%-10s %8.3f s %6i queries' % ('snapshot', t2 - t1, jm.n_query - n_query))
+
+if running_1 != running_2:
+    raise Exception('Snapshot is inconsistent with job manager')
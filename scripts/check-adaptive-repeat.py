@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+'''
+Check the stopping rule of adaptive repeats, postprocess.get_n_more_repeats()
+The stderr in the result of a state point is the standard deviation between repeats
+No database is required
+'''
+
+import sys
+
+sys.path.append('..')
+from config import Config
+from app.postprocess import get_n_more_repeats
+
+Config.REPEAT_BATCH = 16
+Config.REPEAT_TARGET_STDERR = {'viscosity': 0.05, 'electrical conductivity': 0.05}
+
+# std / value = 0.2 needs (0.2 / 0.05) ** 2 = 16 repeats
+result = {'viscosity': 1.0, 'vis_stderr': 0.2, 'electrical conductivity': 2.0, 'econ_stderr': 0.2}
+
+# the relative precision is met with 16 and 32 repeats. No more repeats whatever the number already run
+assert get_n_more_repeats(result, n_converged=16, n_repeat=16, n_max=80) == 0
+assert get_n_more_repeats(result, n_converged=32, n_repeat=32, n_max=80) == 0
+
+# std / value = 0.4 needs 64 repeats
+result['vis_stderr'] = 0.4
+assert get_n_more_repeats(result, n_converged=16, n_repeat=16, n_max=80) == 48
+assert get_n_more_repeats(result, n_converged=64, n_repeat=64, n_max=80) == 0
+# limited by n_max
+assert get_n_more_repeats(result, n_converged=16, n_repeat=70, n_max=80) == 10
+
+# not fitted, one more batch
+result['viscosity'] = None
+assert get_n_more_repeats(result, n_converged=16, n_repeat=16, n_max=80) == 16
+
+print('OK')
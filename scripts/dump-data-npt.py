@@ -12,7 +12,7 @@ from app.models_cv import Cv
 from mstools.formula import Formula
 from mstools.utils import is_alkane
 
-app = create_app('npt')
+app = create_app('npt', readonly=True)
 app.app_context().push()
 
 smiles_list = []
@@ -57,11 +57,13 @@ def get_npt_result(limit=None):
             ml = False
 
         cv = Cv.query.filter(Cv.smiles == smiles).first()
+        # all state points of the task are evaluated with one engine
+        post_data_list = task.get_post_data_list([(t, p) for t, p, raw_density in post_result['density']])
         for i, (t, p, raw_density) in enumerate(post_result['density']):
             raw_einter = post_result['einter'][i][2]
             raw_compress = post_result['compress'][i][2]
 
-            post_data = task.get_post_data(t, p)
+            post_data = post_data_list[i]
             density = post_data['density']
             einter = post_data['einter']
             hvap = post_data['hvap']
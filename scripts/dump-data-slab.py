@@ -10,7 +10,7 @@ from app import create_app
 from app.models import Task
 from mstools.formula import Formula
 
-app = create_app('nvt-slab')
+app = create_app('nvt-slab', readonly=True)
 app.app_context().push()
 
 smiles_list = []
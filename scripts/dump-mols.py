@@ -15,7 +15,7 @@ from app.models import Task
 from app.models_nist import NistMolecule
 
 smiles_list = set()
-npt = create_app('npt')
+npt = create_app('npt', readonly=True)
 with npt.app_context():
     tasks = Task.query.filter(Task.remark == None)
     for task in tasks:
@@ -24,7 +24,7 @@ with npt.app_context():
             continue
         smiles_list.add(task.get_smiles_list()[0])
 
-slab = create_app('nvt-slab')
+slab = create_app('nvt-slab', readonly=True)
 with slab.app_context():
     tasks = Task.query.filter(Task.remark == None)
     for task in tasks:
@@ -10,10 +10,11 @@ from app.models_nist import *
 
 print('#SMILES T(K) P(bar) density(g/mL) u e_inter(kJ/mol) u cp(J/mol.K) u')
 
-for nist in NistMolecule.query.filter(NistMolecule.remark == 'alkane').filter(
-        NistMolecule.n_heavy < 20).order_by(NistMolecule.n_heavy):
-    task = Task.query.filter(Task.smiles_list == json.dumps([nist.smiles])).first()
-    if task != None:
+nist_list = NistMolecule.query.filter(NistMolecule.remark == 'alkane').filter(
+        NistMolecule.n_heavy < 20).order_by(NistMolecule.n_heavy).all()
+smiles_task_id = Task.get_task_ids([nist.smiles for nist in nist_list], procedure=None)
+for nist in nist_list:
+    if nist.smiles in smiles_task_id:
         continue
 
     t_list = [298]
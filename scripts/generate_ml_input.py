@@ -11,6 +11,7 @@ from app.models_nist import *
 from app.models_cv import Cv
 from app.models_ilthermo import *
 from app.selection import *
+from app.molecule import get_molecules
 from mstools.analyzer.fitting import (
     VTFfit,
     fit_vle_dminus,
@@ -343,9 +344,10 @@ def main():
         for smiles in info['SMILES'].unique():
             training_smiles_list.append(get_canonical_smiles(smiles))
         print('%i molecules in training set' % len(training_smiles_list))
+        # all tasks are looked up in a few indexed queries
+        smiles_task_id = Task.get_task_ids(training_smiles_list, procedure=args.procedure)
         for smiles in training_smiles_list:
-            task = Task.query.filter(Task.procedure == args.procedure).filter(
-                Task.smiles_list == json.dumps([smiles])).first()
+            task = Task.query.get(smiles_task_id[smiles]) if smiles in smiles_task_id else None
             if task is None:
                 print('There is no task for %s' % smiles)
                 continue
@@ -426,6 +428,7 @@ def main():
         p_list = []
         den_list = []
         tasks = Task.query.filter(Task.procedure == args.procedure)
+        molecules = get_molecules([task.get_smiles_list()[0] for task in tasks])
         for task in tasks:
             if task.status in [Compute.Status.FAILED, Compute.Status.STARTED]:
                 continue
@@ -437,10 +440,10 @@ def main():
             if post_result is None or post_result['density-poly4'][-1] < 0.999:
                 continue
             smiles = task.get_smiles_list()[0]
-            py_mol = task.get_mol_list()[0]
-            if not 5 < get_heavy_atom_numbers(smiles) < args.nheavy:
+            molecule = molecules[smiles]
+            if not 5 < molecule.n_heavy < args.nheavy:
                 continue
-            f = Formula(py_mol.formula)
+            f = Formula(molecule.formula)
             n_CON = f.atomdict.get('C', 0) + f.atomdict.get('O', 0) + f.atomdict.get('N', 0)
             cv = Cv.query.filter(Cv.smiles == smiles).first()
             jobs = task.jobs
@@ -507,6 +510,7 @@ def main():
         t_list = []
         p_list = []
         tasks = Task.query.filter(Task.procedure == args.procedure)
+        molecules = get_molecules([task.get_smiles_list()[0] for task in tasks])
         for task in tasks:
             if task.status in [Compute.Status.FAILED, Compute.Status.STARTED]:
                 continue
@@ -518,7 +522,7 @@ def main():
             if post_result is None:
                 continue
             smiles = task.get_smiles_list()[0]
-            if not 5 < get_heavy_atom_numbers(smiles) < args.nheavy:
+            if not 5 < molecules[smiles].n_heavy < args.nheavy:
                 continue
             jobs = task.jobs
             for i, t in enumerate(task.get_t_list()):
@@ -9,16 +9,22 @@ parser = argparse.ArgumentParser(description='This is a code to post-process the
 parser.add_argument('-p', '--procedure', type=str, help='procedure of the compute: npt(ppm), or nvt-slab')
 parser.add_argument('-s', '--smiles', type=str, help='The smiles list of specific molecule')
 parser.add_argument('-pro', '--property', type=str, help='The property want to calculated')
+parser.add_argument('-r', '--ratio', type=str, help='The n_mol_ratio of the mixture, e.g. 1:3. Any ratio if not set')
 opt = parser.parse_args()
 
-app = create_app(opt.procedure)
+app = create_app(opt.procedure, readonly=True)
 app.app_context().push()
 
 from app.models import *
 smiles_list = opt.smiles.split('.')
+n_mol_ratio = None if opt.ratio is None else [int(n) for n in opt.ratio.split(':')]
 # task_id = Task.query.filter(Task.smiles_list == json.dumps(smiles_list)).first().id
+# smiles_hash does not depend on the order of components, so the tasks found are checked against the exact smiles_list
+task_ids = [task.id for task in Task.query.filter(Task.smiles_hash == get_smiles_hash(smiles_list))
+            if json.loads(task.smiles_list) == smiles_list
+            and (n_mol_ratio is None or json.loads(task.n_mol_ratio or 'null') == n_mol_ratio)]
 print('# T P sim simstderr')
-for job in Job.query.join(Task).filter(Task.smiles_list == json.dumps(smiles_list)).order_by(Job.t, Job.p):
+for job in Job.query.filter(Job.task_id.in_(task_ids)).order_by(Job.t, Job.p):
 # for job in Job.query.filter(Job.task_id == task_id).order_by(Job.t, Job.p):
     if job.converged:
         if json.loads(job.result).get(opt.property) != None:
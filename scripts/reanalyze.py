@@ -21,6 +21,9 @@ procedure = opt.procedure
 app = create_app(procedure)
 app.app_context().push()
 
+# jobs whose result is cleared, their rows in job_property are deleted before commit
+reset_jobs = []
+
 if opt.id != 0:
     compute = Compute.query.get(opt.id)
     tasks = compute.tasks
@@ -36,8 +39,10 @@ if opt.id != 0:
                 job.converged = False
                 job.status = Compute.Status.STARTED
                 job.result = None
+                reset_jobs.append(job)
         else:
             raise Exception('Compute %i is not a %s (procedure) compute' % (opt.id, procedure))
+    save_job_properties(reset_jobs)
     db.session.commit()
 elif opt.taskid != 0:
     tasks = Task.query.filter(Task.procedure == procedure).filter(Task.id == opt.taskid)
@@ -49,8 +54,10 @@ elif opt.taskid != 0:
                 job.converged = False
                 job.status = Compute.Status.STARTED
                 job.result = None
+                reset_jobs.append(job)
         else:
             raise Exception('Task %i is not a %s (procedure) compute' % (opt.taskid, procedure))
+    save_job_properties(reset_jobs)
     db.session.commit()
 elif opt.jobid != 0:
     job = Job.query.filter(Job.id == opt.jobid).first()
@@ -58,8 +65,10 @@ elif opt.jobid != 0:
         job.converged = False
         job.status = Compute.Status.STARTED
         job.result = None
+        reset_jobs.append(job)
         job.task.stage = Compute.Stage.RUNNING
         job.task.status = Compute.Status.STARTED
+        save_job_properties(reset_jobs)
         db.session.commit()
 elif opt.failed_jobs:
     failed_jobs = Job.query.filter(Job.status == Compute.Status.FAILED)
@@ -72,8 +81,10 @@ elif opt.failed_jobs:
             job.converged = False
             job.status = Compute.Status.STARTED
             job.result = None
+            reset_jobs.append(job)
             job.task.stage = Compute.Stage.RUNNING
             job.task.status = Compute.Status.STARTED
+    save_job_properties(reset_jobs)
     db.session.commit()
 elif opt.failed_tasks:
     failed_tasks = Task.query.filter(Task.status == Compute.Status.FAILED).filter(Task.procedure == procedure)
@@ -89,8 +100,10 @@ elif opt.failed_tasks:
                 job.converged = False
                 job.status = Compute.Status.STARTED
                 job.result = None
+                reset_jobs.append(job)
         else:
             raise Exception('Task %i is not a %s (procedure) compute' % (task.id, procedure))
+    save_job_properties(reset_jobs)
     db.session.commit()
 elif opt.unfinished_tasks:
     unfinished_tasks = Task.query.filter(Task.procedure == procedure).filter(Task.stage == Compute.Stage.RUNNING).filter(Task.status == Compute.Status.STARTED)
@@ -106,8 +119,10 @@ elif opt.unfinished_tasks:
                 job.converged = False
                 job.status = Compute.Status.STARTED
                 job.result = None
+                reset_jobs.append(job)
         else:
             raise Exception('Task %i is not a %s (procedure) compute' % (task.id, procedure))
+    save_job_properties(reset_jobs)
     db.session.commit()
 else:
     tasks = Task.query.filter(Task.procedure == procedure)
@@ -123,8 +138,10 @@ else:
                 job.converged = False
                 job.status = Compute.Status.STARTED
                 job.result = None
+                reset_jobs.append(job)
         else:
             raise Exception('Task %i is not a %s (procedure) compute' % (task.id, procedure))
+    save_job_properties(reset_jobs)
     db.session.commit()
 
 
@@ -13,7 +13,7 @@ from app.models_qmcv import IonQM
 
 
 procedure = sys.argv[1]
-app = create_app(sys.argv[1])
+app = create_app(sys.argv[1], readonly=True)
 app.app_context().push()
 CWD = os.getcwd()
 